@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+"""
+This script compares the treecode evaluation of the Biot-Savart law,
+selected by passing tol to BiotSavart.set_points, with the direct sum
+over all coil quadrature points. The coils are a ring of circular
+coils, and the points are spread over the volume they enclose, as for
+field line tracing or a Poincare plot. For an increasing number of
+points, the time for evaluating B is reported for the direct sum and
+for several tolerances, together with the speedup and the maximum
+relative error of the treecode.
+
+The largest case takes a while for the direct sum.
+"""
+
+from time import perf_counter
+
+import numpy as np
+
+from simsopt.geo.curvexyzfourier import CurveXYZFourier
+from simsopt.geo.biotsavart import BiotSavart
+
+ncoils = 100
+nquadpoints = 200
+major_radius = 1.0
+minor_radius = 0.4
+
+coils = []
+for phi in np.linspace(0, 2 * np.pi, ncoils, endpoint=False):
+    coil = CurveXYZFourier(nquadpoints, 1)
+    coil.set_dofs([major_radius * np.cos(phi), 0, minor_radius * np.cos(phi),
+                   major_radius * np.sin(phi), 0, minor_radius * np.sin(phi),
+                   0, minor_radius, 0])
+    coils.append(coil)
+currents = 1e5 * np.ones(ncoils)
+bs = BiotSavart(coils, currents)
+
+
+def random_points(npoints):
+    """
+    Return points distributed uniformly in angle and in a square
+    cross-section inside the coils.
+    """
+    phi = 2 * np.pi * np.random.rand(npoints)
+    r = major_radius + 0.6 * minor_radius * (2 * np.random.rand(npoints) - 1)
+    z = 0.6 * minor_radius * (2 * np.random.rand(npoints) - 1)
+    return np.stack((r * np.cos(phi), r * np.sin(phi), z), axis=1)
+
+
+def time_B(points, tol):
+    """
+    Return B and the wall-clock time for evaluating it.
+    """
+    bs.set_points(points, tol=tol)
+    start = perf_counter()
+    B = bs.B()
+    return B, perf_counter() - start
+
+
+np.random.seed(0)
+tols = [1e-6, 1e-4, 1e-2]
+print("Coils: {}, quadrature points per coil: {}".format(ncoils, nquadpoints))
+print("{:>8} {:>12} {:>8} {:>12} {:>10} {:>12}".format(
+    "npoints", "direct (s)", "tol", "tree (s)", "speedup", "max rel err"))
+for npoints in [1000, 10000, 100000, 1000000]:
+    points = random_points(npoints)
+    B_direct, direct_time = time_B(points, None)
+    for tol in tols:
+        B_tree, tree_time = time_B(points, tol)
+        err = np.max(np.linalg.norm(B_tree - B_direct, axis=1) / np.linalg.norm(B_direct, axis=1))
+        print("{:8d} {:12.4e} {:8.0e} {:12.4e} {:10.2f} {:12.4e}".format(
+            npoints, direct_time, tol, tree_time, direct_time / tree_time, err))
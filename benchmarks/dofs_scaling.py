@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+"""
+This script measures how the cost of the bookkeeping in
+simsopt.core.dofs.Dofs scales with the number of degrees of
+freedom. A collection of Adder objects, each owning a block of dofs,
+is combined into a single Dofs object, and the time required for
+Dofs.x, Dofs.set() and Dofs.jac() is reported.
+
+Since x, set() and jac() use the index maps precomputed in
+Dofs.__init__, the cost of each call should grow roughly linearly
+with the total number of dofs.
+"""
+
+from time import perf_counter
+
+import numpy as np
+
+from simsopt.core.dofs import Dofs
+from simsopt.core.functions import Adder
+
+
+def time_call(func, nrepeat):
+    """
+    Return the mean wall-clock time for calling func().
+    """
+    start = perf_counter()
+    for j in range(nrepeat):
+        func()
+    return (perf_counter() - start) / nrepeat
+
+
+dofs_per_owner = 50
+nrepeat = 20
+
+print("{:>8} {:>8} {:>12} {:>12} {:>12} {:>12}".format(
+    "nparams", "nowners", "init (s)", "x (s)", "set (s)", "jac (s)"))
+for nparams in [100, 300, 1000, 3000, 10000]:
+    nowners = nparams // dofs_per_owner
+    owners = [Adder(dofs_per_owner) for j in range(nowners)]
+    # Fix one dof in each owner so the maps are not trivial:
+    for owner in owners:
+        owner.fixed[0] = True
+
+    start = perf_counter()
+    dofs = Dofs([owner.J for owner in owners])
+    init_time = perf_counter() - start
+
+    x = np.random.rand(dofs.nparams)
+    x_time = time_call(lambda: dofs.x, nrepeat)
+    set_time = time_call(lambda: dofs.set(x), nrepeat)
+    jac_time = time_call(dofs.jac, nrepeat)
+
+    print("{:8d} {:8d} {:12.4e} {:12.4e} {:12.4e} {:12.4e}".format(
+        dofs.nparams, nowners, init_time, x_time, set_time, jac_time))
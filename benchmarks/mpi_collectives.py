@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+"""
+This script compares the cost of the pickle-based lowercase mpi4py
+collectives with the buffer-based uppercase ones, for the two kinds of
+communication in the parallel solvers: broadcasting a state vector,
+and collecting the function evaluations for a finite-difference
+Jacobian on rank 0.
+
+For the second case, the old approach of summing a dense (nvals,
+ncols) matrix over all ranks, where each column is nonzero on only
+one rank, is compared with gathering each rank's columns with
+Gatherv.
+
+Run this script with different numbers of ranks, e.g.
+
+    mpiexec -n 4 python mpi_collectives.py
+"""
+
+from time import perf_counter
+
+import numpy as np
+from mpi4py import MPI
+
+comm = MPI.COMM_WORLD
+rank = comm.Get_rank()
+nprocs = comm.Get_size()
+nrepeat = 50
+
+
+def time_call(func):
+    """
+    Return the maximum over ranks of the mean wall-clock time for
+    calling func().
+    """
+    comm.Barrier()
+    start = perf_counter()
+    for j in range(nrepeat):
+        func()
+    elapsed = (perf_counter() - start) / nrepeat
+    return comm.allreduce(elapsed, op=MPI.MAX)
+
+
+if rank == 0:
+    print("Number of ranks:", nprocs)
+    print("{:>8} {:>12} {:>12}".format("nparams", "bcast (s)", "Bcast (s)"))
+for nparams in [10, 100, 1000, 10000, 100000]:
+    x = np.random.rand(nparams)
+    bcast_time = time_call(lambda: comm.bcast(x, root=0))
+    Bcast_time = time_call(lambda: comm.Bcast(x, root=0))
+    if rank == 0:
+        print("{:8d} {:12.4e} {:12.4e}".format(nparams, bcast_time, Bcast_time))
+
+if rank == 0:
+    print()
+    print("{:>8} {:>8} {:>12} {:>12}".format("nvals", "ncols", "reduce (s)", "Gatherv (s)"))
+for nvals in [10, 1000, 100000]:
+    ncols = 4 * nprocs
+    # Columns are assigned round-robin:
+    mine = np.arange(rank, ncols, nprocs)
+    evals = np.zeros((nvals, ncols))
+    evals[:, mine] = np.random.rand(nvals, len(mine))
+
+    def dense_reduce():
+        comm.reduce(evals, op=MPI.SUM, root=0)
+
+    # Each rank sends its own columns, stored contiguously:
+    sendbuf = np.ascontiguousarray(evals[:, mine].T)
+    counts = np.array([len(range(r, ncols, nprocs)) * nvals for r in range(nprocs)])
+    displacements = np.concatenate(([0], np.cumsum(counts[:-1])))
+    recvbuf = np.empty(ncols * nvals) if rank == 0 else None
+
+    def column_gather():
+        if rank == 0:
+            comm.Gatherv(sendbuf, [recvbuf, counts, displacements, MPI.DOUBLE], root=0)
+        else:
+            comm.Gatherv(sendbuf, None, root=0)
+
+    reduce_time = time_call(dense_reduce)
+    gather_time = time_call(column_gather)
+    if rank == 0:
+        print("{:8d} {:8d} {:12.4e} {:12.4e}".format(nvals, ncols, reduce_time, gather_time))
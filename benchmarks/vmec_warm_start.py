@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+"""
+This script compares the cost of cold-started and warm-started VMEC
+runs for the kind of small perturbations used in finite-difference
+Jacobians. For each step size, VMEC is first run at a base point to
+populate the cache, and then run again with rc(0,0) perturbed. The
+number of force-residual records written by VMEC (itfsq, which is
+proportional to the number of iterations) and the wall-clock time of
+the perturbed run are reported, along with the change in the volume
+between the cold and warm results.
+"""
+
+import os
+from time import perf_counter
+
+from mpi4py import MPI
+from scipy.io import netcdf
+
+from simsopt.mhd import Vmec
+
+filename = os.path.join(os.path.dirname(__file__), '..', 'tests',
+                        'test_files', 'input.li383_low_res')
+
+
+def perturbed_run(warm_start, step):
+    """
+    Run VMEC at a base point, then at a perturbed point. Return the
+    wall-clock time, itfsq and volume for the perturbed run.
+    """
+    v = Vmec(filename, warm_start=warm_start)
+    v.run()
+    v.boundary.set_rc(0, 0, v.boundary.get_rc(0, 0) + step)
+    start = perf_counter()
+    v.run()
+    elapsed = perf_counter() - start
+    f = netcdf.netcdf_file(v.output_file, mmap=False)
+    itfsq = int(f.variables['itfsq'][()])
+    f.close()
+    return elapsed, itfsq, v.volume()
+
+
+if MPI.COMM_WORLD.Get_rank() == 0:
+    print("{:>10} {:>10} {:>10} {:>10} {:>10} {:>12}".format(
+        "step", "cold itfsq", "warm itfsq", "cold (s)", "warm (s)", "volume diff"))
+for step in [1.0e-7, 1.0e-5, 1.0e-3]:
+    cold_time, cold_itfsq, cold_volume = perturbed_run(False, step)
+    warm_time, warm_itfsq, warm_volume = perturbed_run(True, step)
+    if MPI.COMM_WORLD.Get_rank() == 0:
+        print("{:10.1e} {:10d} {:10d} {:10.3f} {:10.3f} {:12.3e}".format(
+            step, cold_itfsq, warm_itfsq, cold_time, warm_time,
+            warm_volume - cold_volume))
@@ -1,4 +1,6 @@
 #include "biot_savart.h"
+#include "biot_savart_tree.h"
+#include <algorithm>
 
 // When compiled with C++17, then we use `if constexpr` to check for
 // derivatives that need to be computed.  These are actually evaluated at
@@ -12,14 +14,18 @@
 #define MYIF(c) if(c)
 #endif
 
+// Adds scale times the field of one coil to B (and its derivatives) at the
+// points with indices start <= i < end. start has to be a multiple of the SIMD
+// width, so that the aligned loads of the point coordinates are valid.
 template<class T, int derivs>
-void biot_savart_kernel(vector_type& pointsx, vector_type& pointsy, vector_type& pointsz, T& gamma, T& dgamma_by_dphi, T& B, T& dB_by_dX, T& d2B_by_dXdX) {
-    int num_points         = pointsx.size();
+void biot_savart_kernel(vector_type& pointsx, vector_type& pointsy, vector_type& pointsz, T& gamma, T& dgamma_by_dphi, T& B, T& dB_by_dX, T& d2B_by_dXdX, int start, int end, double scale) {
     int num_quad_points    = gamma.shape(0);
     constexpr int simd_size = xsimd::simd_type<double>::size;
+    int simd_end = end - (end - start) % simd_size;
+    double fak = scale * 1e-7/num_quad_points;
     auto dB_dX_i = vector<Vec3dSimd, xs::aligned_allocator<Vec3dSimd, XSIMD_DEFAULT_ALIGNMENT>>();
     auto d2B_dXdX_i = vector<Vec3dSimd, xs::aligned_allocator<Vec3dSimd, XSIMD_DEFAULT_ALIGNMENT>>();
-    for(int i = 0; i < num_points-num_points%simd_size; i += simd_size) {
+    for(int i = start; i < simd_end; i += simd_size) {
         auto point_i = Vec3dSimd(&(pointsx[i]), &(pointsy[i]), &(pointsz[i]));
         auto B_i   = Vec3dSimd();
         MYIF(derivs > 0) {
@@ -87,48 +93,48 @@ void biot_savart_kernel(vector_type& pointsx, vector_type& pointsy, vector_type&
         }
 
         for(int j=0; j<simd_size; j++){
-            B(i+j, 0) = B_i.x[j];
-            B(i+j, 1) = B_i.y[j];
-            B(i+j, 2) = B_i.z[j];
+            B(i+j, 0) += fak * B_i.x[j];
+            B(i+j, 1) += fak * B_i.y[j];
+            B(i+j, 2) += fak * B_i.z[j];
             MYIF(derivs > 0) {
                 for(int k=0; k<3; k++) {
-                    dB_by_dX(i+j, k, 0) = dB_dX_i[k].x[j];
-                    dB_by_dX(i+j, k, 1) = dB_dX_i[k].y[j];
-                    dB_by_dX(i+j, k, 2) = dB_dX_i[k].z[j];
+                    dB_by_dX(i+j, k, 0) += fak * dB_dX_i[k].x[j];
+                    dB_by_dX(i+j, k, 1) += fak * dB_dX_i[k].y[j];
+                    dB_by_dX(i+j, k, 2) += fak * dB_dX_i[k].z[j];
                 }
             }
             MYIF(derivs > 1) {
                 for(int k1=0; k1<3; k1++) {
                     for(int k2=0; k2<=k1; k2++) {
-                        d2B_by_dXdX(i+j, k1, k2, 0) = d2B_dXdX_i[3*k1 + k2].x[j];
-                        d2B_by_dXdX(i+j, k1, k2, 1) = d2B_dXdX_i[3*k1 + k2].y[j];
-                        d2B_by_dXdX(i+j, k1, k2, 2) = d2B_dXdX_i[3*k1 + k2].z[j];
+                        d2B_by_dXdX(i+j, k1, k2, 0) += fak * d2B_dXdX_i[3*k1 + k2].x[j];
+                        d2B_by_dXdX(i+j, k1, k2, 1) += fak * d2B_dXdX_i[3*k1 + k2].y[j];
+                        d2B_by_dXdX(i+j, k1, k2, 2) += fak * d2B_dXdX_i[3*k1 + k2].z[j];
                         if(k2 < k1){
-                            d2B_by_dXdX(i+j, k2, k1, 0) = d2B_dXdX_i[3*k1 + k2].x[j];
-                            d2B_by_dXdX(i+j, k2, k1, 1) = d2B_dXdX_i[3*k1 + k2].y[j];
-                            d2B_by_dXdX(i+j, k2, k1, 2) = d2B_dXdX_i[3*k1 + k2].z[j];
+                            d2B_by_dXdX(i+j, k2, k1, 0) += fak * d2B_dXdX_i[3*k1 + k2].x[j];
+                            d2B_by_dXdX(i+j, k2, k1, 1) += fak * d2B_dXdX_i[3*k1 + k2].y[j];
+                            d2B_by_dXdX(i+j, k2, k1, 2) += fak * d2B_dXdX_i[3*k1 + k2].z[j];
                         }
                     }
                 }
             }
         }
     }
-    for (int i = num_points - num_points % simd_size; i < num_points; ++i) {
+    for (int i = simd_end; i < end; ++i) {
         auto point = Vec3d{pointsx[i], pointsy[i], pointsz[i]};
-        B(i, 0) = 0;
-        B(i, 1) = 0;
-        B(i, 2) = 0;
+        Vec3d B_p = Vec3d::Zero();
+        Vec3d dB_dX_p[3];
+        Vec3d d2B_dXdX_p[9];
+        for(int k=0; k<3; k++)
+            dB_dX_p[k].setZero();
+        for(int k=0; k<9; k++)
+            d2B_dXdX_p[k].setZero();
         for (int j = 0; j < num_quad_points; ++j) {
             Vec3d gamma_j = Vec3d { gamma(j, 0), gamma(j, 1), gamma(j, 2)};
             Vec3d dgamma_by_dphi_j = Vec3d { dgamma_by_dphi(j, 0), dgamma_by_dphi(j, 1), dgamma_by_dphi(j, 2)};
             Vec3d diff = point - gamma_j;
             double norm_diff = norm(diff);
             Vec3d dgamma_by_dphi_j_cross_diff = cross(dgamma_by_dphi_j, diff);
-            Vec3d B_i = dgamma_by_dphi_j_cross_diff / (norm_diff * norm_diff * norm_diff);
-
-            B(i, 0) += B_i[0];
-            B(i, 1) += B_i[1];
-            B(i, 2) += B_i[2];
+            B_p += dgamma_by_dphi_j_cross_diff / (norm_diff * norm_diff * norm_diff);
             MYIF(derivs > 0) {
                 double norm_diff_4_inv = 1/(norm_diff*norm_diff*norm_diff*norm_diff);
                 Vec3d three_dgamma_by_dphi_cross_diff_by_norm_diff = dgamma_by_dphi_j_cross_diff * 3 / norm_diff;
@@ -137,10 +143,7 @@ void biot_savart_kernel(vector_type& pointsx, vector_type& pointsy, vector_type&
                     ek[k] = 1.0;
                     Vec3d numerator1 = cross(dgamma_by_dphi_j, ek) * norm_diff;
                     Vec3d numerator2 = three_dgamma_by_dphi_cross_diff_by_norm_diff * diff[k];
-                    Vec3d temp = (numerator1-numerator2) * norm_diff_4_inv;
-                    dB_by_dX(i, k, 0) += temp[0];
-                    dB_by_dX(i, k, 1) += temp[1];
-                    dB_by_dX(i, k, 2) += temp[2];
+                    dB_dX_p[k] += (numerator1-numerator2) * norm_diff_4_inv;
                 }
                 MYIF(derivs > 1) {
                     double norm_diff_5_inv = norm_diff_4_inv/norm_diff;
@@ -159,39 +162,52 @@ void biot_savart_kernel(vector_type& pointsx, vector_type& pointsy, vector_type&
                             if(k1 == k2) {
                                 term4 = -3 * norm_diff_5_inv * dgamma_by_dphi_j_cross_diff;
                             }
-                            Vec3d temp = (term1 + term2 + term3 + term4);
-                            d2B_by_dXdX(i, k1, k2, 0) += temp[0];
-                            d2B_by_dXdX(i, k1, k2, 1) += temp[1];
-                            d2B_by_dXdX(i, k1, k2, 2) += temp[2];
+                            d2B_dXdX_p[3*k1 + k2] += (term1 + term2 + term3 + term4);
                         }
                     }
                 }
             }
         }
+        for(int d=0; d<3; d++) {
+            B(i, d) += fak * B_p[d];
+            MYIF(derivs > 0) {
+                for(int k=0; k<3; k++)
+                    dB_by_dX(i, k, d) += fak * dB_dX_p[k][d];
+            }
+            MYIF(derivs > 1) {
+                for(int k1=0; k1<3; k1++)
+                    for(int k2=0; k2<3; k2++)
+                        d2B_by_dXdX(i, k1, k2, d) += fak * d2B_dXdX_p[3*k1 + k2][d];
+            }
+        }
     }
-    double fak = (1e-7/num_quad_points);
-    B *= fak;
-    MYIF(derivs > 0)
-        dB_by_dX *= fak;
-    MYIF(derivs > 1)
-        d2B_by_dXdX *= fak;
 }
 
-template void biot_savart_kernel<xt::xarray<double>, 0>(vector_type&, vector_type&, vector_type&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&);
-template void biot_savart_kernel<xt::xarray<double>, 1>(vector_type&, vector_type&, vector_type&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&);
-template void biot_savart_kernel<xt::xarray<double>, 2>(vector_type&, vector_type&, vector_type&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&);
+template void biot_savart_kernel<xt::xarray<double>, 0>(vector_type&, vector_type&, vector_type&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, int, int, double);
+template void biot_savart_kernel<xt::xarray<double>, 1>(vector_type&, vector_type&, vector_type&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, int, int, double);
+template void biot_savart_kernel<xt::xarray<double>, 2>(vector_type&, vector_type&, vector_type&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, int, int, double);
 
 
-void biot_savart(Array& points, vector<Array>& gammas, vector<Array>& dgamma_by_dphis, vector<Array>& B, vector<Array>& dB_by_dX, vector<Array>& d2B_by_dXdX) {
-    auto pointsx = vector_type(points.shape(0), 0);
-    auto pointsy = vector_type(points.shape(0), 0);
-    auto pointsz = vector_type(points.shape(0), 0);
+// The points are processed in blocks of this size, and each thread
+// evaluates the field of all coils on its blocks. The block size has to be a
+// multiple of the SIMD width.
+constexpr int BIOT_SAVART_BLOCK_SIZE = 128;
+
+static void split_points(Array& points, vector_type& pointsx, vector_type& pointsy, vector_type& pointsz) {
     int num_points = points.shape(0);
     for (int i = 0; i < num_points; ++i) {
         pointsx[i] = points(i, 0);
         pointsy[i] = points(i, 1);
         pointsz[i] = points(i, 2);
     }
+}
+
+void biot_savart(Array& points, vector<Array>& gammas, vector<Array>& dgamma_by_dphis, vector<Array>& B, vector<Array>& dB_by_dX, vector<Array>& d2B_by_dXdX) {
+    auto pointsx = vector_type(points.shape(0), 0);
+    auto pointsy = vector_type(points.shape(0), 0);
+    auto pointsz = vector_type(points.shape(0), 0);
+    split_points(points, pointsx, pointsy, pointsz);
+    int num_points = points.shape(0);
     int num_coils  = gammas.size();
 
     Array dummyjac = xt::zeros<double>({1, 1, 1});
@@ -204,32 +220,256 @@ void biot_savart(Array& points, vector<Array>& gammas, vector<Array>& dgamma_by_
             nderivs = 2;
         }
     }
+    for(int i=0; i<num_coils; i++) {
+        std::fill(B[i].begin(), B[i].end(), 0.);
+        if(nderivs > 0)
+            std::fill(dB_by_dX[i].begin(), dB_by_dX[i].end(), 0.);
+        if(nderivs > 1)
+            std::fill(d2B_by_dXdX[i].begin(), d2B_by_dXdX[i].end(), 0.);
+    }
 
+    // Parallelizing over the coils leaves most threads idle when there are
+    // only a few coils, so instead parallelize over blocks of points.
+    int num_blocks = (num_points + BIOT_SAVART_BLOCK_SIZE - 1)/BIOT_SAVART_BLOCK_SIZE;
 #pragma omp parallel for
-    for(int i=0; i<num_coils; i++) {
-        if(nderivs == 2)
-            biot_savart_kernel<Array, 2>(pointsx, pointsy, pointsz, gammas[i], dgamma_by_dphis[i], B[i], dB_by_dX[i], d2B_by_dXdX[i]);
-        else {
-            if(nderivs == 1) 
-                biot_savart_kernel<Array, 1>(pointsx, pointsy, pointsz, gammas[i], dgamma_by_dphis[i], B[i], dB_by_dX[i], dummyhess);
+    for(int b=0; b<num_blocks; b++) {
+        int start = b*BIOT_SAVART_BLOCK_SIZE;
+        int end = std::min(start + BIOT_SAVART_BLOCK_SIZE, num_points);
+        for(int i=0; i<num_coils; i++) {
+            if(nderivs == 2)
+                biot_savart_kernel<Array, 2>(pointsx, pointsy, pointsz, gammas[i], dgamma_by_dphis[i], B[i], dB_by_dX[i], d2B_by_dXdX[i], start, end, 1.);
+            else if(nderivs == 1)
+                biot_savart_kernel<Array, 1>(pointsx, pointsy, pointsz, gammas[i], dgamma_by_dphis[i], B[i], dB_by_dX[i], dummyhess, start, end, 1.);
             else
-                biot_savart_kernel<Array, 0>(pointsx, pointsy, pointsz, gammas[i], dgamma_by_dphis[i], B[i], dummyjac, dummyhess);
+                biot_savart_kernel<Array, 0>(pointsx, pointsy, pointsz, gammas[i], dgamma_by_dphis[i], B[i], dummyjac, dummyhess, start, end, 1.);
         }
     }
 }
 
-Array biot_savart_B(Array& points, vector<Array>& gammas, vector<Array>& dgamma_by_dphis, vector<double>& currents){
-    auto dB_by_dXs = vector<Array>();
-    auto d2B_by_dXdXs = vector<Array>();
-    int num_coils = currents.size();
-    auto Bs = vector<Array>(num_coils, Array());
-    for (int i = 0; i < num_coils; ++i) {
-        Bs[i] = xt::zeros<double>({points.shape(0), points.shape(1)});
+void biot_savart_fused(Array& points, vector<Array>& gammas, vector<Array>& dgamma_by_dphis, vector<double>& currents, Array& B, Array& dB_by_dX, Array& d2B_by_dXdX) {
+    auto pointsx = vector_type(points.shape(0), 0);
+    auto pointsy = vector_type(points.shape(0), 0);
+    auto pointsz = vector_type(points.shape(0), 0);
+    split_points(points, pointsx, pointsy, pointsz);
+    int num_points = points.shape(0);
+    int num_coils  = gammas.size();
+
+    // The derivatives are computed if arrays with one row per point are
+    // passed for them.
+    int nderivs = 0;
+    if(dB_by_dX.dimension() == 3 && dB_by_dX.shape(0) == num_points) {
+        nderivs = 1;
+        if(d2B_by_dXdX.dimension() == 4 && d2B_by_dXdX.shape(0) == num_points) {
+            nderivs = 2;
+        }
     }
-    biot_savart(points, gammas, dgamma_by_dphis, Bs, dB_by_dXs, d2B_by_dXdXs);
-    Array B = xt::zeros<double>({points.shape(0), points.shape(1)});
-    for (int i = 0; i < num_coils; ++i) {
-        B += currents[i] * Bs[i];
+    std::fill(B.begin(), B.end(), 0.);
+    if(nderivs > 0)
+        std::fill(dB_by_dX.begin(), dB_by_dX.end(), 0.);
+    if(nderivs > 1)
+        std::fill(d2B_by_dXdX.begin(), d2B_by_dXdX.end(), 0.);
+
+    int num_blocks = (num_points + BIOT_SAVART_BLOCK_SIZE - 1)/BIOT_SAVART_BLOCK_SIZE;
+#pragma omp parallel for
+    for(int b=0; b<num_blocks; b++) {
+        int start = b*BIOT_SAVART_BLOCK_SIZE;
+        int end = std::min(start + BIOT_SAVART_BLOCK_SIZE, num_points);
+        for(int i=0; i<num_coils; i++) {
+            if(nderivs == 2)
+                biot_savart_kernel<Array, 2>(pointsx, pointsy, pointsz, gammas[i], dgamma_by_dphis[i], B, dB_by_dX, d2B_by_dXdX, start, end, currents[i]);
+            else if(nderivs == 1)
+                biot_savart_kernel<Array, 1>(pointsx, pointsy, pointsz, gammas[i], dgamma_by_dphis[i], B, dB_by_dX, d2B_by_dXdX, start, end, currents[i]);
+            else
+                biot_savart_kernel<Array, 0>(pointsx, pointsy, pointsz, gammas[i], dgamma_by_dphis[i], B, dB_by_dX, d2B_by_dXdX, start, end, currents[i]);
+        }
     }
+}
+
+Array biot_savart_B(Array& points, vector<Array>& gammas, vector<Array>& dgamma_by_dphis, vector<double>& currents){
+    Array B = xt::zeros<double>({points.shape(0), points.shape(1)});
+    Array dummyjac = xt::zeros<double>({1, 1, 1});
+    Array dummyhess = xt::zeros<double>({1, 1, 1, 1});
+    biot_savart_fused(points, gammas, dgamma_by_dphis, currents, B, dummyjac, dummyhess);
     return B;
 }
+
+// Adds scale times the vector potential of one coil (and its derivatives) to
+// A at the points with indices start <= i < end, with the same conventions
+// as biot_savart_kernel.
+template<class T, int derivs>
+void biot_savart_A_kernel(vector_type& pointsx, vector_type& pointsy, vector_type& pointsz, T& gamma, T& dgamma_by_dphi, T& A, T& dA_by_dX, T& d2A_by_dXdX, int start, int end, double scale) {
+    int num_quad_points    = gamma.shape(0);
+    constexpr int simd_size = xsimd::simd_type<double>::size;
+    int simd_end = end - (end - start) % simd_size;
+    double fak = scale * 1e-7/num_quad_points;
+    for(int i = start; i < simd_end; i += simd_size) {
+        auto point_i = Vec3dSimd(&(pointsx[i]), &(pointsy[i]), &(pointsz[i]));
+        auto A_i = Vec3dSimd();
+        Vec3dSimd dA_dX_i[3];
+        Vec3dSimd d2A_dXdX_i[9];
+        for (int j = 0; j < num_quad_points; ++j) {
+            auto gamma_j = Vec3d{ gamma(j, 0), gamma(j, 1), gamma(j, 2)};
+            auto dgamma_by_dphi_j_simd = Vec3dSimd(dgamma_by_dphi(j, 0), dgamma_by_dphi(j, 1), dgamma_by_dphi(j, 2));
+            auto diff = point_i - gamma_j;
+            auto norm_diff_2 = normsq(diff);
+            auto norm_diff_inv = 1./sqrt(norm_diff_2);
+
+            A_i += dgamma_by_dphi_j_simd * norm_diff_inv;
+            MYIF(derivs > 0) {
+                auto norm_diff_3_inv = norm_diff_inv/norm_diff_2;
+                for(int k=0; k<3; k++)
+                    dA_dX_i[k] -= dgamma_by_dphi_j_simd * (diff[k] * norm_diff_3_inv);
+                MYIF(derivs > 1) {
+                    auto norm_diff_5_inv = norm_diff_3_inv/norm_diff_2;
+                    for(int k1=0; k1<3; k1++) {
+                        for(int k2=0; k2<=k1; k2++) {
+                            auto term = 3. * (diff[k1] * diff[k2] * norm_diff_5_inv);
+                            if(k1 == k2)
+                                term -= norm_diff_3_inv;
+                            d2A_dXdX_i[3*k1 + k2] += dgamma_by_dphi_j_simd * term;
+                        }
+                    }
+                }
+            }
+        }
+
+        for(int j=0; j<simd_size; j++){
+            for(int d=0; d<3; d++) {
+                A(i+j, d) += fak * A_i[d][j];
+                MYIF(derivs > 0) {
+                    for(int k=0; k<3; k++)
+                        dA_by_dX(i+j, k, d) += fak * dA_dX_i[k][d][j];
+                }
+                MYIF(derivs > 1) {
+                    for(int k1=0; k1<3; k1++) {
+                        for(int k2=0; k2<=k1; k2++) {
+                            d2A_by_dXdX(i+j, k1, k2, d) += fak * d2A_dXdX_i[3*k1 + k2][d][j];
+                            if(k2 < k1)
+                                d2A_by_dXdX(i+j, k2, k1, d) += fak * d2A_dXdX_i[3*k1 + k2][d][j];
+                        }
+                    }
+                }
+            }
+        }
+    }
+    for (int i = simd_end; i < end; ++i) {
+        auto point = Vec3d{pointsx[i], pointsy[i], pointsz[i]};
+        Vec3d A_p = Vec3d::Zero();
+        Vec3d dA_dX_p[3];
+        Vec3d d2A_dXdX_p[9];
+        for(int k=0; k<3; k++)
+            dA_dX_p[k].setZero();
+        for(int k=0; k<9; k++)
+            d2A_dXdX_p[k].setZero();
+        for (int j = 0; j < num_quad_points; ++j) {
+            Vec3d gamma_j = Vec3d { gamma(j, 0), gamma(j, 1), gamma(j, 2)};
+            Vec3d dgamma_by_dphi_j = Vec3d { dgamma_by_dphi(j, 0), dgamma_by_dphi(j, 1), dgamma_by_dphi(j, 2)};
+            Vec3d diff = point - gamma_j;
+            double norm_diff = norm(diff);
+            double norm_diff_inv = 1./norm_diff;
+            A_p += dgamma_by_dphi_j * norm_diff_inv;
+            MYIF(derivs > 0) {
+                double norm_diff_3_inv = norm_diff_inv/(norm_diff*norm_diff);
+                for(int k=0; k<3; k++)
+                    dA_dX_p[k] -= dgamma_by_dphi_j * (diff[k] * norm_diff_3_inv);
+                MYIF(derivs > 1) {
+                    double norm_diff_5_inv = norm_diff_3_inv/(norm_diff*norm_diff);
+                    for(int k1=0; k1<3; k1++) {
+                        for(int k2=0; k2<3; k2++) {
+                            double term = 3. * diff[k1] * diff[k2] * norm_diff_5_inv;
+                            if(k1 == k2)
+                                term -= norm_diff_3_inv;
+                            d2A_dXdX_p[3*k1 + k2] += dgamma_by_dphi_j * term;
+                        }
+                    }
+                }
+            }
+        }
+        for(int d=0; d<3; d++) {
+            A(i, d) += fak * A_p[d];
+            MYIF(derivs > 0) {
+                for(int k=0; k<3; k++)
+                    dA_by_dX(i, k, d) += fak * dA_dX_p[k][d];
+            }
+            MYIF(derivs > 1) {
+                for(int k1=0; k1<3; k1++)
+                    for(int k2=0; k2<3; k2++)
+                        d2A_by_dXdX(i, k1, k2, d) += fak * d2A_dXdX_p[3*k1 + k2][d];
+            }
+        }
+    }
+}
+
+void biot_savart_A(Array& points, vector<Array>& gammas, vector<Array>& dgamma_by_dphis, vector<double>& currents, Array& A, Array& dA_by_dX, Array& d2A_by_dXdX) {
+    auto pointsx = vector_type(points.shape(0), 0);
+    auto pointsy = vector_type(points.shape(0), 0);
+    auto pointsz = vector_type(points.shape(0), 0);
+    split_points(points, pointsx, pointsy, pointsz);
+    int num_points = points.shape(0);
+    int num_coils  = gammas.size();
+
+    int nderivs = 0;
+    if(dA_by_dX.dimension() == 3 && dA_by_dX.shape(0) == num_points) {
+        nderivs = 1;
+        if(d2A_by_dXdX.dimension() == 4 && d2A_by_dXdX.shape(0) == num_points) {
+            nderivs = 2;
+        }
+    }
+    std::fill(A.begin(), A.end(), 0.);
+    if(nderivs > 0)
+        std::fill(dA_by_dX.begin(), dA_by_dX.end(), 0.);
+    if(nderivs > 1)
+        std::fill(d2A_by_dXdX.begin(), d2A_by_dXdX.end(), 0.);
+
+    int num_blocks = (num_points + BIOT_SAVART_BLOCK_SIZE - 1)/BIOT_SAVART_BLOCK_SIZE;
+#pragma omp parallel for
+    for(int b=0; b<num_blocks; b++) {
+        int start = b*BIOT_SAVART_BLOCK_SIZE;
+        int end = std::min(start + BIOT_SAVART_BLOCK_SIZE, num_points);
+        for(int i=0; i<num_coils; i++) {
+            if(nderivs == 2)
+                biot_savart_A_kernel<Array, 2>(pointsx, pointsy, pointsz, gammas[i], dgamma_by_dphis[i], A, dA_by_dX, d2A_by_dXdX, start, end, currents[i]);
+            else if(nderivs == 1)
+                biot_savart_A_kernel<Array, 1>(pointsx, pointsy, pointsz, gammas[i], dgamma_by_dphis[i], A, dA_by_dX, d2A_by_dXdX, start, end, currents[i]);
+            else
+                biot_savart_A_kernel<Array, 0>(pointsx, pointsy, pointsz, gammas[i], dgamma_by_dphis[i], A, dA_by_dX, d2A_by_dXdX, start, end, currents[i]);
+        }
+    }
+}
+
+void biot_savart_tree(Array& points, vector<Array>& gammas, vector<Array>& dgamma_by_dphis, vector<double>& currents, Array& B, Array& dB_by_dX, double tol) {
+    int num_points = points.shape(0);
+    int num_coils  = gammas.size();
+    auto positions = vector<Vec3d>();
+    auto weights = vector<Vec3d>();
+    for(int i=0; i<num_coils; i++) {
+        int num_quad_points = gammas[i].shape(0);
+        double fak = currents[i] * 1e-7/num_quad_points;
+        for (int j = 0; j < num_quad_points; ++j) {
+            positions.push_back(Vec3d{gammas[i](j, 0), gammas[i](j, 1), gammas[i](j, 2)});
+            weights.push_back(fak * Vec3d{dgamma_by_dphis[i](j, 0), dgamma_by_dphis[i](j, 1), dgamma_by_dphis[i](j, 2)});
+        }
+    }
+    BiotSavartTree tree(positions, weights, tol);
+
+    bool derivs = dB_by_dX.dimension() == 3 && dB_by_dX.shape(0) == num_points;
+    // The number of clusters that are opened varies between points, so
+    // distribute the points dynamically.
+#pragma omp parallel for schedule(dynamic, 256)
+    for (int i = 0; i < num_points; ++i) {
+        Vec3d x = Vec3d{points(i, 0), points(i, 1), points(i, 2)};
+        Vec3d B_i;
+        Eigen::Matrix3d dB_i;
+        if(derivs)
+            tree.evaluate<1>(x, B_i, dB_i);
+        else
+            tree.evaluate<0>(x, B_i, dB_i);
+        for(int d=0; d<3; d++) {
+            B(i, d) = B_i[d];
+            if(derivs) {
+                for(int k=0; k<3; k++)
+                    dB_by_dX(i, k, d) = dB_i(k, d);
+            }
+        }
+    }
+}
@@ -148,7 +148,128 @@ void biot_savart_vjp_kernel(vector_type& pointsx, vector_type& pointsy, vector_t
 template void biot_savart_vjp_kernel<xt::xarray<double>, 0>(vector_type&, vector_type&, vector_type&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&);
 template void biot_savart_vjp_kernel<xt::xarray<double>, 1>(vector_type&, vector_type&, vector_type&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&);
 
-void biot_savart_vjp(Array& points, vector<Array>& gammas, vector<Array>& dgamma_by_dphis, vector<double>& currents, Array& v, Array& vgrad, vector<Array>& dgamma_by_dcoeffs, vector<Array>& d2gamma_by_dphidcoeffs, vector<Array>& res_B, vector<Array>& res_dB){
+// The vector-Jacobian product for the vector potential A, with the same
+// conventions as biot_savart_vjp_kernel. Here vgrad pairs with dA_by_dX, so
+// the vector-Jacobian product for the derivative is computed from
+// \sum_{k,l} vgrad(i, k, l) dA_l/dx_k.
+template<class T, int derivs>
+void biot_savart_vjp_A_kernel(vector_type& pointsx, vector_type& pointsy, vector_type& pointsz, T& gamma, T& dgamma_by_dphi, T& v, T& res_gamma, T& res_dgamma_by_dphi, T& vgrad, T& res_grad_gamma, T& res_grad_dgamma_by_dphi) {
+    int num_points         = pointsx.size();
+    int num_quad_points    = gamma.shape(0);
+    constexpr int simd_size = xsimd::simd_type<double>::size;
+    for(int i = 0; i < num_points-num_points%simd_size; i += simd_size) {
+        Vec3dSimd point_i = Vec3dSimd(&(pointsx[i]), &(pointsy[i]), &(pointsz[i]));
+        auto v_i   = Vec3dSimd();
+        auto vgrad_i = vector<Vec3dSimd, xs::aligned_allocator<Vec3dSimd, XSIMD_DEFAULT_ALIGNMENT>>{
+                Vec3dSimd(), Vec3dSimd(), Vec3dSimd()
+            };
+        for(int k=0; k<simd_size; k++){
+            for (int d = 0; d < 3; ++d) {
+                v_i[d][k] = v(i+k, d);
+                MYIF(derivs>0) {
+                    for (int dd = 0; dd < 3; ++dd) {
+                        vgrad_i[dd][d][k] = vgrad(i+k, dd, d);
+                    }
+                }
+            }
+        }
+        for (int j = 0; j < num_quad_points; ++j) {
+            auto gamma_j = Vec3d{ gamma(j, 0), gamma(j, 1), gamma(j, 2)};
+            auto dgamma_j_by_dphi = Vec3d{ dgamma_by_dphi(j, 0), dgamma_by_dphi(j, 1), dgamma_by_dphi(j, 2)};
+            auto diff = point_i - gamma_j;
+            auto norm_diff_2 = normsq(diff);
+            auto norm_diff_inv = 1./sqrt(norm_diff_2);
+            auto norm_diff_3_inv = norm_diff_inv/norm_diff_2;
+
+            auto res_dgamma_by_dphi_add = v_i * norm_diff_inv;
+            res_dgamma_by_dphi(j, 0) += xsimd::hadd(res_dgamma_by_dphi_add.x);
+            res_dgamma_by_dphi(j, 1) += xsimd::hadd(res_dgamma_by_dphi_add.y);
+            res_dgamma_by_dphi(j, 2) += xsimd::hadd(res_dgamma_by_dphi_add.z);
+
+            auto res_gamma_add = diff * (inner(v_i, dgamma_j_by_dphi) * norm_diff_3_inv);
+            res_gamma(j, 0) += xsimd::hadd(res_gamma_add.x);
+            res_gamma(j, 1) += xsimd::hadd(res_gamma_add.y);
+            res_gamma(j, 2) += xsimd::hadd(res_gamma_add.z);
+
+            MYIF(derivs>0) {
+                auto norm_diff_5_inv = norm_diff_3_inv/norm_diff_2;
+                auto vgrad_dgamma = Vec3dSimd(inner(vgrad_i[0], dgamma_j_by_dphi), inner(vgrad_i[1], dgamma_j_by_dphi), inner(vgrad_i[2], dgamma_j_by_dphi));
+                auto res_grad_dgamma_by_dphi_add = Vec3dSimd();
+                for(int k=0; k<3; k++)
+                    res_grad_dgamma_by_dphi_add -= vgrad_i[k] * (diff[k] * norm_diff_3_inv);
+                auto res_grad_gamma_add = vgrad_dgamma * norm_diff_3_inv;
+                res_grad_gamma_add -= diff * (3. * inner(diff, vgrad_dgamma) * norm_diff_5_inv);
+
+                res_grad_dgamma_by_dphi(j, 0) += xsimd::hadd(res_grad_dgamma_by_dphi_add.x);
+                res_grad_dgamma_by_dphi(j, 1) += xsimd::hadd(res_grad_dgamma_by_dphi_add.y);
+                res_grad_dgamma_by_dphi(j, 2) += xsimd::hadd(res_grad_dgamma_by_dphi_add.z);
+                res_grad_gamma(j, 0) += xsimd::hadd(res_grad_gamma_add.x);
+                res_grad_gamma(j, 1) += xsimd::hadd(res_grad_gamma_add.y);
+                res_grad_gamma(j, 2) += xsimd::hadd(res_grad_gamma_add.z);
+            }
+        }
+    }
+    for (int i = num_points - num_points % simd_size; i < num_points; ++i) {
+        auto point_i = Vec3d{pointsx[i], pointsy[i], pointsz[i]};
+        Vec3d v_i   = Vec3d::Zero();
+        auto vgrad_i = vector<Vec3d>{
+            Vec3d::Zero(), Vec3d::Zero(), Vec3d::Zero()
+            };
+        for (int d = 0; d < 3; ++d) {
+            v_i[d] = v(i, d);
+            MYIF(derivs>0) {
+                for (int dd = 0; dd < 3; ++dd) {
+                    vgrad_i[dd][d] = vgrad(i, dd, d);
+                }
+            }
+        }
+        for (int j = 0; j < num_quad_points; ++j) {
+            Vec3d gamma_j = Vec3d{ gamma(j, 0), gamma(j, 1), gamma(j, 2) };
+            Vec3d dgamma_j_by_dphi = Vec3d{ dgamma_by_dphi(j, 0), dgamma_by_dphi(j, 1), dgamma_by_dphi(j, 2) };
+            Vec3d diff = point_i - gamma_j;
+            double norm_diff = norm(diff);
+            double norm_diff_inv = 1./norm_diff;
+            double norm_diff_3_inv = norm_diff_inv/(norm_diff*norm_diff);
+
+            Vec3d res_dgamma_by_dphi_add = v_i * norm_diff_inv;
+            res_dgamma_by_dphi(j, 0) += res_dgamma_by_dphi_add[0];
+            res_dgamma_by_dphi(j, 1) += res_dgamma_by_dphi_add[1];
+            res_dgamma_by_dphi(j, 2) += res_dgamma_by_dphi_add[2];
+
+            Vec3d res_gamma_add = diff * (inner(v_i, dgamma_j_by_dphi) * norm_diff_3_inv);
+            res_gamma(j, 0) += res_gamma_add[0];
+            res_gamma(j, 1) += res_gamma_add[1];
+            res_gamma(j, 2) += res_gamma_add[2];
+
+            MYIF(derivs>0) {
+                double norm_diff_5_inv = norm_diff_3_inv/(norm_diff*norm_diff);
+                Vec3d vgrad_dgamma = Vec3d{inner(vgrad_i[0], dgamma_j_by_dphi), inner(vgrad_i[1], dgamma_j_by_dphi), inner(vgrad_i[2], dgamma_j_by_dphi)};
+                Vec3d res_grad_dgamma_by_dphi_add = Vec3d::Zero();
+                for(int k=0; k<3; k++)
+                    res_grad_dgamma_by_dphi_add -= vgrad_i[k] * (diff[k] * norm_diff_3_inv);
+                Vec3d res_grad_gamma_add = vgrad_dgamma * norm_diff_3_inv;
+                res_grad_gamma_add -= diff * (3. * inner(diff, vgrad_dgamma) * norm_diff_5_inv);
+
+                res_grad_dgamma_by_dphi(j, 0) += res_grad_dgamma_by_dphi_add[0];
+                res_grad_dgamma_by_dphi(j, 1) += res_grad_dgamma_by_dphi_add[1];
+                res_grad_dgamma_by_dphi(j, 2) += res_grad_dgamma_by_dphi_add[2];
+                res_grad_gamma(j, 0) += res_grad_gamma_add[0];
+                res_grad_gamma(j, 1) += res_grad_gamma_add[1];
+                res_grad_gamma(j, 2) += res_grad_gamma_add[2];
+            }
+        }
+    }
+}
+
+template void biot_savart_vjp_A_kernel<xt::xarray<double>, 0>(vector_type&, vector_type&, vector_type&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&);
+template void biot_savart_vjp_A_kernel<xt::xarray<double>, 1>(vector_type&, vector_type&, vector_type&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&, xt::xarray<double>&);
+
+typedef void (*VjpKernel)(vector_type&, vector_type&, vector_type&, Array&, Array&, Array&, Array&, Array&, Array&, Array&, Array&);
+
+// Evaluates the vjp kernel for each coil and contracts the results with the
+// derivatives of the coil with respect to its coefficients. kernel0 computes
+// only the vjp for the field, and kernel1 also the one for its gradient.
+static void biot_savart_vjp_impl(VjpKernel kernel0, VjpKernel kernel1, Array& points, vector<Array>& gammas, vector<Array>& dgamma_by_dphis, vector<double>& currents, Array& v, Array& vgrad, vector<Array>& dgamma_by_dcoeffs, vector<Array>& d2gamma_by_dphidcoeffs, vector<Array>& res_B, vector<Array>& res_dB){
     auto pointsx = vector_type(points.shape(0), 0);
     auto pointsy = vector_type(points.shape(0), 0);
     auto pointsz = vector_type(points.shape(0), 0);
@@ -181,11 +302,11 @@ void biot_savart_vjp(Array& points, vector<Array>& gammas, vector<Array>& dgamma
     #pragma omp parallel for
     for(int i=0; i<num_coils; i++) {
         if(compute_dB)
-            biot_savart_vjp_kernel<Array, 1>(pointsx, pointsy, pointsz, gammas[i], dgamma_by_dphis[i],
+            kernel1(pointsx, pointsy, pointsz, gammas[i], dgamma_by_dphis[i],
                     v, res_gamma[i], res_dgamma_by_dphi[i],
                     vgrad, res_grad_gamma[i], res_grad_dgamma_by_dphi[i]);
         else
-            biot_savart_vjp_kernel<Array, 0>(pointsx, pointsy, pointsz, gammas[i], dgamma_by_dphis[i],
+            kernel0(pointsx, pointsy, pointsz, gammas[i], dgamma_by_dphis[i],
                     v, res_gamma[i], res_dgamma_by_dphi[i], dummy, dummy, dummy);
         int numcoeff = dgamma_by_dcoeffs[i].shape(2);
         for (int j = 0; j < dgamma_by_dcoeffs[i].shape(0); ++j) {
@@ -209,3 +330,13 @@ void biot_savart_vjp(Array& points, vector<Array>& gammas, vector<Array>& dgamma
             res_dB[i] *= fak;
     }
 }
+
+void biot_savart_vjp(Array& points, vector<Array>& gammas, vector<Array>& dgamma_by_dphis, vector<double>& currents, Array& v, Array& vgrad, vector<Array>& dgamma_by_dcoeffs, vector<Array>& d2gamma_by_dphidcoeffs, vector<Array>& res_B, vector<Array>& res_dB){
+    biot_savart_vjp_impl(&biot_savart_vjp_kernel<Array, 0>, &biot_savart_vjp_kernel<Array, 1>,
+            points, gammas, dgamma_by_dphis, currents, v, vgrad, dgamma_by_dcoeffs, d2gamma_by_dphidcoeffs, res_B, res_dB);
+}
+
+void biot_savart_vjp_A(Array& points, vector<Array>& gammas, vector<Array>& dgamma_by_dphis, vector<double>& currents, Array& v, Array& vgrad, vector<Array>& dgamma_by_dcoeffs, vector<Array>& d2gamma_by_dphidcoeffs, vector<Array>& res_A, vector<Array>& res_dA){
+    biot_savart_vjp_impl(&biot_savart_vjp_A_kernel<Array, 0>, &biot_savart_vjp_A_kernel<Array, 1>,
+            points, gammas, dgamma_by_dphis, currents, v, vgrad, dgamma_by_dcoeffs, d2gamma_by_dphidcoeffs, res_A, res_dA);
+}
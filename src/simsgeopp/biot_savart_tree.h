@@ -0,0 +1,223 @@
+#pragma once
+
+// A treecode (Barnes-Hut) evaluation of the Biot-Savart law. The quadrature
+// points of all coils are sorted into a binary tree. For a target point x,
+// the field of a cluster of sources that is far away compared to its size is
+// approximated by a Taylor expansion of the kernel about the center of the
+// cluster, up to quadrupole order. Clusters that are too close are opened,
+// and leaves are summed directly. The cost per target point is then
+// O(log N_sources) instead of O(N_sources).
+//
+// Writing w_s = I dl_s for the current element at the source y_s, and
+// G(R) = R/|R|^3, the field is B(x) = \sum_s w_s x G(x - y_s). For a cluster
+// with center c, with R = x - c and d_s = y_s - c,
+//
+//   B(x) = M0 x G(R) - \sum_k M1_k x d_k G(R) + 1/2 \sum_{k,l} M2_kl x d_k d_l G(R) + ...
+//
+// where M0 = \sum_s w_s, M1_k = \sum_s w_s d_{s,k}, M2_kl = \sum_s w_s d_{s,k} d_{s,l}.
+// The relative error of the truncation is of order (rho/|R|)^3, with rho
+// the radius of the cluster, so a cluster is approximated if
+// rho < theta |R| with theta = tol^(1/3).
+
+#include <Eigen/Dense>
+#include <vector>
+#include <cmath>
+#include <algorithm>
+#include <numeric>
+
+class BiotSavartTree {
+    public:
+        // positions and weights have one entry per source, and weights
+        // already include the current, the factor mu_0/(4 pi) and the
+        // quadrature weight.
+        BiotSavartTree(const std::vector<Eigen::Vector3d>& positions, const std::vector<Eigen::Vector3d>& weights, double tol, int leaf_size=32) : leaf_size(leaf_size) {
+            theta = std::min(std::cbrt(tol), 0.7);
+            int num_sources = positions.size();
+            order = std::vector<int>(num_sources);
+            std::iota(order.begin(), order.end(), 0);
+            this->positions = positions;
+            this->weights = weights;
+            if(num_sources > 0)
+                build(0, num_sources);
+            // Store the sources in tree order, so that each node refers to a
+            // contiguous range.
+            for (int s = 0; s < num_sources; ++s) {
+                this->positions[s] = positions[order[s]];
+                this->weights[s] = weights[order[s]];
+            }
+        }
+
+        // Computes B at x, and if derivs > 0 also dB(k, d) = dB_d/dx_k.
+        template<int derivs>
+        void evaluate(const Eigen::Vector3d& x, Eigen::Vector3d& B, Eigen::Matrix3d& dB) const {
+            B.setZero();
+            dB.setZero();
+            if(nodes.size() == 0)
+                return;
+            int stack[128];
+            int num_stack = 0;
+            stack[num_stack++] = 0;
+            double theta2 = theta*theta;
+            while(num_stack > 0) {
+                const Node& node = nodes[stack[--num_stack]];
+                Eigen::Vector3d R = x - node.center;
+                double r2 = R.squaredNorm();
+                if(node.radius*node.radius < theta2*r2) {
+                    far_field<derivs>(node, R, r2, B, dB);
+                } else if(node.children[0] < 0) {
+                    for (int s = node.begin; s < node.end; ++s)
+                        direct<derivs>(s, x, B, dB);
+                } else {
+                    stack[num_stack++] = node.children[0];
+                    stack[num_stack++] = node.children[1];
+                }
+            }
+        }
+
+        int num_nodes() const {
+            return nodes.size();
+        }
+
+    private:
+        struct Node {
+            Eigen::Vector3d center;
+            double radius;
+            int begin, end;
+            int children[2];
+            Eigen::Vector3d M0;
+            Eigen::Vector3d M1[3];
+            // The symmetric second moments, for (k, l) in
+            // (0, 0), (1, 1), (2, 2), (0, 1), (0, 2), (1, 2).
+            Eigen::Vector3d M2[6];
+        };
+
+        int leaf_size;
+        double theta;
+        std::vector<int> order;
+        std::vector<Eigen::Vector3d> positions;
+        std::vector<Eigen::Vector3d> weights;
+        std::vector<Node> nodes;
+
+        int build(int begin, int end) {
+            Node node;
+            node.begin = begin;
+            node.end = end;
+            node.children[0] = -1;
+            node.children[1] = -1;
+            node.center.setZero();
+            for (int s = begin; s < end; ++s)
+                node.center += positions[order[s]];
+            node.center /= (end - begin);
+            node.radius = 0;
+            node.M0.setZero();
+            for (int k = 0; k < 3; ++k)
+                node.M1[k].setZero();
+            for (int k = 0; k < 6; ++k)
+                node.M2[k].setZero();
+            Eigen::Vector3d lower = positions[order[begin]];
+            Eigen::Vector3d upper = positions[order[begin]];
+            for (int s = begin; s < end; ++s) {
+                const Eigen::Vector3d& w = weights[order[s]];
+                Eigen::Vector3d d = positions[order[s]] - node.center;
+                node.radius = std::max(node.radius, d.norm());
+                lower = lower.cwiseMin(positions[order[s]]);
+                upper = upper.cwiseMax(positions[order[s]]);
+                node.M0 += w;
+                for (int k = 0; k < 3; ++k)
+                    node.M1[k] += w * d[k];
+                node.M2[0] += w * (d[0]*d[0]);
+                node.M2[1] += w * (d[1]*d[1]);
+                node.M2[2] += w * (d[2]*d[2]);
+                node.M2[3] += w * (d[0]*d[1]);
+                node.M2[4] += w * (d[0]*d[2]);
+                node.M2[5] += w * (d[1]*d[2]);
+            }
+            int index = nodes.size();
+            nodes.push_back(node);
+
+            int axis;
+            double extent = (upper - lower).maxCoeff(&axis);
+            if(end - begin > leaf_size && extent > 0) {
+                // Split at the median along the longest side of the bounding
+                // box, which keeps the tree balanced.
+                int mid = (begin + end)/2;
+                std::nth_element(order.begin() + begin, order.begin() + mid, order.begin() + end,
+                        [this, axis](int a, int b) { return positions[a][axis] < positions[b][axis]; });
+                int left = build(begin, mid);
+                int right = build(mid, end);
+                nodes[index].children[0] = left;
+                nodes[index].children[1] = right;
+            }
+            return index;
+        }
+
+        template<int derivs>
+        void direct(int s, const Eigen::Vector3d& x, Eigen::Vector3d& B, Eigen::Matrix3d& dB) const {
+            const Eigen::Vector3d& w = weights[s];
+            Eigen::Vector3d diff = x - positions[s];
+            double r2 = diff.squaredNorm();
+            double r3inv = 1./(r2*std::sqrt(r2));
+            Eigen::Vector3d w_cross_diff = w.cross(diff);
+            B += w_cross_diff * r3inv;
+            if(derivs > 0) {
+                double r5inv = r3inv/r2;
+                for (int k = 0; k < 3; ++k) {
+                    Eigen::Vector3d ek = Eigen::Vector3d::Zero();
+                    ek[k] = 1.;
+                    dB.row(k) += (w.cross(ek) * r3inv - w_cross_diff * (3. * diff[k] * r5inv)).transpose();
+                }
+            }
+        }
+
+        template<int derivs>
+        void far_field(const Node& node, const Eigen::Vector3d& R, double r2, Eigen::Vector3d& B, Eigen::Matrix3d& dB) const {
+            static const int kl[6][2] = {{0, 0}, {1, 1}, {2, 2}, {0, 1}, {0, 2}, {1, 2}};
+            // 1/2 for the diagonal second moments, and 1 for the off-diagonal
+            // ones, which appear twice in the sum over k and l.
+            static const double kl_fak[6] = {0.5, 0.5, 0.5, 1., 1., 1.};
+            double r3inv = 1./(r2*std::sqrt(r2));
+            double r5inv = r3inv/r2;
+            double r7inv = r5inv/r2;
+
+            // d_k G
+            auto dG = [&](int k) {
+                Eigen::Vector3d v = R * (-3. * R[k] * r5inv);
+                v[k] += r3inv;
+                return v;
+            };
+            // d_k d_l G
+            auto ddG = [&](int k, int l) {
+                Eigen::Vector3d v = R * (15. * R[k] * R[l] * r7inv - (k == l ? 3. * r5inv : 0.));
+                v[k] -= 3. * R[l] * r5inv;
+                v[l] -= 3. * R[k] * r5inv;
+                return v;
+            };
+
+            B += node.M0.cross(R * r3inv);
+            for (int k = 0; k < 3; ++k)
+                B -= node.M1[k].cross(dG(k));
+            for (int j = 0; j < 6; ++j)
+                B += kl_fak[j] * node.M2[j].cross(ddG(kl[j][0], kl[j][1]));
+
+            if(derivs > 0) {
+                double r9inv = r7inv/r2;
+                // d_k d_l d_m G
+                auto dddG = [&](int k, int l, int m) {
+                    double diag = (k == l ? R[m] : 0.) + (k == m ? R[l] : 0.) + (l == m ? R[k] : 0.);
+                    Eigen::Vector3d v = R * (15. * diag * r7inv - 105. * R[k] * R[l] * R[m] * r9inv);
+                    v[k] += 15. * R[l] * R[m] * r7inv - (l == m ? 3. * r5inv : 0.);
+                    v[l] += 15. * R[k] * R[m] * r7inv - (k == m ? 3. * r5inv : 0.);
+                    v[m] += 15. * R[k] * R[l] * r7inv - (k == l ? 3. * r5inv : 0.);
+                    return v;
+                };
+                for (int m = 0; m < 3; ++m) {
+                    Eigen::Vector3d dB_m = node.M0.cross(dG(m));
+                    for (int k = 0; k < 3; ++k)
+                        dB_m -= node.M1[k].cross(ddG(k, m));
+                    for (int j = 0; j < 6; ++j)
+                        dB_m += kl_fak[j] * node.M2[j].cross(dddG(kl[j][0], kl[j][1], m));
+                    dB.row(m) += dB_m.transpose();
+                }
+            }
+        }
+};
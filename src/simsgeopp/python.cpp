@@ -20,6 +20,7 @@ typedef CurveXYZFourier<PyArray> PyCurveXYZFourier;
 #include "curverzfourier.cpp"
 typedef CurveRZFourier<PyArray> PyCurveRZFourier; 
 #include "biot_savart.h"
+#include "regular_grid_interpolant_3d.h"
 
 namespace py = pybind11;
 
@@ -226,8 +227,40 @@ PYBIND11_MODULE(simsgeopp, m) {
     register_common_curve_methods<PyCurveRZFourier>(pycurverzfourier);
 
     m.def("biot_savart", &biot_savart);
+    m.def("biot_savart_fused", &biot_savart_fused);
     m.def("biot_savart_B", &biot_savart_B);
+    m.def("biot_savart_tree", &biot_savart_tree);
     m.def("biot_savart_vjp", &biot_savart_vjp);
+    m.def("biot_savart_A", &biot_savart_A);
+    m.def("biot_savart_vjp_A", &biot_savart_vjp_A);
+
+    py::class_<CylindricalFieldInterpolant>(m, "CylindricalFieldInterpolant")
+        .def(py::init<double, double, int, int, double, double, int, int, int, bool>())
+        .def("nodes", [](const CylindricalFieldInterpolant& f, int d) { return f.interpolant.nodes(d); })
+        .def("set_values", [](CylindricalFieldInterpolant& f, PyArray& values) {
+                auto& num_nodes = f.interpolant.num_nodes;
+                if(values.size() != num_nodes[0]*num_nodes[1]*num_nodes[2]*3)
+                    throw std::invalid_argument("values has the wrong size");
+                auto data = vector<double>(values.begin(), values.end());
+                f.interpolant.set_values(data.data());
+            })
+        .def("evaluate", [](const CylindricalFieldInterpolant& f, PyArray& points) {
+                int num_points = points.shape(0);
+                auto xyz = vector<double>(points.begin(), points.end());
+                PyArray B = xt::zeros<double>({num_points, 3});
+                f.evaluate_batch(xyz.data(), num_points, B.data(), nullptr);
+                return B;
+            })
+        .def("evaluate_with_derivative", [](const CylindricalFieldInterpolant& f, PyArray& points) {
+                int num_points = points.shape(0);
+                auto xyz = vector<double>(points.begin(), points.end());
+                PyArray B = xt::zeros<double>({num_points, 3});
+                PyArray dB = xt::zeros<double>({num_points, 3, 3});
+                f.evaluate_batch(xyz.data(), num_points, B.data(), dB.data());
+                return std::make_tuple(B, dB);
+            })
+        .def_readonly("nfp", &CylindricalFieldInterpolant::nfp)
+        .def_readonly("stellsym", &CylindricalFieldInterpolant::stellsym);
 
 
 #ifdef VERSION_INFO
@@ -0,0 +1,221 @@
+#pragma once
+
+// Piecewise polynomial interpolation on a regular grid in three dimensions,
+// and its use for interpolating a magnetic field in cylindrical coordinates.
+//
+// The domain is split into n[0] x n[1] x n[2] cells, and in each cell a
+// function is interpolated by a tensor product Lagrange polynomial of the
+// given degree on equally spaced nodes, e.g. tricubic for degree 3. Nodes on
+// the faces of the cells are shared between neighbouring cells, so a grid
+// with n cells in a direction has n*degree+1 nodes in that direction, and
+// only the values at the nodes are stored.
+
+#include <vector>
+#include <array>
+#include <cmath>
+#include <limits>
+#include <stdexcept>
+
+class RegularGridInterpolant3D {
+    public:
+        static constexpr int max_degree = 7;
+
+        RegularGridInterpolant3D(std::array<double, 3> lower, std::array<double, 3> upper, std::array<int, 3> n, int degree, int value_size) :
+            lower(lower), upper(upper), n(n), degree(degree), value_size(value_size) {
+            if(degree < 1 || degree > max_degree)
+                throw std::invalid_argument("degree must be between 1 and 7");
+            for (int d = 0; d < 3; ++d) {
+                if(n[d] < 1)
+                    throw std::invalid_argument("The number of cells must be positive");
+                if(!(upper[d] > lower[d]))
+                    throw std::invalid_argument("The upper bound of the grid must be larger than the lower bound");
+                num_nodes[d] = n[d]*degree + 1;
+                spacing[d] = (upper[d] - lower[d])/(n[d]*degree);
+            }
+            values = std::vector<double>(num_nodes[0]*num_nodes[1]*num_nodes[2]*value_size, 0.);
+        }
+
+        // The coordinates of the nodes in direction d.
+        std::vector<double> nodes(int d) const {
+            auto res = std::vector<double>(num_nodes[d]);
+            for (int i = 0; i < num_nodes[d]; ++i)
+                res[i] = lower[d] + i*spacing[d];
+            return res;
+        }
+
+        // Set the values at the nodes, stored in C order with shape
+        // (num_nodes[0], num_nodes[1], num_nodes[2], value_size).
+        void set_values(const double* data) {
+            for (size_t i = 0; i < values.size(); ++i)
+                values[i] = data[i];
+        }
+
+        bool contains(const double* x) const {
+            for (int d = 0; d < 3; ++d) {
+                if(!(x[d] >= lower[d] && x[d] <= upper[d]))
+                    return false;
+            }
+            return true;
+        }
+
+        // Evaluate the interpolant at x, which has to lie in the domain. If
+        // dout is not null, the derivatives dout[3*k + d] of the k-th value
+        // with respect to x[d] are computed as well.
+        void evaluate(const double* x, double* out, double* dout) const {
+            double w[3][max_degree + 1];
+            double dw[3][max_degree + 1];
+            int start[3];
+            for (int d = 0; d < 3; ++d) {
+                double s = (x[d] - lower[d])/spacing[d];
+                int cell = std::min(std::max(int(std::floor(s/degree)), 0), n[d] - 1);
+                start[d] = cell*degree;
+                lagrange_basis(s - start[d], w[d], dw[d]);
+                for (int j = 0; j <= degree; ++j)
+                    dw[d][j] /= spacing[d];
+            }
+            for (int k = 0; k < value_size; ++k) {
+                out[k] = 0.;
+                if(dout) {
+                    dout[3*k + 0] = 0.;
+                    dout[3*k + 1] = 0.;
+                    dout[3*k + 2] = 0.;
+                }
+            }
+            for (int i0 = 0; i0 <= degree; ++i0) {
+                for (int i1 = 0; i1 <= degree; ++i1) {
+                    double w01 = w[0][i0]*w[1][i1];
+                    const double* v = &values[((start[0] + i0)*num_nodes[1] + start[1] + i1)*num_nodes[2]*value_size + start[2]*value_size];
+                    for (int i2 = 0; i2 <= degree; ++i2) {
+                        double weight = w01*w[2][i2];
+                        for (int k = 0; k < value_size; ++k)
+                            out[k] += weight*v[i2*value_size + k];
+                        if(dout) {
+                            double weight0 = dw[0][i0]*w[1][i1]*w[2][i2];
+                            double weight1 = w[0][i0]*dw[1][i1]*w[2][i2];
+                            double weight2 = w01*dw[2][i2];
+                            for (int k = 0; k < value_size; ++k) {
+                                dout[3*k + 0] += weight0*v[i2*value_size + k];
+                                dout[3*k + 1] += weight1*v[i2*value_size + k];
+                                dout[3*k + 2] += weight2*v[i2*value_size + k];
+                            }
+                        }
+                    }
+                }
+            }
+        }
+
+        std::array<double, 3> lower, upper;
+        std::array<int, 3> n;
+        std::array<int, 3> num_nodes;
+        int degree;
+        int value_size;
+
+    private:
+        std::array<double, 3> spacing;
+        std::vector<double> values;
+
+        // The Lagrange polynomials on the nodes 0, 1, ..., degree and their
+        // derivatives, evaluated at t.
+        void lagrange_basis(double t, double* w, double* dw) const {
+            for (int j = 0; j <= degree; ++j) {
+                w[j] = 1.;
+                dw[j] = 0.;
+                for (int m = 0; m <= degree; ++m) {
+                    if(m == j)
+                        continue;
+                    double term = 1./(j - m);
+                    for (int q = 0; q <= degree; ++q) {
+                        if(q != j && q != m)
+                            term *= (t - q)/(j - q);
+                    }
+                    dw[j] += term;
+                    w[j] *= (t - m)/(j - m);
+                }
+            }
+        }
+};
+
+
+// Interpolates a magnetic field given by its cylindrical components
+// (B_r, B_phi, B_z) on a grid in (r, phi, z). The field is assumed to be
+// invariant under rotation by 2 pi/nfp, so phi only has to cover
+// [0, 2 pi/nfp]. If the field is also stellarator symmetric, i.e.
+// B_r(r, -phi, -z) = -B_r(r, phi, z) while B_phi and B_z are unchanged, phi
+// only has to cover [0, pi/nfp], and the z range has to be symmetric about 0.
+class CylindricalFieldInterpolant {
+    public:
+        CylindricalFieldInterpolant(double rmin, double rmax, int nr, int nphi, double zmin, double zmax, int nz, int degree, int nfp, bool stellsym) :
+            interpolant({rmin, 0., zmin}, {rmax, (stellsym ? M_PI : 2*M_PI)/nfp, zmax}, {nr, nphi, nz}, degree, 3),
+            nfp(nfp), stellsym(stellsym) {
+            if(stellsym && zmin != -zmax)
+                throw std::invalid_argument("For stellarator symmetric fields, the z range has to be symmetric about 0");
+        }
+
+        // Evaluates B, and if dB is not null its gradient dB[3*k + d] =
+        // dB_d/dx_k, at num_points Cartesian points. Points outside the grid
+        // give nan.
+        void evaluate_batch(const double* xyz, int num_points, double* B, double* dB) const {
+#pragma omp parallel for
+            for (int i = 0; i < num_points; ++i)
+                evaluate(&xyz[3*i], &B[3*i], dB ? &dB[9*i] : nullptr);
+        }
+
+        void evaluate(const double* xyz, double* B, double* dB) const {
+            double x = xyz[0], y = xyz[1], z = xyz[2];
+            double r = std::sqrt(x*x + y*y);
+            double phi = std::atan2(y, x);
+            double period = 2*M_PI/nfp;
+            double q[3] = {r, phi - period*std::floor(phi/period), z};
+            bool flip = false;
+            if(stellsym && q[1] > 0.5*period) {
+                q[1] = period - q[1];
+                q[2] = -z;
+                flip = true;
+            }
+            if(!interpolant.contains(q)) {
+                for (int d = 0; d < 3; ++d)
+                    B[d] = std::numeric_limits<double>::quiet_NaN();
+                if(dB) {
+                    for (int d = 0; d < 9; ++d)
+                        dB[d] = std::numeric_limits<double>::quiet_NaN();
+                }
+                return;
+            }
+            double Bc[3];
+            double dBc[9];
+            interpolant.evaluate(q, Bc, dB ? dBc : nullptr);
+            if(flip) {
+                // B_r changes sign, and the derivatives with respect to phi
+                // and z change sign because of the reflection.
+                Bc[0] = -Bc[0];
+                if(dB) {
+                    for (int c = 0; c < 3; ++c) {
+                        double sign = (c == 0) ? -1. : 1.;
+                        dBc[3*c + 0] *= sign;
+                        dBc[3*c + 1] *= -sign;
+                        dBc[3*c + 2] *= -sign;
+                    }
+                }
+            }
+            double cosphi = x/r, sinphi = y/r;
+            B[0] = Bc[0]*cosphi - Bc[1]*sinphi;
+            B[1] = Bc[0]*sinphi + Bc[1]*cosphi;
+            B[2] = Bc[2];
+            if(dB) {
+                // The derivatives of the Cartesian components with respect to
+                // r, phi and z:
+                double dB_dr[3] = {dBc[0]*cosphi - dBc[3]*sinphi, dBc[0]*sinphi + dBc[3]*cosphi, dBc[6]};
+                double dB_dphi[3] = {dBc[1]*cosphi - dBc[4]*sinphi - B[1], dBc[1]*sinphi + dBc[4]*cosphi + B[0], dBc[7]};
+                double dB_dz[3] = {dBc[2]*cosphi - dBc[5]*sinphi, dBc[2]*sinphi + dBc[5]*cosphi, dBc[8]};
+                for (int d = 0; d < 3; ++d) {
+                    dB[0 + d] = cosphi*dB_dr[d] - sinphi/r*dB_dphi[d];
+                    dB[3 + d] = sinphi*dB_dr[d] + cosphi/r*dB_dphi[d];
+                    dB[6 + d] = dB_dz[d];
+                }
+            }
+        }
+
+        RegularGridInterpolant3D interpolant;
+        int nfp;
+        bool stellsym;
+};
@@ -11,7 +11,9 @@ This module should not depend on anything involving communication
 """
 
 import logging
+import pickle
 import numpy as np
+import scipy.sparse
 
 from .optimizable import function_from_user
 from .util import unique
@@ -19,22 +21,52 @@ from .util import unique
 logger = logging.getLogger(__name__)
 
 
-def get_owners(obj, owners_so_far=[]):
+def get_owners(obj, memo=None):
     """
     Given an object, return a list of objects that own any
     degrees of freedom, including both the input object and any of its
     dependendents, if there are any.
+
+    The list starts with obj, followed by the list for each object
+    named in obj.depends_on, in order. An object reachable along more
+    than one path appears once for each path.
+
+    The dependency graph is traversed iteratively, so deep chains of
+    dependencies do not hit the recursion limit, and the list for each
+    object is computed only once. memo can be a dict, shared between
+    calls, in which the list for each object visited is stored, keyed
+    by id(). RuntimeError is raised if the objects depend on each
+    other circularly.
     """
-    owners = [obj]
-    # If the 'depends_on' attribute does not exist, assume obj does
-    # not depend on the dofs of any other objects.
-    if hasattr(obj, 'depends_on'):
-        for j in obj.depends_on:
-            subobj = getattr(obj, j)
-            if subobj in owners_so_far:
-                raise RuntimeError('Circular dependency detected among the objects')
-            owners += get_owners(subobj, owners_so_far=owners)
-    return owners
+    if memo is None:
+        memo = {}
+    # Objects whose lists are being assembled, i.e. the ancestors of
+    # the object being visited. Reaching one of these again means
+    # there is a cycle.
+    in_progress = set()
+    stack = [(obj, False)]
+    while len(stack) > 0:
+        node, children_done = stack.pop()
+        key = id(node)
+        # If the 'depends_on' attribute does not exist, assume node
+        # does not depend on the dofs of any other objects.
+        children = [getattr(node, name) for name in getattr(node, 'depends_on', [])]
+        if children_done:
+            owners = [node]
+            for child in children:
+                owners += memo[id(child)]
+            memo[key] = owners
+            in_progress.discard(key)
+            continue
+        if key in memo:
+            continue
+        if key in in_progress:
+            raise RuntimeError('Circular dependency detected among the objects')
+        in_progress.add(key)
+        stack.append((node, True))
+        for child in reversed(children):
+            stack.append((child, False))
+    return list(memo[id(obj)])
 
 
 class Dofs:
@@ -65,15 +97,40 @@ class Dofs:
         the owner's set_dofs method corresponding to this dof.
 
         names: A list of strings to identify each of the dofs.
+
+        owner_global_indices, owner_local_indices: Lists with one entry
+        per element of all_owners. Each entry is an integer array such
+        that x[owner_global_indices[k]] corresponds to
+        all_owners[k].get_dofs()[owner_local_indices[k]]. These maps
+        allow x, set() and jac() to gather and scatter the state
+        vector without any per-dof python loops.
+
+        owner_dependencies: A list with one entry per element of
+        all_owners. Each entry is an integer array giving the
+        positions in all_owners of the objects that this owner depends
+        on, directly or indirectly.
+
+        nskipped_set_dofs: The number of times set() has skipped
+        calling set_dofs() on an owner because neither the owner's
+        dofs nor the dofs of anything it depends on have changed.
+
+        func_global_cols, func_local_cols: Lists with one entry per
+        function. For function j, column func_local_cols[j] of the
+        function's gradient is stored in column func_global_cols[j]
+        of the global Jacobian.
         """
 
         # Convert all user-supplied function-like things to actual functions:
         funcs = [function_from_user(f) for f in funcs]
 
-        # First, get a list of the objects and any objects they depend on:
+        # First, get a list of the objects and any objects they depend
+        # on. The lists of owners are shared between the functions
+        # through memo, since the functions typically depend on
+        # overlapping parts of the same graph:
+        memo = {}
         all_owners = []
         for j in funcs:
-            all_owners += get_owners(j.__self__)
+            all_owners += get_owners(j.__self__, memo)
 
         # Eliminate duplicates, preserving order:
         all_owners = unique(all_owners)
@@ -86,6 +143,8 @@ class Dofs:
         maxs = []
         names = []
         fixed_merged = []
+        owner_global_indices = []
+        owner_local_indices = []
         for owner in all_owners:
             ox = owner.get_dofs()
             ndofs = len(ox)
@@ -112,14 +171,27 @@ class Dofs:
             else:
                 onames = ['x[{}] of {}'.format(k, owner) for k in range(ndofs)]
 
-            for jdof in range(ndofs):
-                if not fixed[jdof]:
-                    x.append(ox[jdof])
-                    dof_owners.append(owner)
-                    indices.append(jdof)
-                    names.append(onames[jdof])
-                    mins.append(omins[jdof])
-                    maxs.append(omaxs[jdof])
+            local_indices = [jdof for jdof in range(ndofs) if not fixed[jdof]]
+            owner_global_indices.append(np.arange(len(x), len(x) + len(local_indices),
+                                                  dtype=int))
+            owner_local_indices.append(np.array(local_indices, dtype=int))
+            for jdof in local_indices:
+                x.append(ox[jdof])
+                dof_owners.append(owner)
+                indices.append(jdof)
+                names.append(onames[jdof])
+                mins.append(omins[jdof])
+                maxs.append(omaxs[jdof])
+
+        # For each owner, record which other owners it depends on, so
+        # set() can tell when an owner must be updated because
+        # something upstream of it changed:
+        owner_position = {id(owner): j for j, owner in enumerate(all_owners)}
+        owner_dependencies = []
+        for owner in all_owners:
+            deps = unique(get_owners(owner, memo)[1:])
+            owner_dependencies.append(np.array([owner_position[id(dep)] for dep in deps],
+                                               dtype=int))
 
         # Now repeat the process we just went through, but for only a
         # single element of funcs. The results will be needed to
@@ -134,7 +206,7 @@ class Dofs:
         # information needed to convert the individual function
         # gradients into the global Jacobian.
         for func in funcs:
-            owners = get_owners(func.__self__)
+            owners = get_owners(func.__self__, memo)
             f_dof_owners = []
             f_indices = []
             f_fixed = []
@@ -158,6 +230,27 @@ class Dofs:
             func_indices.append(f_indices)
             func_fixed.append(f_fixed)
 
+        # For each function, match up the global dofs with the
+        # columns of that function's gradient. A global dof matches a
+        # gradient column if the owners and indices both match. If an
+        # owner appears more than once for a function, the first
+        # matching column is used.
+        global_slot = {(id(owner), index): jdof for jdof, (owner, index)
+                       in enumerate(zip(dof_owners, indices))}
+        func_global_cols = []
+        func_local_cols = []
+        for jfunc in range(len(funcs)):
+            first_col = {}
+            for jgrad, (owner, index) in enumerate(zip(func_dof_owners[jfunc],
+                                                       func_indices[jfunc])):
+                jdof = global_slot.get((id(owner), index))
+                if jdof is not None:
+                    first_col.setdefault(jdof, jgrad)
+            global_cols = np.array(sorted(first_col), dtype=int)
+            func_global_cols.append(global_cols)
+            func_local_cols.append(np.array([first_col[jdof] for jdof in global_cols],
+                                            dtype=int))
+
         # Check whether derivative information is available:
         grad_avail = True
         grad_funcs = []
@@ -185,6 +278,12 @@ class Dofs:
         self.func_dof_owners = func_dof_owners
         self.func_indices = func_indices
         self.func_fixed = func_fixed
+        self.owner_global_indices = owner_global_indices
+        self.owner_local_indices = owner_local_indices
+        self.owner_dependencies = owner_dependencies
+        self.nskipped_set_dofs = 0
+        self.func_global_cols = func_global_cols
+        self.func_local_cols = func_local_cols
         self.grad_avail = grad_avail
         self.grad_funcs = grad_funcs
 
@@ -195,14 +294,15 @@ class Dofs:
         of the state vector.
         """
         x = np.zeros(self.nparams)
-        for owner in self.dof_owners:
+        for owner, global_indices, local_indices in zip(
+                self.all_owners, self.owner_global_indices, self.owner_local_indices):
+            if len(global_indices) == 0:
+                continue
             # In the next line, we make sure to cast the type to a
             # float. Otherwise get_dofs might return an array with
             # integer type.
             objx = np.array(owner.get_dofs(), dtype=np.dtype(float))
-            for j in range(self.nparams):
-                if self.dof_owners[j] == owner:
-                    x[j] = objx[self.indices[j]]
+            x[global_indices] = objx[local_indices]
         return x
 
     def f(self, x=None):
@@ -235,11 +335,13 @@ class Dofs:
         self.nvals = np.sum(self.nvals_per_func)
         return np.concatenate(val_list)
 
-    def jac(self, x=None):
+    def jac(self, x=None, sparse=False):
         """
         Return the Jacobian, i.e. the gradients of all the functions that
         were originally supplied to Dofs(). Result is a 2D numpy
-        array.
+        array, or a scipy.sparse.csr_matrix if sparse is True. In the
+        sparse case, only the entries in jac_sparsity() are stored, and
+        the dense matrix is never formed.
 
         If the argument x is not supplied, the Jacobian will be
         evaluated for the present state vector. If x is supplied, then
@@ -292,6 +394,21 @@ class Dofs:
 
         self.nvals = np.sum(self.nvals_per_func)
 
+        if sparse:
+            rows = []
+            cols = []
+            vals = []
+            for jfunc in range(self.nfuncs):
+                global_cols = self.func_global_cols[jfunc]
+                block = grads[jfunc][:, self.func_local_cols[jfunc]]
+                block_rows = np.arange(start_indices[jfunc], end_indices[jfunc])
+                rows.append(np.repeat(block_rows, len(global_cols)))
+                cols.append(np.tile(global_cols, len(block_rows)))
+                vals.append(block.flatten())
+            return scipy.sparse.csr_matrix(
+                (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                shape=(self.nvals, self.nparams))
+
         results = np.zeros((self.nvals, self.nparams))
         # Loop over the rows of the Jacobian, i.e. over the functions
         # that were originally provided to Dofs():
@@ -300,15 +417,10 @@ class Dofs:
             end_index = end_indices[jfunc]
             grad = grads[jfunc]
 
-            # Match up the global dofs with the dofs for this particular gradient function:
-            for jdof in range(self.nparams):
-                for jgrad in range(len(self.func_indices[jfunc])):
-                    # A global dof matches a dof for this function if the owners and indices both match:
-                    if self.dof_owners[jdof] == self.func_dof_owners[jfunc][jgrad] and self.indices[jdof] == \
-                            self.func_indices[jfunc][jgrad]:
-                        results[start_index:end_index, jdof] = grad[:, jgrad]
-                        # If we find a match, we can exit the innermost loop:
-                        break
+            # Scatter the gradient columns into the global dofs,
+            # using the maps precomputed in __init__:
+            results[start_index:end_index, self.func_global_cols[jfunc]] = \
+                grad[:, self.func_local_cols[jfunc]]
 
         # print('finite-difference Jacobian:')
         # fd_jac = self.fd_jac()
@@ -319,36 +431,161 @@ class Dofs:
         # print(fd_jac - results)
         return results
 
+    def jac_sparsity(self):
+        """
+        Return the sparsity pattern of the Jacobian, as a
+        scipy.sparse.csr_matrix of shape (nvals, nparams) with ones
+        where the Jacobian may be nonzero. The rows for each function
+        are nonzero only in the columns for dofs of the objects the
+        function depends on, i.e. the columns in func_global_cols.
+
+        The number of values returned by each function must be known,
+        so if no function evaluation has been done yet, one is done
+        here.
+        """
+        if self.nvals is None:
+            self.f()
+        rows = []
+        cols = []
+        start_index = 0
+        for jfunc in range(self.nfuncs):
+            nvals = self.nvals_per_func[jfunc]
+            global_cols = self.func_global_cols[jfunc]
+            rows.append(np.repeat(np.arange(start_index, start_index + nvals),
+                                  len(global_cols)))
+            cols.append(np.tile(global_cols, nvals))
+            start_index += nvals
+        rows = np.concatenate(rows)
+        return scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, np.concatenate(cols))),
+                                       shape=(self.nvals, self.nparams))
+
+    def column_groups(self):
+        """
+        Partition the dofs into groups such that no function depends on
+        more than one dof in each group. All the dofs in a group can
+        then be perturbed at the same time in a finite-difference
+        Jacobian, since the change in each function is due to at most
+        one of them. The groups are found by greedy coloring of the
+        graph in which two dofs are connected if some function depends
+        on both, taking the dofs in order.
+
+        For example, if each function depends on the dofs of only one
+        coil, the number of groups is the largest number of dofs of
+        any one coil, rather than the total number of dofs.
+
+        Returns:
+            A list of integer arrays, each giving the dofs in one group.
+        """
+        dof_funcs = [[] for j in range(self.nparams)]
+        for jfunc, global_cols in enumerate(self.func_global_cols):
+            for jdof in global_cols:
+                dof_funcs[jdof].append(jfunc)
+
+        colors = np.full(self.nparams, -1, dtype=int)
+        for jdof in range(self.nparams):
+            used = set()
+            for jfunc in dof_funcs[jdof]:
+                used.update(colors[self.func_global_cols[jfunc]])
+            color = 0
+            while color in used:
+                color += 1
+            colors[jdof] = color
+
+        ngroups = np.max(colors) + 1 if self.nparams > 0 else 0
+        return [np.nonzero(colors == color)[0] for color in range(ngroups)]
+
     def set(self, x):
         """
         Call set_dofs() for each object, given a global state vector x.
+
+        set_dofs() is only called for objects whose dofs actually
+        change, or which depend on an object whose dofs change. This
+        way, expensive codes and cached quantities are not
+        invalidated when only an unrelated dof is modified, as happens
+        for most columns of a finite-difference Jacobian. The version
+        counter of each object whose dofs change is incremented (see
+        Optimizable.bump_version()), so objects downstream of it know
+        their results are stale.
         """
-        # Idea behind the following loops: call set_dofs exactly once
-        # once for each object, in case that improves performance at
-        # all for the optimizable objects.
-        for owner in self.all_owners:
+        # Idea behind the following loops: call set_dofs at most once
+        # for each object, in case that improves performance at all
+        # for the optimizable objects.
+        x = np.asarray(x, dtype=np.dtype(float))
+        changed = np.full(len(self.all_owners), False)
+        objxs = []
+        for j, (owner, global_indices, local_indices) in enumerate(zip(
+                self.all_owners, self.owner_global_indices, self.owner_local_indices)):
             # In the next line, we make sure to cast the type to a
             # float. Otherwise get_dofs might return an array with
             # integer type.
             objx = np.array(owner.get_dofs(), dtype=np.dtype(float))
-            for j in range(self.nparams):
-                if self.dof_owners[j] == owner:
-                    objx[self.indices[j]] = x[j]
-            owner.set_dofs(objx)
+            newx = x[global_indices]
+            # Compare against the owner's present dofs rather than
+            # the last values we sent, in case the owner was modified
+            # directly. The comparison is bitwise, so e.g. -0.0 vs 0.0
+            # counts as a change.
+            if newx.tobytes() != objx[local_indices].tobytes():
+                objx[local_indices] = newx
+                changed[j] = True
+            objxs.append(objx)
+
+        for j, owner in enumerate(self.all_owners):
+            if changed[j] or np.any(changed[self.owner_dependencies[j]]):
+                owner.set_dofs(objxs[j])
+                if changed[j] and hasattr(owner, 'bump_version'):
+                    owner.bump_version()
+            else:
+                self.nskipped_set_dofs += 1
 
-    def fd_jac(self, x=None, eps=1e-7, centered=False):
+    def fd_jac(self, x=None, eps=1e-7, centered=False, richardson=False,
+               f0=None, executor=None, grouped=False, sparse=False, chunksize=1):
         """
         Compute the finite-difference Jacobian of the functions with
         respect to all non-fixed degrees of freedom. Either a 1-sided
         or centered-difference approximation is used, with step size
-        eps.
+        eps. eps can be a scalar, or an array with a step for each
+        parameter, e.g. from fd_steps().
+
+        If richardson is True, two steps eps and 2 * eps are combined
+        by Richardson extrapolation, to eliminate the leading error
+        term. For centered differences this gives the 4-point stencil,
+        with error O(eps^4), and for 1-sided differences a 3-point
+        stencil with error O(eps^2). See fd_points().
 
         If the argument x is not supplied, the Jacobian will be
         evaluated for the present state vector. If x is supplied, then
         first get_dofs() will be called for each object to set the
         global state vector to x.
 
-        No parallelization is used here.
+        For 1-sided differences, the function values at the present
+        state vector can be passed as f0, e.g. if they are already
+        known from the optimizer, in which case they are not evaluated
+        again. The Jacobian then costs exactly nparams function
+        evaluations (2 * nparams with richardson=True).
+
+        If executor is None, no parallelization is used. Otherwise
+        executor should be a concurrent.futures.Executor, such as a
+        ProcessPoolExecutor, and the functions are evaluated at the
+        perturbed points by executor's workers. The objects are pickled
+        once, and each task evaluates chunksize of the points on its own
+        copy of the objects, so small chunks let the executor balance
+        evaluations of different cost among its workers, while large
+        chunks make fewer copies. In this case all the
+        objects must be picklable, and the state of the objects in this
+        process is not modified. eps is used as given, so to reproduce
+        the steps scipy.optimize.least_squares uses for its own
+        finite differences, pass eps from scipy_fd_steps().
+
+        If grouped is True, the dofs in each group returned by
+        column_groups() are perturbed simultaneously, so the number of
+        function evaluations is proportional to the number of groups
+        rather than to nparams. This relies on each function depending
+        only on the dofs of the objects it is connected to through
+        depends_on. The columns are then separated using
+        jac_sparsity().
+
+        If sparse is True, the result is a scipy.sparse.csr_matrix
+        instead of a 2D numpy array.
         """
 
         if x is not None:
@@ -371,42 +608,250 @@ class Dofs:
                 # function eval to determine nvals.
                 self.f()
             jac = np.zeros((self.nvals, self.nparams))
-            return jac
-
-        if centered:
-            # Centered differences:
-            jac = None
-            for j in range(self.nparams):
-                x = np.copy(x0)
-
-                x[j] = x0[j] + eps
-                self.set(x)
-                # fplus = np.array([f() for f in self.funcs])
-                fplus = self.f()
-                if jac is None:
-                    # After the first function evaluation, we now know
-                    # the size of the Jacobian.
-                    jac = np.zeros((self.nvals, self.nparams))
-
-                x[j] = x0[j] - eps
-                self.set(x)
-                fminus = self.f()
-
-                jac[:, j] = (fplus - fminus) / (2 * eps)
+            return scipy.sparse.csr_matrix(jac) if sparse else jac
+
+        groups = self.column_groups() if grouped else None
+        xs = fd_points(x0, eps, centered=centered, richardson=richardson, groups=groups)
+        npoints = xs.shape[1]
+        # For 1-sided differences, column 0 of xs is x0:
+        first = 0
+        if f0 is not None and not centered:
+            first = 1
+
+        if executor is not None:
+            # Serialize this object, including all the objects that own
+            # dofs, only once, and send it with each chunk of points:
+            data = pickle.dumps(self)
+            chunks = [np.arange(start, min(start + chunksize, npoints))
+                      for start in range(first, npoints, chunksize)]
+            results = list(executor.map(evaluate_dofs, [data] * len(chunks),
+                                        [xs[:, chunk] for chunk in chunks]))
+            fs = [f for chunk_fs, nvals_per_func in results for f in chunk_fs]
+            self.nvals_per_func = results[0][1]
+            self.nvals = np.sum(self.nvals_per_func)
+        else:
+            fs = []
+            for j in range(first, npoints):
+                self.set(xs[:, j])
+                fs.append(self.f())
+            # Weird things may happen if we do not reset the state vector
+            # to x0:
+            self.set(x0)
+
+        evals = np.zeros((self.nvals, npoints))
+        if first == 1:
+            evals[:, 0] = f0
+        evals[:, first:] = np.array(fs).T
+        if grouped:
+            jac = fd_jac_from_evals(evals, eps, centered=centered, richardson=richardson,
+                                    groups=groups, sparsity=self.jac_sparsity())
+            return jac.tocsr() if sparse else jac.toarray()
+        jac = fd_jac_from_evals(evals, eps, centered=centered, richardson=richardson)
+        return scipy.sparse.csr_matrix(jac) if sparse else jac
+
+    def fd_noise(self, x=None, h=1e-6, npoints=8, seed=0):
+        """
+        Estimate the relative noise in the functions, i.e. the typical
+        size of the random error in each function value divided by its
+        magnitude. Numerical codes such as VMEC only converge to a
+        tolerance, so their outputs contain noise that limits the
+        accuracy of finite differences, and that can be used to choose
+        the step sizes with fd_steps().
+
+        The functions are evaluated at npoints points spaced by h
+        along a random unit direction through x. Since the third
+        differences of a smooth function along these points are
+        O(h^3), they are dominated by the noise, and the noise is
+        estimated from their root-mean-square as in the ECnoise method
+        of More and Wild (SIAM J. Sci. Comput. 33, 1292 (2011)).
+
+        If the argument x is not supplied, the present state vector is
+        used.
+        """
+        if npoints < 4:
+            raise ValueError('npoints must be at least 4')
+        if x is not None:
+            self.set(x)
+        x0 = self.x
+        direction = np.random.default_rng(seed).standard_normal(self.nparams)
+        direction /= np.linalg.norm(direction)
 
+        fs = []
+        for j in range(npoints):
+            self.set(x0 + (j - npoints // 2) * h * direction)
+            fs.append(self.f())
+        self.set(x0)
+        fs = np.array(fs)
+
+        # Third differences of independent noise with standard
+        # deviation sigma have variance sigma^2 / gamma, with gamma =
+        # (3!)^2 / 6!:
+        gamma = 36.0 / 720.0
+        differences = np.diff(fs, n=3, axis=0)
+        noise = np.sqrt(gamma * np.mean(differences ** 2, axis=0))
+        scale = np.max(np.abs(fs), axis=0)
+        relative = noise[scale > 0] / scale[scale > 0]
+        return np.max(relative) if len(relative) > 0 else 0.0
+
+    def fd_steps(self, noise=None, x=None, centered=False, richardson=False,
+                 typical_x=1.0):
+        """
+        Return an array of finite-difference step sizes, one for each
+        parameter, to pass as eps to fd_jac() or fd_jac_mpi().
+
+        Each step is proportional to max(abs(x_j), typical_x), so the
+        relative perturbation of large dofs is similar to that of
+        small ones. The constant of proportionality balances the
+        truncation error of the stencil against the effect of the
+        relative noise in the functions, as in Gill, Murray and Wright,
+        "Practical Optimization" (1981), section 8.6: it is
+        2 sqrt(noise) for 1-sided differences, noise^(1/3) for
+        centered differences, noise^(1/3) for 1-sided differences with
+        richardson=True, and noise^(1/5) for the 4-point stencil.
+
+        noise is the relative noise in the functions. If None, it is
+        estimated using fd_noise(). It is never taken to be smaller
+        than the machine precision.
+        """
+        if x is not None:
+            self.set(x)
+        x0 = self.x
+        if noise is None:
+            noise = self.fd_noise()
+        noise = max(noise, np.finfo(float).eps)
+        if centered and richardson:
+            factor = noise ** 0.2
+        elif centered or richardson:
+            factor = noise ** (1.0 / 3)
         else:
-            # 1-sided differences
-            f0 = self.f()
-            jac = np.zeros((self.nvals, self.nparams))
-            for j in range(self.nparams):
-                x = np.copy(x0)
-                x[j] = x0[j] + eps
-                self.set(x)
-                fplus = self.f()
+            factor = 2 * np.sqrt(noise)
+        return factor * np.maximum(np.abs(x0), typical_x)
 
-                jac[:, j] = (fplus - f0) / eps
 
-        # Weird things may happen if we do not reset the state vector
-        # to x0:
-        self.set(x0)
-        return jac
+def scipy_fd_steps(x, diff_step=None):
+    """
+    Return the steps scipy.optimize.least_squares uses for its
+    1-sided finite differences ('2-point') at x, i.e. diff_step times
+    max(1, |x|) in the direction of the sign of x. If diff_step is
+    None, scipy's default, the square root of the machine epsilon, is
+    used. The result can be passed as eps to Dofs.fd_jac().
+    """
+    x = np.asarray(x, dtype=np.dtype(float))
+    if diff_step is None:
+        diff_step = np.sqrt(np.finfo(float).eps)
+    sign = np.where(x >= 0, 1.0, -1.0)
+    return diff_step * sign * np.maximum(1.0, np.abs(x))
+
+
+def fd_points(x0, eps, centered=False, richardson=False, groups=None):
+    """
+    Return a matrix, the columns of which are the state vectors at
+    which the functions are evaluated for a finite-difference
+    Jacobian at x0. eps can be a scalar or an array with one step
+    for each parameter.
+
+    The columns are ordered as follows, where h_j is the step for
+    parameter j and e_j the unit vector in the direction of parameter j:
+
+    - 1-sided: x0, then x0 + h_j e_j for each j.
+    - 1-sided with richardson: x0, then x0 + h_j e_j, x0 + 2 h_j e_j
+      for each j.
+    - centered: x0 + h_j e_j, x0 - h_j e_j for each j.
+    - centered with richardson: x0 + h_j e_j, x0 - h_j e_j,
+      x0 + 2 h_j e_j, x0 - 2 h_j e_j for each j.
+
+    If groups is given, as a list of arrays of parameter indices such
+    as from Dofs.column_groups(), then j runs over the groups instead
+    of the parameters, and all the parameters in a group are perturbed
+    together.
+    """
+    nparams = len(x0)
+    eps = np.broadcast_to(np.asarray(eps, dtype=np.dtype(float)), (nparams,))
+    if groups is None:
+        groups = [[j] for j in range(nparams)]
+    if centered:
+        multiples = [1, -1, 2, -2] if richardson else [1, -1]
+        first = 0
+    else:
+        multiples = [1, 2] if richardson else [1]
+        first = 1
+    nper = len(multiples)
+    xs = np.repeat(x0.reshape((nparams, 1)), first + nper * len(groups), axis=1)
+    for j, group in enumerate(groups):
+        for k, multiple in enumerate(multiples):
+            xs[group, first + nper * j + k] = x0[group] + multiple * eps[group]
+    return xs
+
+
+def fd_jac_from_evals(evals, eps, centered=False, richardson=False,
+                      groups=None, sparsity=None):
+    """
+    Given the matrix of function values at the points returned by
+    fd_points(), one column per point, return the finite-difference
+    Jacobian.
+
+    If the points were generated with groups, the sparsity pattern
+    of the Jacobian must also be given, e.g. from
+    Dofs.jac_sparsity(), to tell which rows of each difference belong
+    to which parameter of the group. The result is then a
+    scipy.sparse.csc_matrix.
+    """
+    if centered:
+        nper = 4 if richardson else 2
+        ndiffs = evals.shape[1] // nper
+    else:
+        nper = 2 if richardson else 1
+        ndiffs = (evals.shape[1] - 1) // nper
+
+    # Differences of the function values, to be divided by the step:
+    diffs = np.zeros((evals.shape[0], ndiffs))
+    for j in range(ndiffs):
+        if centered:
+            c = nper * j
+            diff = evals[:, c] - evals[:, c + 1]
+            if richardson:
+                diff2 = evals[:, c + 2] - evals[:, c + 3]
+                diffs[:, j] = (8 * diff - diff2) / 12
+            else:
+                diffs[:, j] = diff / 2
+        else:
+            c = 1 + nper * j
+            if richardson:
+                diffs[:, j] = (-3 * evals[:, 0] + 4 * evals[:, c] - evals[:, c + 1]) / 2
+            else:
+                diffs[:, j] = evals[:, c] - evals[:, 0]
+
+    if groups is None:
+        eps = np.broadcast_to(np.asarray(eps, dtype=np.dtype(float)), (ndiffs,))
+        return diffs / eps
+
+    if sparsity is None:
+        raise ValueError('sparsity must be given along with groups')
+    sparsity = scipy.sparse.csc_matrix(sparsity)
+    nparams = sparsity.shape[1]
+    eps = np.broadcast_to(np.asarray(eps, dtype=np.dtype(float)), (nparams,))
+    # For each parameter, take the rows it affects from the
+    # difference for its group:
+    group_of = np.zeros(nparams, dtype=int)
+    for j, group in enumerate(groups):
+        group_of[group] = j
+    data = np.zeros(sparsity.nnz)
+    for j in range(nparams):
+        start, end = sparsity.indptr[j], sparsity.indptr[j + 1]
+        data[start:end] = diffs[sparsity.indices[start:end], group_of[j]] / eps[j]
+    return scipy.sparse.csc_matrix((data, sparsity.indices, sparsity.indptr),
+                                   shape=sparsity.shape)
+
+
+def evaluate_dofs(data, xs):
+    """
+    Evaluate the functions in a pickled Dofs object at each column of
+    xs, returning the list of function values and the number of
+    values from each function. This function is used by Dofs.fd_jac()
+    with an executor, and is at module level so it can be sent to
+    worker processes. Unpickling gives each task its own objects, also
+    with a thread pool.
+    """
+    dofs = pickle.loads(data)
+    fs = [dofs.f(xs[:, j]) for j in range(xs.shape[1])]
+    return fs, dofs.nvals_per_func
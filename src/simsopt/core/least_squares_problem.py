@@ -11,6 +11,7 @@ import numpy as np
 import logging
 import warnings
 
+import scipy.sparse
 from scipy.optimize import least_squares
 from .dofs import Dofs
 from .util import isnumber
@@ -225,10 +226,16 @@ class LeastSquaresProblem:
         actually compute the Dofs() Jacobian, since sometimes we would
         compute that directly whereas other times we might compute it
         with serial or parallel finite differences. The provided jmat
-        is scaled in-place.
+        is scaled in-place, unless it is a scipy.sparse matrix, in
+        which case a new sparse matrix is returned.
         """
         logger.info("scale_dofs_jac() called")
 
+        if scipy.sparse.issparse(jmat):
+            row_scales = np.repeat([np.sqrt(term.weight) for term in self.terms],
+                                   self.dofs.nvals_per_func)
+            return scipy.sparse.diags(row_scales) @ jmat
+
         # Scale rows by sqrt(weight):
         start_index = 0
         for j in range(self.dofs.nfuncs):
@@ -240,7 +247,7 @@ class LeastSquaresProblem:
             
         return np.array(jmat)
     
-    def jac(self, x=None, **kwargs):
+    def jac(self, x=None, executor=None, **kwargs):
         """
         This method gives the Jacobian of the residuals with respect to
         the parameters, if it is available, given the state vector
@@ -254,7 +261,10 @@ class LeastSquaresProblem:
         first set_dofs() will be called for each object to set the
         global state vector to x.
 
-        kwargs is passed to Dofs.fd_jac().
+        If the Jacobian is computed by finite differences, executor
+        can be a concurrent.futures.Executor used to evaluate the
+        functions in parallel; see Dofs.fd_jac(). kwargs is also passed
+        to Dofs.fd_jac().
         """
         logger.info("jac() called with x=" + str(x))
 
@@ -269,7 +279,7 @@ class LeastSquaresProblem:
             jmat = self.dofs.jac()
         else:
             logger.debug('Calling finite_difference Jacobian')
-            jmat = self.dofs.fd_jac(**kwargs)
+            jmat = self.dofs.fd_jac(executor=executor, **kwargs)
 
         # Scale by sqrt(weight) factor:
         return self.scale_dofs_jac(jmat)
@@ -16,12 +16,80 @@ logger = logging.getLogger(__name__)
 class Optimizable():
     """
     This base class provides some useful features for optimizable functions.
+
+    It also keeps track of when objects need to be recomputed. Each
+    object has a version counter, which is incremented by
+    bump_version() whenever its dofs or other inputs change. An object
+    that caches the results of an expensive calculation records the
+    versions of itself and of everything it depends on (through
+    depends_on) when the calculation is done, using mark_current().
+    The results are then stale if any of these versions has changed
+    since, which is cheap to check with is_stale(). In this way a
+    change to a dof invalidates only the objects downstream of it.
     """
     def get_dofs(self):
         raise NotImplementedError
     
     def set_dofs(self, x):
         raise NotImplementedError
+
+    def bump_version(self):
+        """
+        Record that the dofs or other inputs of this object have
+        changed, so the results of this object and of anything that
+        depends on it are stale.
+        """
+        self.version = getattr(self, 'version', 0) + 1
+
+    def upstream_versions(self):
+        """
+        Return a tuple of the version counters of this object and of
+        all the objects it depends on, directly or indirectly, through
+        depends_on.
+        """
+        versions = []
+        visited = set()
+        stack = [self]
+        while len(stack) > 0:
+            obj = stack.pop()
+            if id(obj) in visited:
+                continue
+            visited.add(id(obj))
+            versions.append((id(obj), getattr(obj, 'version', 0)))
+            for name in getattr(obj, 'depends_on', []):
+                stack.append(getattr(obj, name))
+        return tuple(versions)
+
+    def mark_current(self):
+        """
+        Record that the results of this object are up to date with
+        the present versions of this object and everything upstream.
+        """
+        self.computed_versions = self.upstream_versions()
+
+    def is_stale(self):
+        """
+        Return True if this object or anything it depends on has
+        changed since mark_current() was last called.
+        """
+        return getattr(self, 'computed_versions', None) != self.upstream_versions()
+
+    @property
+    def need_to_run_code(self):
+        """
+        True if the results of this object are stale; see is_stale().
+        Setting this attribute to True forces the results, and those
+        of anything downstream, to be recomputed, and setting it to
+        False marks them as up to date.
+        """
+        return self.is_stale()
+
+    @need_to_run_code.setter
+    def need_to_run_code(self, value):
+        if value:
+            self.bump_version()
+        else:
+            self.mark_current()
     
     def index(self, dof_str):
         """
@@ -45,6 +113,7 @@ class Optimizable():
         x = self.get_dofs()
         x[self.index(dof_str)] = newval
         self.set_dofs(x)
+        self.bump_version()
 
     def get_fixed(self, dof_str):
         """
@@ -132,7 +201,8 @@ def optimizable(obj):
     if not hasattr(obj, 'maxs'):
         obj.maxs = np.full(n, np.Inf)
     # Add the following methods from the Optimizable class:
-    for method in ['index', 'get', 'set', 'get_fixed', 'set_fixed', 'all_fixed']:
+    for method in ['index', 'get', 'set', 'get_fixed', 'set_fixed', 'all_fixed',
+                   'bump_version', 'upstream_versions', 'mark_current', 'is_stale']:
         # See https://stackoverflow.com/questions/972/adding-a-method-to-an-existing-object-instance
         setattr(obj, method, types.MethodType(getattr(Optimizable, method), obj))
 
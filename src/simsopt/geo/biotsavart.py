@@ -3,11 +3,62 @@ import simsgeopp as sgpp
 
 
 class BiotSavart():
+    """
+    The magnetic field of a set of coils. If nfp > 1 or stellsym is
+    true, coils are only the base coils, and the field also includes
+    the copies of these that are rotated by 2 pi k/nfp about the z axis,
+    and if stellsym is true their images under rotation by pi about the
+    x axis, i.e. the coils RotatedCurve(coil, 2 pi k/nfp, flip) with
+    the same currents. Instead of evaluating the copies, the field of
+    the base coils is evaluated at the inversely mapped points, and
+    rotated back.
+    """
 
-    def __init__(self, coils, coil_currents):
+    def __init__(self, coils, coil_currents, nfp=1, stellsym=False):
         assert len(coils) == len(coil_currents)
         self.coils = coils
         self.coil_currents = coil_currents
+        self.nfp = nfp
+        self.stellsym = stellsym
+        self.rotations = []
+        for k in range(nfp):
+            phi = 2 * np.pi * k / nfp
+            rotation = np.asarray([
+                [np.cos(phi), -np.sin(phi), 0],
+                [np.sin(phi), np.cos(phi), 0],
+                [0, 0, 1]
+            ])
+            self.rotations.append(rotation)
+            if stellsym:
+                self.rotations.append(np.diag([1., -1., -1.]) @ rotation)
+
+    def _rotate(self, values, rotation):
+        """
+        Apply the rotation to all vector indices of values, which has
+        shape (npoints, 3, ..., 3).
+        """
+        for axis in range(1, values.ndim):
+            values = np.moveaxis(np.tensordot(values, rotation, axes=([axis], [1])), -1, axis)
+        return values
+
+    def _map_to_base(self, values):
+        """
+        Stack Q^T x for all rotations Q, where x are the points, or the
+        vectors that are contracted with the field in a vjp.
+        """
+        if len(self.rotations) == 1:
+            return values
+        return np.ascontiguousarray(np.concatenate([self._rotate(values, rotation.T) for rotation in self.rotations]))
+
+    def _map_from_base(self, values):
+        """
+        Sum the rotated values Q y for all rotations Q, where y are
+        values computed at the points returned by _map_to_base.
+        """
+        if values is None or len(self.rotations) == 1:
+            return values
+        n = len(values) // len(self.rotations)
+        return sum(self._rotate(values[i*n:(i+1)*n], rotation) for i, rotation in enumerate(self.rotations))
 
     def clear_cached_properties(self):
         self._B = None
@@ -16,28 +67,45 @@ class BiotSavart():
         self._A = None
         self._dA_by_dX = None
         self._d2A_by_dXdX = None
+        self._dB_by_dcoilcurrents = None
+        self._d2B_by_dXdcoilcurrents = None
+        self._d3B_by_dXdXdcoilcurrents = None
 
-    def set_points(self, points):
+    def set_points(self, points, tol=None):
+        """
+        Set the points at which the field is evaluated. If tol is not
+        None, B and dB_by_dX are evaluated with a treecode, in which the
+        field of each cluster of coil quadrature points that is far from
+        the point is replaced by its multipole expansion. tol bounds the
+        relative truncation error of the expansion for each cluster, so
+        the error in the total field is usually well below tol. This is
+        faster than the direct sum for large numbers of points and
+        coils. The second derivatives and the derivatives with respect
+        to the coil currents are always computed by the direct sum.
+        """
+        if tol is not None and tol < 0:
+            raise ValueError('tol must be nonnegative')
         self.points = points
+        self.tol = tol
         self.clear_cached_properties()
         return self
 
     def B(self, compute_derivatives=0):
         if self._B is None:
             assert compute_derivatives >= 0
-            self.compute(self.points, compute_derivatives)
+            self.compute(self.points, compute_derivatives, dcoilcurrents=False, tol=self.tol)
         return self._B
 
     def dB_by_dX(self, compute_derivatives=1):
         if self._dB_by_dX is None:
             assert compute_derivatives >= 1
-            self.compute(self.points, compute_derivatives)
+            self.compute(self.points, compute_derivatives, dcoilcurrents=False, tol=self.tol)
         return self._dB_by_dX
     
     def d2B_by_dXdX(self, compute_derivatives=2):
         if self._d2B_by_dXdX is None:
             assert compute_derivatives >= 2
-            self.compute(self.points, compute_derivatives)
+            self.compute(self.points, compute_derivatives, dcoilcurrents=False, tol=self.tol)
         return self._d2B_by_dXdX
 
     def A(self, compute_derivatives = 0):
@@ -62,74 +130,83 @@ class BiotSavart():
 
 
     def compute_A(self, points, compute_derivatives=0):
+        """
+        Compute the vector potential A and its first compute_derivatives
+        derivatives at the given points.
+        """
         assert compute_derivatives <= 2
 
-        self._dA_by_dcoilcurrents      = [np.zeros((len(points), 3)) for coil in self.coils]
-        if compute_derivatives >= 1:
-            self._d2A_by_dXdcoilcurrents   = [np.zeros((len(points), 3, 3)) for coil in self.coils]
-        if compute_derivatives >= 2:
-            self._d3A_by_dXdXdcoilcurrents = [np.zeros((len(points), 3, 3, 3)) for coil in self.coils]
-        
         gammas                 = [coil.gamma() for coil in self.coils]
         dgamma_by_dphis        = [coil.gammadash() for coil in self.coils]
-        for l in range(len(self.coils)):
-            coil = self.coils[l]
-            current = self.coil_currents[l]
-            gamma = gammas[l]
-            dgamma_by_dphi = dgamma_by_dphis[l] 
-            num_coil_quadrature_points = gamma.shape[0]
-            for i, point in enumerate(points):
-                diff = point-gamma
-                dist = np.linalg.norm(diff, axis = 1)
-                self._dA_by_dcoilcurrents[l][i, :] += np.sum( (1./dist)[:, None] * dgamma_by_dphi,axis=0)
-                
-                if compute_derivatives >= 1:
-                    for j in range(3):
-                        self._d2A_by_dXdcoilcurrents[l][i, j, :] = np.sum(-(diff[:, j]/dist**3)[:, None] * dgamma_by_dphi,axis=0)
-                
-                if compute_derivatives >= 2:
-                    for j1 in range(3):
-                        for j2 in range(3):
-                            term1 = 3 * (diff[:, j1] * diff[:, j2]/dist**5)[:, None] * dgamma_by_dphi
-                            if j1 == j2:
-                                term2 = - (1./dist**3)[:, None] * dgamma_by_dphi
-                            else:
-                                term2 = 0
-                            self._d3A_by_dXdXdcoilcurrents[l][i, j1, j2, :] = np.sum(term1 + term2 , axis=0)
-
-            self._dA_by_dcoilcurrents[l] *= (1e-7/num_coil_quadrature_points)
-            if compute_derivatives >= 1:
-                self._d2A_by_dXdcoilcurrents[l] *= (1e-7/num_coil_quadrature_points)
-            if compute_derivatives >= 2:
-                self._d3A_by_dXdXdcoilcurrents[l] *= (1e-7/num_coil_quadrature_points)
-        
-        self._A = sum(self.coil_currents[i] * self._dA_by_dcoilcurrents[i] for i in range(len(self.coil_currents)))
-        if compute_derivatives >= 1:
-            self._dA_by_dX = sum(self.coil_currents[i] * self._d2A_by_dXdcoilcurrents[i] for i in range(len(self.coil_currents)))
-        if compute_derivatives >= 2:
-            self._d2A_by_dXdX = sum(self.coil_currents[i] * self._d3A_by_dXdXdcoilcurrents[i] for i in range(len(self.coil_currents)))
-        return self
+        points = self._map_to_base(points)
 
+        self._A = np.zeros((len(points), 3))
+        self._dA_by_dX = np.zeros((len(points), 3, 3)) if compute_derivatives >= 1 else np.zeros((0, 3, 3))
+        self._d2A_by_dXdX = np.zeros((len(points), 3, 3, 3)) if compute_derivatives >= 2 else np.zeros((0, 3, 3, 3))
+        sgpp.biot_savart_A(points, gammas, dgamma_by_dphis, self.coil_currents, self._A, self._dA_by_dX, self._d2A_by_dXdX)
+        if compute_derivatives < 1:
+            self._dA_by_dX = None
+        if compute_derivatives < 2:
+            self._d2A_by_dXdX = None
+        self._A = self._map_from_base(self._A)
+        self._dA_by_dX = self._map_from_base(self._dA_by_dX)
+        self._d2A_by_dXdX = self._map_from_base(self._d2A_by_dXdX)
+        return self
 
-    def compute(self, points, compute_derivatives=0):
+    def compute(self, points, compute_derivatives=0, dcoilcurrents=True, tol=None):
+        """
+        Compute B and its first compute_derivatives derivatives at the
+        given points. If dcoilcurrents is true, the field of each coil
+        for unit current is also stored, which is needed for the
+        derivatives with respect to the coil currents. Otherwise, the
+        current-weighted sum over the coils is accumulated directly in
+        the kernel, without allocating arrays for the individual coils,
+        and if tol is not None and compute_derivatives <= 1, the
+        treecode described in set_points is used.
+        """
         assert compute_derivatives <= 2
 
-        self._dB_by_dcoilcurrents    = [np.zeros((len(points), 3)) for coil in self.coils]
+        gammas                 = [coil.gamma() for coil in self.coils]
+        dgamma_by_dphis        = [coil.gammadash() for coil in self.coils]
+        points = self._map_to_base(points)
 
+        if not dcoilcurrents:
+            self._dB_by_dcoilcurrents = None
+            self._d2B_by_dXdcoilcurrents = None
+            self._d3B_by_dXdXdcoilcurrents = None
+            self._B = np.zeros((len(points), 3))
+            self._dB_by_dX = np.zeros((len(points), 3, 3)) if compute_derivatives >= 1 else np.zeros((0, 3, 3))
+            self._d2B_by_dXdX = np.zeros((len(points), 3, 3, 3)) if compute_derivatives >= 2 else np.zeros((0, 3, 3, 3))
+            if tol is not None and compute_derivatives <= 1:
+                sgpp.biot_savart_tree(points, gammas, dgamma_by_dphis, self.coil_currents, self._B, self._dB_by_dX, tol)
+            else:
+                sgpp.biot_savart_fused(points, gammas, dgamma_by_dphis, self.coil_currents, self._B, self._dB_by_dX, self._d2B_by_dXdX)
+            if compute_derivatives < 1:
+                self._dB_by_dX = None
+            if compute_derivatives < 2:
+                self._d2B_by_dXdX = None
+            self._B = self._map_from_base(self._B)
+            self._dB_by_dX = self._map_from_base(self._dB_by_dX)
+            self._d2B_by_dXdX = self._map_from_base(self._d2B_by_dXdX)
+            return self
+
+        self._dB_by_dcoilcurrents    = [np.zeros((len(points), 3)) for coil in self.coils]
         if compute_derivatives >= 1:
             self._d2B_by_dXdcoilcurrents = [np.zeros((len(points), 3, 3)) for coil in self.coils]
         else:
-            self._d2B_by_dXdcoilcurrents = []
-
+            self._d2B_by_dXdcoilcurrents = None
         if compute_derivatives >= 2:
             self._d3B_by_dXdXdcoilcurrents = [np.zeros((len(points), 3, 3, 3)) for coil in self.coils]
         else:
-            self._d3B_by_dXdXdcoilcurrents = []
+            self._d3B_by_dXdXdcoilcurrents = None
 
-        gammas                 = [coil.gamma() for coil in self.coils]
-        dgamma_by_dphis        = [coil.gammadash() for coil in self.coils]
-
-        sgpp.biot_savart(points, gammas, dgamma_by_dphis, self._dB_by_dcoilcurrents, self._d2B_by_dXdcoilcurrents, self._d3B_by_dXdXdcoilcurrents)
+        sgpp.biot_savart(points, gammas, dgamma_by_dphis, self._dB_by_dcoilcurrents,
+                         self._d2B_by_dXdcoilcurrents or [], self._d3B_by_dXdXdcoilcurrents or [])
+        self._dB_by_dcoilcurrents = [self._map_from_base(B) for B in self._dB_by_dcoilcurrents]
+        if compute_derivatives >= 1:
+            self._d2B_by_dXdcoilcurrents = [self._map_from_base(dB) for dB in self._d2B_by_dXdcoilcurrents]
+        if compute_derivatives >= 2:
+            self._d3B_by_dXdXdcoilcurrents = [self._map_from_base(d2B) for d2B in self._d3B_by_dXdXdcoilcurrents]
 
         self._B = sum(self.coil_currents[i] * self._dB_by_dcoilcurrents[i] for i in range(len(self.coil_currents)))
         if compute_derivatives >= 1:
@@ -166,7 +243,7 @@ class BiotSavart():
         n = len(self.coils)
         coils = self.coils
         res_B = [np.zeros((coils[i].num_dofs(), )) for i in range(n)]
-        sgpp.biot_savart_vjp(self.points, gammas, dgamma_by_dphis, currents, v, [], dgamma_by_dcoeffs, d2gamma_by_dphidcoeffs, res_B, [])
+        sgpp.biot_savart_vjp(self._map_to_base(self.points), gammas, dgamma_by_dphis, currents, self._map_to_base(v), [], dgamma_by_dcoeffs, d2gamma_by_dphidcoeffs, res_B, [])
         return res_B
 
     def B_and_dB_vjp(self, v, vgrad):
@@ -179,9 +256,34 @@ class BiotSavart():
         coils = self.coils
         res_B = [np.zeros((coils[i].num_dofs(), )) for i in range(n)]
         res_dB = [np.zeros((coils[i].num_dofs(), )) for i in range(n)]
-        sgpp.biot_savart_vjp(self.points, gammas, dgamma_by_dphis, currents, v, vgrad, dgamma_by_dcoeffs, d2gamma_by_dphidcoeffs, res_B, res_dB)
+        sgpp.biot_savart_vjp(self._map_to_base(self.points), gammas, dgamma_by_dphis, currents, self._map_to_base(v), self._map_to_base(vgrad), dgamma_by_dcoeffs, d2gamma_by_dphidcoeffs, res_B, res_dB)
         return (res_B, res_dB)
 
+    def A_vjp(self, v):
+        gammas                 = [coil.gamma() for coil in self.coils]
+        dgamma_by_dphis        = [coil.gammadash() for coil in self.coils]
+        currents = self.coil_currents
+        dgamma_by_dcoeffs      = [coil.dgamma_by_dcoeff() for coil in self.coils]
+        d2gamma_by_dphidcoeffs = [coil.dgammadash_by_dcoeff() for coil in self.coils]
+        n = len(self.coils)
+        coils = self.coils
+        res_A = [np.zeros((coils[i].num_dofs(), )) for i in range(n)]
+        sgpp.biot_savart_vjp_A(self._map_to_base(self.points), gammas, dgamma_by_dphis, currents, self._map_to_base(v), [], dgamma_by_dcoeffs, d2gamma_by_dphidcoeffs, res_A, [])
+        return res_A
+
+    def A_and_dA_vjp(self, v, vgrad):
+        gammas                 = [coil.gamma() for coil in self.coils]
+        dgamma_by_dphis        = [coil.gammadash() for coil in self.coils]
+        currents = self.coil_currents
+        dgamma_by_dcoeffs      = [coil.dgamma_by_dcoeff() for coil in self.coils]
+        d2gamma_by_dphidcoeffs = [coil.dgammadash_by_dcoeff() for coil in self.coils]
+        n = len(self.coils)
+        coils = self.coils
+        res_A = [np.zeros((coils[i].num_dofs(), )) for i in range(n)]
+        res_dA = [np.zeros((coils[i].num_dofs(), )) for i in range(n)]
+        sgpp.biot_savart_vjp_A(self._map_to_base(self.points), gammas, dgamma_by_dphis, currents, self._map_to_base(v), self._map_to_base(vgrad), dgamma_by_dcoeffs, d2gamma_by_dphidcoeffs, res_A, res_dA)
+        return (res_A, res_dA)
+
     # def compute_by_dcoilcoeff(self, points):
     #     self.dB_by_dcoilcoeffs    = [np.zeros((len(points), 3, coil.num_dofs())) for coil in self.coils]
     #     self.d2B_by_dXdcoilcoeffs = [np.zeros((len(points), 3, 3, coil.num_dofs())) for coil in self.coils]
@@ -21,5 +21,7 @@ class CurveRZFourier(sgpp.CurveRZFourier, Curve):
 
     def set_dofs(self, dofs):
         sgpp.CurveRZFourier.set_dofs(self, dofs)
+        self.bump_version()
         for d in self.dependencies:
             d.invalidate_cache()
+            d.bump_version()
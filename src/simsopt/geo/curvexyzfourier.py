@@ -17,8 +17,10 @@ class CurveXYZFourier(sgpp.CurveXYZFourier, Curve):
 
     def set_dofs(self, dofs):
         sgpp.CurveXYZFourier.set_dofs(self, dofs)
+        self.bump_version()
         for d in self.dependencies:
             d.invalidate_cache()
+            d.bump_version()
 
     # def kappa_impl(self, kappa):
     #     Curve.kappa_impl(self, kappa)
@@ -0,0 +1,115 @@
+import numpy as np
+import simsgeopp as sgpp
+
+
+class InterpolatedField():
+    """
+    A surrogate for a magnetic field, e.g. a BiotSavart object, that
+    interpolates the field on a regular grid in cylindrical coordinates
+    (r, phi, z). The field is sampled once at the nodes of the grid,
+    which is much cheaper than evaluating the Biot-Savart law at many
+    points, e.g. for field line or particle tracing.
+
+    The grid has nr, nphi and nz cells in the ranges rrange =
+    (rmin, rmax), phi in [0, 2 pi/nfp] and zrange = (zmin, zmax), and
+    in each cell the field is interpolated by a tensor product
+    polynomial of the given degree, e.g. tricubic for degree 3. If
+    stellsym is true, the field is assumed to be stellarator symmetric,
+    so phi only has to cover [0, pi/nfp] and zrange has to be symmetric
+    about 0. dB_by_dX is the derivative of the interpolant. Points
+    outside the grid give nan. The points at which field is evaluated,
+    set with its set_points(), are restored after it is sampled.
+    """
+
+    def __init__(self, field, rrange, zrange, nr, nphi, nz, degree=3, nfp=1, stellsym=False):
+        rmin, rmax = rrange
+        zmin, zmax = zrange
+        if stellsym and zmin != -zmax:
+            raise ValueError('For stellarator symmetric fields, zrange has to be symmetric about 0')
+        self.field = field
+        self.points = None
+        self.clear_cached_properties()
+        self.interpolant = sgpp.CylindricalFieldInterpolant(rmin, rmax, nr, nphi, zmin, zmax, nz, degree, nfp, stellsym)
+
+        rs = np.asarray(self.interpolant.nodes(0))
+        phis = np.asarray(self.interpolant.nodes(1))
+        zs = np.asarray(self.interpolant.nodes(2))
+        r, phi, z = np.meshgrid(rs, phis, zs, indexing='ij')
+        r, phi, z = r.flatten(), phi.flatten(), z.flatten()
+        points = np.stack((r * np.cos(phi), r * np.sin(phi), z), axis=1)
+        B = self.field_B(points)
+        values = np.stack((
+            B[:, 0] * np.cos(phi) + B[:, 1] * np.sin(phi),
+            -B[:, 0] * np.sin(phi) + B[:, 1] * np.cos(phi),
+            B[:, 2]), axis=1)
+        self.interpolant.set_values(values)
+
+    def clear_cached_properties(self):
+        self._B = None
+        self._dB_by_dX = None
+
+    def set_points(self, points):
+        self.points = points
+        self.clear_cached_properties()
+        return self
+
+    def B(self, compute_derivatives=0):
+        if self._B is None:
+            assert compute_derivatives >= 0
+            self.compute(self.get_points(), compute_derivatives)
+        return self._B
+
+    def dB_by_dX(self, compute_derivatives=1):
+        if self._dB_by_dX is None:
+            assert compute_derivatives >= 1
+            self.compute(self.get_points(), compute_derivatives)
+        return self._dB_by_dX
+
+    def get_points(self):
+        if self.points is None:
+            raise RuntimeError('set_points() must be called before the field is evaluated')
+        return self.points
+
+    def field_B(self, points):
+        """
+        Evaluate the field that is interpolated at the given points,
+        and restore its previous points (and tol, for a BiotSavart
+        object) afterwards.
+        """
+        old_points = getattr(self.field, 'points', None)
+        old_tol = getattr(self.field, 'tol', None)
+        self.field.set_points(points)
+        try:
+            return self.field.B()
+        finally:
+            if old_tol is not None:
+                self.field.set_points(old_points, tol=old_tol)
+            elif old_points is not None:
+                self.field.set_points(old_points)
+
+    def compute(self, points, compute_derivatives=0):
+        assert compute_derivatives <= 1
+        if compute_derivatives >= 1:
+            self._B, self._dB_by_dX = self.interpolant.evaluate_with_derivative(points)
+        else:
+            self._B = self.interpolant.evaluate(points)
+            self._dB_by_dX = None
+        return self
+
+    def estimate_error(self, npoints=1000, seed=1):
+        """
+        Estimate the interpolation error by comparing with the field at
+        npoints random points in the grid. Returns the maximum and the
+        mean of |B_interp - B| / |B|.
+        """
+        rmin, rmax = self.interpolant.nodes(0)[0], self.interpolant.nodes(0)[-1]
+        zmin, zmax = self.interpolant.nodes(2)[0], self.interpolant.nodes(2)[-1]
+        rng = np.random.default_rng(seed)
+        r = rng.uniform(rmin, rmax, size=(npoints, ))
+        phi = rng.uniform(0, 2*np.pi, size=(npoints, ))
+        z = rng.uniform(zmin, zmax, size=(npoints, ))
+        points = np.stack((r * np.cos(phi), r * np.sin(phi), z), axis=1)
+        B = self.field_B(points)
+        B_interp = self.interpolant.evaluate(points)
+        err = np.linalg.norm(B_interp - B, axis=1) / np.linalg.norm(B, axis=1)
+        return np.max(err), np.mean(err)
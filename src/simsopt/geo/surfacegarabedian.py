@@ -78,6 +78,7 @@ class SurfaceGarabedian(Surface):
         self.Delta[m - self.mmin, n - self.nmin] = val
         self.recalculate = True
         self.recalculate_derivs = True
+        self.bump_version()
 
     def get_dofs(self):
         """
@@ -104,6 +105,7 @@ class SurfaceGarabedian(Surface):
         logger.info('set_dofs called, and at least one dof changed')
         self.recalculate = True
         self.recalculate_derivs = True
+        self.bump_version()
 
         self.Delta = v.reshape((self.mmax - self.mmin + 1, self.nmax - self.nmin + 1), order='F')
 
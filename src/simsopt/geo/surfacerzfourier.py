@@ -103,6 +103,7 @@ class SurfaceRZFourier(sgpp.SurfaceRZFourier, Surface):
         self.allocate()
         if mpol < old_mpol or ntor < old_ntor:
             self.invalidate_cache()
+        self.bump_version()
 
         min_mpol = np.min((mpol, old_mpol))
         min_ntor = np.min((ntor, old_ntor))
@@ -182,6 +183,7 @@ class SurfaceRZFourier(sgpp.SurfaceRZFourier, Surface):
         self.rc[m, n + self.ntor] = val
         self.recalculate = True
         self.recalculate_derivs = True
+        self.bump_version()
 
     def set_rs(self, m, n, val):
         """
@@ -194,6 +196,7 @@ class SurfaceRZFourier(sgpp.SurfaceRZFourier, Surface):
         self.rs[m, n + self.ntor] = val
         self.recalculate = True
         self.recalculate_derivs = True
+        self.bump_version()
 
     def set_zc(self, m, n, val):
         """
@@ -206,6 +209,7 @@ class SurfaceRZFourier(sgpp.SurfaceRZFourier, Surface):
         self.zc[m, n + self.ntor] = val
         self.recalculate = True
         self.recalculate_derivs = True
+        self.bump_version()
 
     def set_zs(self, m, n, val):
         """
@@ -215,6 +219,7 @@ class SurfaceRZFourier(sgpp.SurfaceRZFourier, Surface):
         self.zs[m, n + self.ntor] = val
         self.recalculate = True
         self.recalculate_derivs = True
+        self.bump_version()
 
     def fixed_range(self, mmin, mmax, nmin, nmax, fixed=True):
         """
@@ -11,6 +11,7 @@ import logging
 from typing import Union, Iterable
 
 import numpy as np
+from mpi4py import MPI
 
 booz_xform_found = True
 try:
@@ -23,6 +24,14 @@ from simsopt.mhd import Vmec
 
 logger = logging.getLogger(__name__)
 
+# Outputs of booz_xform with one column (or entry) per surface, which
+# are gathered from the procs of a group after a parallel run. The
+# names ending in ns_b / nc_b for the other parity are only present
+# for non-stellarator-symmetric configurations.
+BOOZ_XFORM_OUTPUTS = ['bmnc_b', 'rmnc_b', 'zmns_b', 'numns_b', 'gmnc_b',
+                      'bmns_b', 'rmns_b', 'zmnc_b', 'numnc_b', 'gmns_b',
+                      'Boozer_G', 'Boozer_I']
+
 # This next function can be deleted I think.
 def closest_index(grid: Iterable[float], val: float) -> int:
     """
@@ -45,11 +54,22 @@ class Boozer(Optimizable):
     the run() method is called, the Boozer transformation is carried
     out on all these surfaces. The registry can be cleared at any time
     by setting the s attribute to {}.
+
+    If parallel is True, the surfaces, which are independent, are
+    divided among the procs of the MPI group, each of which runs
+    booz_xform on its share. The results are gathered on the group
+    leader with a collective operation, so all procs in the group
+    must then call run(), as they do when evaluating the functions of
+    an optimization problem. If run() is called only on the group
+    leaders, e.g. to evaluate the functions on proc0_world alone,
+    parallel must be False, in which case the group leaders compute
+    all the surfaces and the other procs do nothing.
     """
     def __init__(self,
                  equil: Vmec,
                  mpol: int = 32,
-                 ntor: int = 32) -> None:
+                 ntor: int = 32,
+                 parallel: bool = True) -> None:
         """
         Constructor
         """
@@ -64,7 +84,7 @@ class Boozer(Optimizable):
         self.ntor = ntor
         self.bx = booz_xform.Booz_xform()
         self.s = set()
-        self.need_to_run_code = True
+        self.parallel = parallel
         self._calls = 0 # For testing, keep track of how many times we call bx.run()
 
         # We may at some point want to allow booz_xform to use a
@@ -80,7 +100,7 @@ class Boozer(Optimizable):
         return np.array([])
 
     def set_dofs(self, x):
-        self.need_to_run_code = True
+        pass
         
     def register(self, s: Union[float, Iterable[float]]) -> None:
         """
@@ -103,18 +123,20 @@ class Boozer(Optimizable):
                                  "in the interval [0, 1]")
         logger.info("Adding entries to Boozer registry: {}".format(ss))
         self.s = self.s.union(ss)
-        self.need_to_run_code = True
+        self.bump_version()
 
     def run(self):
         """
         Run booz_xform on all the surfaces that have been registered.
+        If self.parallel is True, all procs in the group must call
+        this function.
         """
         
-        if (self.mpi is not None) and (not self.mpi.proc0_groups):
+        if (not self.parallel) and (self.mpi is not None) and (not self.mpi.proc0_groups):
             logger.info("This proc is skipping Boozer.run since it is not a group leader.")
             return
             
-        if not self.need_to_run_code:
+        if not self.is_stale():
             logger.info("Boozer.run() called but no need to re-run Boozer transformation.")
             return
         
@@ -172,8 +194,6 @@ class Boozer(Optimizable):
             self.bx.mnmax = wout.mnmax
             self.bx.xm = wout.xm
             self.bx.xn = wout.xn
-            print('mnmax:', wout.mnmax, ' len(xm):', len(wout.xm), ' len(xn):', len(wout.xn))
-            print('mnmax_nyq:', wout.mnmax_nyq, ' len(xm_nyq):', len(wout.xm_nyq), ' len(xn_nyq):', len(wout.xn_nyq))
             assert len(wout.xm) == wout.mnmax
             assert len(wout.xn) == wout.mnmax
             assert len(self.bx.xm) == self.bx.mnmax
@@ -232,11 +252,74 @@ class Boozer(Optimizable):
             raise ValueError("equil is not an equilibrium type supported by"
                              "Boozer")
         
-        logger.info("About to call booz_xform.Booz_xform.run().")
-        self.bx.run()
+        comm = None if self.mpi is None else self.mpi.comm_groups
+        if (not self.parallel) or comm is None or comm.size == 1:
+            logger.info("About to call booz_xform.Booz_xform.run().")
+            self.bx.run()
+            logger.info("Returned from calling booz_xform.Booz_xform.run().")
+        else:
+            # Surfaces are assigned round-robin, so each proc gets a
+            # similar mix of inner and outer surfaces:
+            my_surfs = compute_surfs[comm.rank::comm.size]
+            if len(my_surfs) > 0:
+                self.bx.compute_surfs = my_surfs
+                logger.info("About to call booz_xform.Booz_xform.run() for "
+                            "surfaces {}.".format(my_surfs))
+                self.bx.run()
+                logger.info("Returned from calling booz_xform.Booz_xform.run().")
+            self.gather_surfaces(comm, compute_surfs)
         self._calls += 1
-        logger.info("Returned from calling booz_xform.Booz_xform.run().")
-        self.need_to_run_code = False
+        self.mark_current()
+
+    def gather_surfaces(self, comm, compute_surfs):
+        """
+        After each proc of comm has run booz_xform on its share of
+        compute_surfs, assigned round-robin, gather the results on
+        rank 0 of comm and store them in self.bx, so they appear as if
+        all the surfaces had been computed there.
+        """
+        nsurfs = len(compute_surfs)
+        if nsurfs == 0:
+            return
+        my_nsurfs = len(compute_surfs[comm.rank::comm.size])
+        # Rank 0 always has at least one surface, so it knows the
+        # size of each output:
+        names = [name for name in BOOZ_XFORM_OUTPUTS
+                 if hasattr(self.bx, name) and np.size(getattr(self.bx, name)) > 0]
+        names = comm.bcast(names if comm.rank == 0 else None, root=0)
+        # Pack this proc's outputs into one row per surface:
+        if my_nsurfs > 0:
+            columns = [np.reshape(getattr(self.bx, name), (-1, my_nsurfs)) for name in names]
+            sizes = [column.shape[0] for column in columns]
+            sendbuf = np.ascontiguousarray(np.concatenate(columns).T)
+        else:
+            sizes = None
+            sendbuf = np.zeros((0, 0))
+        sizes = comm.bcast(sizes, root=0)
+
+        if comm.rank != 0:
+            comm.Gatherv(sendbuf, None, root=0)
+            return
+
+        nrows = sum(sizes)
+        counts = np.array([len(compute_surfs[r::comm.size]) * nrows
+                           for r in range(comm.size)])
+        displacements = np.concatenate(([0], np.cumsum(counts[:-1])))
+        recvbuf = np.empty((nsurfs, nrows))
+        comm.Gatherv(sendbuf, [recvbuf, counts, displacements, MPI.DOUBLE], root=0)
+        # Put the surfaces back in the order of compute_surfs:
+        order = np.concatenate([np.arange(r, nsurfs, comm.size) for r in range(comm.size)])
+        results = np.empty_like(recvbuf)
+        results[order, :] = recvbuf
+
+        self.bx.compute_surfs = compute_surfs
+        start = 0
+        for name, size in zip(names, sizes):
+            result = results[:, start:start + size].T
+            if np.ndim(getattr(self.bx, name)) == 1:
+                result = result.flatten()
+            setattr(self.bx, name, result)
+            start += size
         
         
 class Quasisymmetry(Optimizable):
@@ -281,105 +364,109 @@ class Quasisymmetry(Optimizable):
         return np.array([])
 
     def set_dofs(self, x):
-        self.need_to_run_code = True
+        pass
 
     def J(self) -> Iterable:
         """
         Carry out the calculation of the quasisymmetry error.
         """
 
-        # Only group leaders do anything:
+        # The next line is the expensive part of the calculation. If
+        # boozer.parallel is True, all procs in the group take part,
+        # since the surfaces are divided among them:
+        self.boozer.run()
+
+        # Only group leaders do anything else:
         if (self.boozer.mpi is not None) and (not self.boozer.mpi.proc0_groups):
             logger.info("This proc is skipping Quasisymmetry.J since it is not a group leader.")
             return np.array([])
-        
-        # The next line is the expensive part of the calculation:
-        self.boozer.run()
-        
-        symmetry_error = []
-        for js, s in enumerate(self.s):
-            index = self.boozer.s_to_index[s]
-            bmnc = self.boozer.bx.bmnc_b[:, index]
-            xm = self.boozer.bx.xm_b
-            xn = self.boozer.bx.xn_b / self.boozer.bx.nfp
-
-            if self.m != 0 and self.m != 1:
-                raise ValueError("m for quasisymmetry should be 0 or 1.")
-
-            # Find the indices of the symmetric modes:
-            if self.n == 0:
-                # Quasi-axisymmetry
-                symmetric = (xn == 0)
 
-            elif self.m == 0:
-                # Quasi-poloidal symmetry
-                symmetric = (xm == 0)
+        if self.normalization not in ["B00", "symmetric"]:
+            raise ValueError("Unrecognized value for normalization in Quasisymmetry")
+        if self.weight not in ["even", "stellopt", "stellopt_ornl"]:
+            raise ValueError("Unrecognized value for weight in Quasisymmetry")
 
-            else:
-                # Quasi-helical symmetry
-                symmetric = (xm * self.n + xn * self.m == 0)
-                # Stellopt takes the "and" of this with mod(xm, self.m),
-                # which does not seem necessary since self.m must be 1 to
-                # get here.
-            nonsymmetric = np.logical_not(symmetric)
-
-            # Scale all bmnc modes so the average |B| is 1 or close to 1:
-
-            if self.normalization == "B00":
-                # Normalize by the (m,n) = (0,0) mode amplitude:
-                assert xm[0] == 0
-                assert xn[0] == 0
-                bnorm = bmnc[0]
-
-            elif self.normalization == "symmetric":
-                # Normalize by sqrt(sum_{symmetric modes} B{m,n}^2)
-                temp = bmnc[symmetric]
-                bnorm = np.sqrt(np.dot(temp, temp))
-
-            else:
-                raise ValueError("Unrecognized value for normalization in Quasisymmetry")
+        bx = self.boozer.bx
+        symmetric, nonsymmetric = self.mode_masks(bx.xm_b, bx.xn_b, bx.nfp)
 
-            logger.info("For s={}, bnorm={}".format(s, bnorm))
-            bmnc = bmnc / bnorm
+        # Columns of bmnc for all the surfaces at once:
+        indices = [self.boozer.s_to_index[s] for s in self.s]
+        bmnc = bx.bmnc_b[:, indices]
 
-            # Apply any weight that depends on m and/or n:
+        # Scale all bmnc modes so the average |B| is 1 or close to 1:
+        if self.normalization == "B00":
+            # Normalize by the (m,n) = (0,0) mode amplitude:
+            assert bx.xm_b[0] == 0
+            assert bx.xn_b[0] == 0
+            bnorm = bmnc[0, :]
+        else:
+            # Normalize by sqrt(sum_{symmetric modes} B{m,n}^2)
+            temp = bmnc[symmetric, :]
+            bnorm = np.sqrt(np.sum(temp * temp, axis=0))
+        logger.info("For s={}, bnorm={}".format(self.s, bnorm))
+        bmnc = bmnc[nonsymmetric, :] / bnorm
+
+        # Apply any weight that depends on m and/or n:
+        if self.weight == "stellopt":
+            # Stellopt appears to apply a m-dependent radial
+            # weight, assuming sigma > 0. However, the m is
+            # evaluated outside of any loop over m, so m ends up
+            # taking the value mboz instead of the actual m for
+            # each mode. As a result, there is an even weight by s_used**2.
+            s_used = np.array([self.boozer.s_used[s] for s in self.s])
+            logger.info('s_used, in Quasisymmetry: {}'.format(s_used))
+            bmnc = bmnc / (s_used * s_used)
+
+        elif self.weight == "stellopt_ornl":
+            # This option is similar to "stellopt" except we
+            # return a single number for the residual instead of a
+            # vector of residuals.
+
+            # For this option, stellopt applies a m-dependent
+            # radial weight only when sigma < 0, the opposite of
+            # when using the non-ORNL helicity! Here, we do not
+            # apply such a weight.
+            bmnc = np.sqrt(np.sum(bmnc * bmnc, axis=0, keepdims=True))
+
+        # Evenly weight each bmnc mode. The residuals for each surface
+        # are contiguous:
+        return bmnc.T.flatten()
+
+    def mode_masks(self, xm, xn, nfp):
+        """
+        Return boolean arrays (symmetric, nonsymmetric) selecting the
+        Boozer harmonics that are consistent or inconsistent with the
+        symmetry (m, n) of this target. The masks only depend on m, n
+        and the resolution of the Boozer transformation, so they are
+        computed once and re-used until one of these changes.
+        """
+        if self.m != 0 and self.m != 1:
+            raise ValueError("m for quasisymmetry should be 0 or 1.")
 
-            if self.weight == "even":
-                # Evenly weight each bmnc mode. Normalize by the m=n=0 mode on that surface.
-                symmetry_error.append(bmnc[nonsymmetric])
+        # The last mode has the largest m and n, so together with the
+        # number of modes and nfp it identifies the resolution:
+        key = (self.m, self.n, len(xm), nfp, xm[-1], xn[-1])
+        if getattr(self, 'mode_masks_key', None) == key:
+            return self.symmetric, self.nonsymmetric
 
-            elif self.weight == "stellopt":
-                # Stellopt appears to apply a m-dependent radial
-                # weight, assuming sigma > 0. However, the m is
-                # evaluated outside of any loop over m, so m ends up
-                # taking the value mboz instead of the actual m for
-                # each mode. As a result, there is an even weight by s_used**2.
-                
-                s_used = self.boozer.s_used[s]
-                logger.info('s_used, in Quasisymmetry: {}'.format(s_used))
-                """
-                rad_sigma = np.full(len(xm), s_used * s_used)
-                rad_sigma[xm < 3] = s_used
-                rad_sigma[xm == 3] = s_used ** 1.5
-                """
-                rad_sigma = s_used * s_used
-                temp = bmnc / rad_sigma
-                symmetry_error.append(temp[nonsymmetric])
-
-            elif self.weight == "stellopt_ornl":
-                # This option is similar to "stellopt" except we
-                # return a single number for the residual instead of a
-                # vector of residuals.
-
-                # For this option, stellopt applies a m-dependent
-                # radial weight only when sigma < 0, the opposite of
-                # when using the non-ORNL helicity! Here, we do not
-                # apply such a weight.
-                
-                temp = bmnc[nonsymmetric]
-                symmetry_error.append(np.array([np.sqrt(np.sum(temp * temp))]))
+        xn = xn / nfp
+        # Find the indices of the symmetric modes:
+        if self.n == 0:
+            # Quasi-axisymmetry
+            symmetric = (xn == 0)
 
-            else:
-                raise ValueError("Unrecognized value for weight in Quasisymmetry")
+        elif self.m == 0:
+            # Quasi-poloidal symmetry
+            symmetric = (xm == 0)
 
-        return np.array(symmetry_error).flatten()
+        else:
+            # Quasi-helical symmetry
+            symmetric = (xm * self.n + xn * self.m == 0)
+            # Stellopt takes the "and" of this with mod(xm, self.m),
+            # which does not seem necessary since self.m must be 1 to
+            # get here.
+
+        self.symmetric = symmetric
+        self.nonsymmetric = np.logical_not(symmetric)
+        self.mode_masks_key = key
+        return self.symmetric, self.nonsymmetric
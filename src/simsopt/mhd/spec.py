@@ -139,7 +139,6 @@ class Spec(Optimizable):
         self.nml._rectify_namelist()
         
         self.depends_on = ["boundary"]
-        self.need_to_run_code = True
         self.counter = 0
 
         # By default, all dofs owned by SPEC directly, as opposed to
@@ -152,7 +151,7 @@ class Spec(Optimizable):
                          self.nml['physicslist']['curtor']])
 
     def set_dofs(self, x):
-        self.need_to_run_code = True
+        self.bump_version()
         self.nml['physicslist']['phiedge'] = x[0]
         self.nml['physicslist']['curtor'] = x[1]
 
@@ -165,7 +164,7 @@ class Spec(Optimizable):
         """
         Run SPEC, if needed.
         """
-        if not self.need_to_run_code:
+        if not self.is_stale():
             logger.info("run() called but no need to re-run SPEC.")
             return
         logger.info("Preparing to run SPEC.")
@@ -211,7 +210,7 @@ class Spec(Optimizable):
                                     filename=filename, force=True)
         logger.info("SPEC run complete.")
         self.counter += 1
-        self.need_to_run_code = False
+        self.mark_current()
 
     def volume(self):
         """
@@ -262,19 +261,18 @@ class Residue(Optimizable):
         self.s_min = s_min
         self.s_max = s_max
         self.depends_on = ['spec']
-        self.need_to_run_code = True
         self.fixed_point = None
 
     def J(self):
         """
         Run Spec if needed, find the periodic field line, and return the residue
         """
-        if self.need_to_run_code:
+        if self.is_stale():
             self.spec.run()
             specb = pyoculus.problems.SPECBfield(self.spec.results, self.vol)
             fp = pyoculus.solvers.FixedPoint(specb, {'theta':self.theta}, integrator_params={'rtol':self.rtol})
             self.fixed_point = fp.compute(self.s_guess, sbegin=self.s_min, send=self.s_max, pp=self.pp, qq=self.qq)
-            self.need_to_run_code = False
+            self.mark_current()
 
         return self.fixed_point.GreenesResidue
     
@@ -282,4 +280,4 @@ class Residue(Optimizable):
         return np.array([])
 
     def set_dofs(self, x):
-        self.need_to_run_code = True
+        pass
@@ -6,6 +6,7 @@
 This module provides a class that handles the VMEC equilibrium code.
 """
 
+import itertools
 import logging
 import os.path
 
@@ -23,9 +24,15 @@ from simsopt.core.optimizable import Optimizable, optimizable
 from simsopt.geo.surfacerzfourier import SurfaceRZFourier
 from simsopt.core.util import Struct
 from simsopt.util.mpi import MpiPartition
+from simsopt.mhd.vmec_cache import VmecCache, hash_state
 
 logger = logging.getLogger(__name__)
 
+# Numbers the VMEC runs in this process, so the output files of
+# different Vmec objects with the same input file do not collide. All
+# procs in a group run VMEC together, so their counters agree.
+run_counter = itertools.count(1)
+
 # Flags used by runvmec():
 restart_flag = 1
 readin_flag = 2
@@ -68,14 +75,93 @@ reset_jacdt_flag = 32
 #                        control its own run history
 
 
+class LazyWout:
+    """
+    This class gives access to the variables in a VMEC wout file,
+    reading each variable from the memory-mapped netcdf file only when
+    it is first accessed, and keeping it for subsequent accesses. For
+    instance if only the aspect ratio is needed, the large arrays of
+    Fourier amplitudes are never loaded.
+
+    Variables are accessed as attributes, e.g. wout.rmnc. Arrays
+    that depend on radius and mode number are transposed to (mode,
+    radius) order. The file stays open until this object is garbage
+    collected, or until load() is called, which reads all remaining
+    variables.
+    """
+
+    # Attribute names that differ from the netcdf variable names:
+    netcdf_names = {'lasym': 'lasym__logical__',
+                    'volume': 'volume_p'}
+    attribute_names = {val: key for key, val in netcdf_names.items()}
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._netcdf = netcdf.netcdf_file(filename, mmap=True)
+        if self.ier_flag != 0:
+            logger.info("VMEC did not succeed!")
+            raise RuntimeError("VMEC did not succeed")
+
+    def __getattr__(self, name):
+        # __getattr__ is only called for attributes that have not
+        # been set yet, i.e. variables not yet read from the file.
+        if name.startswith('_'):
+            raise AttributeError(name)
+        netcdf_name = self.netcdf_names.get(name, name)
+        if self._netcdf is None or netcdf_name not in self._netcdf.variables:
+            raise AttributeError("wout file {} has no variable {}".format(
+                self.filename, netcdf_name))
+        # Copy the data, so no references to the memory map remain:
+        val = np.array(self._netcdf.variables[netcdf_name][()])
+        if val.ndim == 0:
+            val = val[()]
+        elif val.ndim == 2:
+            val = val.transpose()
+        setattr(self, name, val)
+        return val
+
+    def load(self):
+        """
+        Read all variables that have not been read yet, and close the
+        file. This must be done before the file is deleted or
+        overwritten.
+        """
+        if self._netcdf is None:
+            return
+        for netcdf_name in list(self._netcdf.variables):
+            getattr(self, self.attribute_names.get(netcdf_name, netcdf_name))
+        self._netcdf.close()
+        self._netcdf = None
+
+
 class Vmec(Optimizable):
     """
     This class represents the VMEC equilibrium code.
     """
 
-    def __init__(self, filename=None, mpi=None):
+    def __init__(self, filename=None, mpi=None, cache=None, warm_start=False,
+                 wout_in_memory=False):
         """
         Constructor
+
+        filename: VMEC input file to use to initialize parameters.
+        mpi: An MpiPartition. If None, one group is used.
+        cache: An optional VmecCache. If supplied, run() will re-use
+          stored equilibria instead of running VMEC again for inputs
+          that have been run before.
+        warm_start: If True, each VMEC run is started from the nearest
+          equilibrium in the cache, rather than from scratch. If no cache
+          is given, one is created. While warm starts are enabled, the
+          final ftol of every run is multiplied by
+          warm_start_ftol_factor, so results do not depend noticeably on
+          the starting point. Warm starts are only attempted if the
+          distance to the nearest equilibrium is at most
+          warm_start_max_distance (None for no limit).
+        wout_in_memory: If True, VMEC's output is loaded into the fortran
+          read_wout_mod module and accessed there directly, rather than
+          being parsed from the netcdf file in python, and the wout file
+          is deleted after it has been read. Set the keep_wout_files
+          attribute to True to keep the files, e.g. for archival.
         """
         if not vmec_found:
             raise RuntimeError(
@@ -92,6 +178,18 @@ class Vmec(Optimizable):
         else:
             logger.info("Initializing a VMEC object from file: " + filename)
         self.input_file = filename
+        if warm_start and cache is None:
+            cache = VmecCache()
+        self.cache = cache
+        self.warm_start = warm_start
+        self.warm_start_ftol_factor = 0.01
+        self.warm_start_max_distance = None
+        self.wout_in_memory = wout_in_memory
+        self.keep_wout_files = not wout_in_memory
+        # Other input parameters, e.g. profiles, come from the input
+        # file, so its contents are part of the cache key:
+        with open(filename, 'r') as f:
+            self.input_hash = hash_state(f.read())
 
         # Get MPI communicator:
         if mpi is None:
@@ -159,7 +257,6 @@ class Vmec(Optimizable):
                 self.boundary.zs[m, n + vi.ntor] = vi.zbs[101 + n, m]
         # Handle a few variables that are not Parameters:
         self.depends_on = ["boundary"]
-        self.need_to_run_code = True
 
         self.fixed = np.full(len(self.get_dofs()), True)
         self.names = ['delt', 'tcon0', 'phiedge', 'curtor', 'gamma']
@@ -169,7 +266,7 @@ class Vmec(Optimizable):
             [self.delt, self.tcon0, self.phiedge, self.curtor, self.gamma])
 
     def set_dofs(self, x):
-        self.need_to_run_code = True
+        self.bump_version()
         self.delt = x[0]
         self.tcon0 = x[1]
         self.phiedge = x[2]
@@ -180,7 +277,7 @@ class Vmec(Optimizable):
         """
         Run VMEC, if needed.
         """
-        if not self.need_to_run_code:
+        if not self.is_stale():
             logger.info("run() called but no need to re-run VMEC.")
             return
         logger.info("Preparing to run VMEC.")
@@ -207,20 +304,109 @@ class Vmec(Optimizable):
                 vi.rbc[101 + n, m] = boundary_RZFourier.get_rc(m, n)
                 vi.zbs[101 + n, m] = boundary_RZFourier.get_zs(m, n)
 
-        # Set axis shape to something that is obvious wrong (R=0) to
-        # trigger vmec's internal guess_axis.f to run. Otherwise the
-        # initial axis shape for run N will be the final axis shape
-        # from run N-1, which makes VMEC results depend slightly on
-        # the history of previous evaluations, confusing the finite
-        # differencing.
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache_key()
+            wout = self.cache.get(cache_key, loader=self.read_wout)
+            # VMEC runs collectively on the group, so all procs in
+            # the group must agree on whether to run:
+            found = self.mpi.comm_groups.allreduce(wout is not None, op=MPI.LAND)
+            if found:
+                logger.info("Using cached VMEC equilibrium.")
+                self.wout = wout
+                self.mark_current()
+                return
+
+        # Save the multigrid arrays, since a warm start modifies them:
+        ns_array = np.copy(vi.ns_array)
+        ftol_array = np.copy(vi.ftol_array)
+        niter_array = np.copy(vi.niter_array)
+        try:
+            ierr = 0
+            if self.warm_start:
+                restart = self.find_restart()
+                if restart is not None:
+                    ierr = self.run_vmec(*restart)
+                    if ierr != 11:
+                        logger.info("Warm-started VMEC run failed with error code "
+                                    "{}. Trying again from a cold start.".format(ierr))
+                    vi.ns_array[:] = ns_array
+                    vi.ftol_array[:] = ftol_array
+                    vi.niter_array[:] = niter_array
+            if ierr != 11:
+                ierr = self.run_vmec()
+        finally:
+            vi.ns_array[:] = ns_array
+            vi.ftol_array[:] = ftol_array
+            vi.niter_array[:] = niter_array
+
+        if ierr != 11:  # 11 = successful_term_flag, defined in General/vmec_params.f
+            raise RuntimeError("VMEC did not converge. "
+                               "error code {}".format(ierr))
+        logger.info("VMEC run complete. Now loading output.")
+        self.load_wout()
+        logger.info("Done loading VMEC output.")
+        if self.cache is not None:
+            # Only one proc per group copies the wout file:
+            self.cache.store(cache_key, self.wout, output_file=self.output_file,
+                             copy=self.mpi.proc0_groups,
+                             static_key=self.cache_static_key(),
+                             state=self.cache_state())
+        if not self.keep_wout_files:
+            self.delete_wout_file()
+        self.mark_current()
+
+    def run_vmec(self, reset_file='', wout=None):
+        """
+        Call VMEC's fortran routines to compute an equilibrium, after the
+        input parameters have been transferred to VMEC's fortran
+        modules. If reset_file is the name of a wout file, VMEC is
+        restarted from that equilibrium, and wout should be the
+        corresponding wout structure, from which the magnetic axis is
+        taken. Otherwise VMEC starts from its own initial guess.
+
+        Returns VMEC's error code.
+        """
+        vi = vmec.vmec_input  # Shorthand
         vi.raxis_cc[:] = 0
         vi.raxis_cs[:] = 0
         vi.zaxis_cc[:] = 0
         vi.zaxis_cs[:] = 0
+        if reset_file:
+            # Since the stored equilibrium is already converged at the
+            # final radial resolution, only the last multigrid step is
+            # needed.
+            nstages = np.count_nonzero(vi.ns_array)
+            ns, ftol, niter = vi.ns_array[nstages - 1], \
+                vi.ftol_array[nstages - 1], vi.niter_array[nstages - 1]
+            vi.ns_array[:] = 0
+            vi.ftol_array[:] = 0
+            vi.niter_array[:] = 0
+            vi.ns_array[0] = ns
+            vi.ftol_array[0] = ftol
+            vi.niter_array[0] = niter
+            # Start from the axis of the stored equilibrium:
+            vi.raxis_cc[:len(wout.raxis_cc)] = wout.raxis_cc
+            vi.zaxis_cs[:len(wout.zaxis_cs)] = wout.zaxis_cs
+            if wout.lasym:
+                vi.raxis_cs[:len(wout.raxis_cs)] = wout.raxis_cs
+                vi.zaxis_cc[:len(wout.zaxis_cc)] = wout.zaxis_cc
+            logger.info("Warm-starting VMEC from " + reset_file)
+        # Otherwise, the axis shape is left as something that is
+        # obviously wrong (R=0) to trigger vmec's internal guess_axis.f
+        # to run. Otherwise the initial axis shape for run N will be
+        # the final axis shape from run N-1, which makes VMEC results
+        # depend slightly on the history of previous evaluations,
+        # confusing the finite differencing.
+
+        # With warm starts, every run is converged more tightly, so the
+        # result depends negligibly on whether VMEC was warm- or
+        # cold-started, keeping finite-difference Jacobians consistent:
+        vi.ftol_array[:] = self.effective_ftol_array()
 
         self.iter += 1
         input_file = self.input_file + '_{:03d}_{:06d}'.format(
-            self.mpi.group, self.iter)
+            self.mpi.group, next(run_counter))
         self.output_file = os.path.join(
             os.getcwd(),
             os.path.basename(input_file).replace('input.', 'wout_') + '.nc')
@@ -237,75 +423,177 @@ class Vmec(Optimizable):
         self.ictrl[3] = 0  # ns_index
         self.ictrl[4] = 0  # iseq
         verbose = True
-        reset_file = ''
         vmec.runvmec(self.ictrl, input_file, verbose, self.fcomm, reset_file)
         ierr = self.ictrl[1]
 
         # Deallocate arrays, even if vmec did not converge:
         logger.info("Calling VMEC cleanup().")
         vmec.cleanup(True)
+        return ierr
 
-        if ierr != 11:  # 11 = successful_term_flag, defined in General/vmec_params.f
-            raise RuntimeError("VMEC did not converge. "
-                               "error code {}".format(ierr))
-        logger.info("VMEC run complete. Now loading output.")
-        self.load_wout()
-        logger.info("Done loading VMEC output.")
-        self.need_to_run_code = False
+    def find_restart(self):
+        """
+        Find the equilibrium in the cache nearest to the present inputs,
+        for warm-starting VMEC. The choice is made by the group leader
+        and broadcast to the rest of the group.
+
+        Returns:
+            A tuple (wout_file, wout), or None if there is no suitable
+            equilibrium in the cache.
+        """
+        restart = None
+        if self.mpi.proc0_groups:
+            nearest = self.cache.nearest(self.cache_static_key(), self.cache_state())
+            if nearest is not None:
+                wout, wout_file, distance = nearest
+                logger.info("Nearest cached equilibrium is at distance {}".format(distance))
+                if self.warm_start_max_distance is None \
+                   or distance <= self.warm_start_max_distance:
+                    restart = wout_file
+        restart = self.mpi.comm_groups.bcast(restart, root=0)
+        if restart is None:
+            return None
+        return restart, self.read_wout(restart)
+
+    def effective_ftol_array(self):
+        """
+        Return the ftol of each multigrid stage that a run with the
+        present inputs converges to. While warm starts are enabled, the
+        final ftol is multiplied by warm_start_ftol_factor.
+        """
+        vi = vmec.vmec_input  # Shorthand
+        ftol_array = np.copy(vi.ftol_array)
+        if self.warm_start:
+            nstages = np.count_nonzero(vi.ns_array)
+            ftol_array[nstages - 1] *= self.warm_start_ftol_factor
+        return ftol_array
+
+    def cache_static_key(self):
+        """
+        Return a hash of the VMEC inputs other than the boundary shape
+        and the continuously varying dofs, including the tolerance that
+        VMEC converges to. Only equilibria with the same static key are
+        considered for warm starts. This should be
+        called after the inputs have been transferred to VMEC's fortran
+        modules, as in run().
+        """
+        vi = vmec.vmec_input  # Shorthand
+        return hash_state(self.input_hash,
+                          [vi.nfp, vi.lasym, vi.mpol, vi.ntor, self.delt, self.tcon0],
+                          vi.ns_array, self.effective_ftol_array(), vi.niter_array)
+
+    def cache_state(self):
+        """
+        Return a 1D array of the boundary shape and the continuously
+        varying dofs, which is used to measure the distance between
+        equilibria for warm starts.
+        """
+        vi = vmec.vmec_input  # Shorthand
+        ntor = vi.ntor
+        rbc = vi.rbc[101 - ntor:101 + ntor + 1, :vi.mpol + 1]
+        zbs = vi.zbs[101 - ntor:101 + ntor + 1, :vi.mpol + 1]
+        return np.concatenate((rbc.flatten(), zbs.flatten(),
+                               [self.phiedge, self.curtor, self.gamma]))
+
+    def cache_key(self):
+        """
+        Return a hash identifying the present VMEC inputs, for use
+        with a VmecCache. This should be called after the boundary and
+        other parameters have been transferred to VMEC's fortran
+        modules, as in run().
+        """
+        return hash_state(self.cache_static_key(), self.cache_state())
 
     def load_wout(self):
-        ierr = 0
-        logger.info("Attempting to read file " + self.output_file)
-        # vmec.read_wout_mod.read_wout_file(self.output_file, ierr)
-        #if ierr == 0:
-        #    logger.info('Successufully load VMEC results from ' + \
-        #                self.output_file)
-        # else:
-        #    print('Load VMEC results from {:} failed!'.format(
-        #        self.output_file))
-        #wout = vmec.read_wout_mod
-        #print('xm:', wout.xm)
-        #print('xn:', wout.xn)
-        #print('xm_nyq:', wout.xm_nyq)
-        #print('xn_nyq:', wout.xn_nyq)
-        #print('type(xm):', type(wout.xm), ' type(xn):', type(wout.xn), ' type(xm_nyq):', type(wout.xm_nyq), ' type(xn_nyq):', type(wout.xn_nyq))
-        #print('ierr:', ierr)
-        #print('mnmax:', wout.mnmax, ' len(xm):', len(wout.xm), ' len(xn):', len(wout.xn))
-        #print('mnmax_nyq:', wout.mnmax_nyq, ' len(xm_nyq):', len(wout.xm_nyq), ' len(xn_nyq):', len(wout.xn_nyq))
-        #assert len(wout.xm) == wout.mnmax
-        #assert len(wout.xn) == wout.mnmax
-        #assert len(wout.xm_nyq) == wout.mnmax_nyq
-        #assert len(wout.xn_nyq) == wout.mnmax_nyq
-
-        f = netcdf.netcdf_file(self.output_file, mmap=False)
-        self.wout.ier_flag = f.variables['ier_flag'][()]
-        if self.wout.ier_flag != 0:
-            logger.info("VMEC did not succeed!")
-            raise RuntimeError("VMEC did not succeed")
-        self.wout.nfp = f.variables['nfp'][()]
-        self.wout.lasym = f.variables['lasym__logical__'][()]
-        self.wout.ns = f.variables['ns'][()]
-        self.wout.mnmax = f.variables['mnmax'][()]
-        self.wout.mnmax_nyq = f.variables['mnmax_nyq'][()]
-        self.wout.xm = f.variables['xm'][()]
-        self.wout.xn = f.variables['xn'][()]
-        self.wout.xm_nyq = f.variables['xm_nyq'][()]
-        self.wout.xn_nyq = f.variables['xn_nyq'][()]
-        self.wout.mpol = f.variables['mpol'][()]
-        self.wout.ntor = f.variables['ntor'][()]
-        self.wout.bmnc = f.variables['bmnc'][()].transpose()
-        self.wout.rmnc = f.variables['rmnc'][()].transpose()
-        self.wout.zmns = f.variables['zmns'][()].transpose()
-        self.wout.lmns = f.variables['lmns'][()].transpose()
-        self.wout.bsubumnc = f.variables['bsubumnc'][()].transpose()
-        self.wout.bsubvmnc = f.variables['bsubvmnc'][()].transpose()
-        self.wout.iotas = f.variables['iotas'][()]
-        self.wout.iotaf = f.variables['iotaf'][()]
-        self.wout.aspect = f.variables['aspect'][()]
-        self.wout.volume = f.variables['volume_p'][()]
-        f.close()
+        """
+        Read the wout file from the most recent VMEC run into
+        self.wout.
+        """
+        if self.wout_in_memory:
+            # ierr is intent(out), so it is returned rather than passed:
+            ierr = vmec.read_wout_mod.read_wout_file(self.output_file)
+            if ierr != 0:
+                raise RuntimeError("Failed to read wout file {}. "
+                                   "error code {}".format(self.output_file, ierr))
+            # If the results will be cached, they must be copied out
+            # of the fortran module before the next run overwrites
+            # them:
+            self.wout = self.read_wout_from_memory(copy=(self.cache is not None))
+            if self.wout.ier_flag != 0:
+                logger.info("VMEC did not succeed!")
+                raise RuntimeError("VMEC did not succeed")
+        else:
+            self.wout = self.read_wout(self.output_file)
+        return 0
 
-        return ierr
+    def read_wout_from_memory(self, copy=False):
+        """
+        Return a Struct with the VMEC output stored in the fortran
+        read_wout_mod module, e.g. after read_wout_file() has been
+        called. Arrays in the fortran module are already in the
+        (mode, radius) order used by self.wout, so no transposes are
+        needed. Unless copy is True, the arrays are views of the
+        fortran module's memory, and so are only valid until the next
+        VMEC output is loaded.
+        """
+        rw = vmec.read_wout_mod  # Shorthand
+        wout = Struct()
+        wout.ier_flag = int(rw.ier_flag)
+        wout.nfp = int(rw.nfp)
+        wout.lasym = int(rw.lasym)
+        wout.ns = int(rw.ns)
+        wout.mnmax = int(rw.mnmax)
+        wout.mnmax_nyq = int(rw.mnmax_nyq)
+        wout.mpol = int(rw.mpol)
+        wout.ntor = int(rw.ntor)
+        wout.aspect = float(rw.aspect)
+        wout.volume = float(rw.volume)
+        names = ['xm', 'xn', 'xm_nyq', 'xn_nyq', 'bmnc', 'rmnc', 'zmns',
+                 'lmns', 'bsubumnc', 'bsubvmnc', 'iotas', 'iotaf']
+        if wout.lasym:
+            # The non-stellarator-symmetric arrays are only allocated
+            # in this case:
+            names += ['bmns', 'rmns', 'zmnc', 'lmnc', 'bsubumns', 'bsubvmns']
+        for name in names:
+            arr = getattr(rw, name)
+            setattr(wout, name, np.array(arr) if copy else arr)
+        # read_wout_mod stores the axis as raxis = [raxis_cc, raxis_cs]
+        # and zaxis = [zaxis_cs, zaxis_cc], where the second column is
+        # only read for lasym:
+        wout.raxis_cc = np.array(rw.raxis[:, 0])
+        wout.zaxis_cs = np.array(rw.zaxis[:, 0])
+        if wout.lasym:
+            wout.raxis_cs = np.array(rw.raxis[:, 1])
+            wout.zaxis_cc = np.array(rw.zaxis[:, 1])
+        else:
+            wout.raxis_cs = np.zeros_like(wout.raxis_cc)
+            wout.zaxis_cc = np.zeros_like(wout.zaxis_cs)
+        return wout
+
+    def delete_wout_file(self):
+        """
+        Delete the wout file from the most recent VMEC run, once all
+        procs in the group have read it. The file is kept if it may be
+        needed for a warm start.
+        """
+        if self.warm_start and self.cache.directory is None:
+            return
+        # self.wout may also be held by the cache, so read everything
+        # that has not been read yet before the file disappears:
+        if isinstance(self.wout, LazyWout):
+            self.wout.load()
+        self.mpi.comm_groups.barrier()
+        if self.mpi.proc0_groups and os.path.exists(self.output_file):
+            logger.info("Deleting " + self.output_file)
+            os.remove(self.output_file)
+
+    def read_wout(self, filename):
+        """
+        Open a VMEC wout file, returning a LazyWout that reads each
+        variable from the file when it is first accessed.
+        """
+        logger.info("Attempting to read file " + filename)
+        return LazyWout(filename)
 
     def aspect(self):
         """
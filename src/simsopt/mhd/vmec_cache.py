@@ -0,0 +1,243 @@
+# coding: utf-8
+# Copyright (c) HiddenSymmetries Development Team.
+# Distributed under the terms of the LGPL License
+
+"""
+This module provides the VmecCache class, which stores VMEC
+equilibria so that VMEC need not be re-run when an optimizer revisits
+a state vector it has already evaluated.
+"""
+
+import glob
+import hashlib
+import logging
+import os
+import shutil
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def hash_state(*args):
+    """
+    Return a hex string that identifies the given arguments. Each
+    argument may be a string or anything that can be converted to a
+    numpy array of floats. The shape of each array is included in the
+    hash, so e.g. arrays with the same entries but different shapes
+    give different keys.
+    """
+    h = hashlib.sha256()
+    for arg in args:
+        if isinstance(arg, str):
+            h.update(arg.encode())
+        else:
+            arr = np.ascontiguousarray(arg, dtype=np.dtype(float))
+            h.update(str(arr.shape).encode())
+            h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+def wout_nbytes(wout):
+    """
+    Return the number of bytes charged for a wout structure in the
+    cache. For a wout that reads its variables from a file on demand,
+    such as a LazyWout, this is the size of the file, since any of the
+    variables may be read later. Otherwise it is the number of bytes
+    used by the numpy arrays stored in the structure.
+    """
+    filename = getattr(wout, 'filename', None)
+    if filename is not None and os.path.exists(filename):
+        return os.path.getsize(filename)
+    return int(sum(val.nbytes for val in vars(wout).values()
+                   if isinstance(val, np.ndarray)))
+
+
+class VmecCache:
+    """
+    This class is a least-recently-used cache of VMEC output, keyed on
+    a hash of the VMEC inputs. Entries are held in memory, and
+    optionally also as wout files in a directory, so that they can be
+    recovered after being evicted from memory or by a later run.
+
+    The number of hits, misses and evictions are recorded in the
+    attributes hits, misses and evictions.
+
+    Entries may also record a state vector and the name of a wout
+    file, in which case nearest() can be used to find the stored
+    equilibrium closest to a new state, e.g. for warm-starting VMEC.
+    """
+
+    def __init__(self, max_entries=100, max_bytes=None, directory=None,
+                 max_disk_bytes=None):
+        """
+        Args:
+            max_entries: Maximum number of equilibria held in memory.
+            max_bytes: Maximum number of bytes of wout data held in memory,
+              as counted by wout_nbytes(), or None for no limit.
+            directory: Directory in which to keep copies of the wout files,
+              or None to keep the cache in memory only.
+            max_disk_bytes: Maximum total size of the wout files in
+              directory, or None for no limit.
+        """
+        if max_entries < 1:
+            raise ValueError('max_entries must be at least 1')
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+        self.entries = OrderedDict()
+        # For each key, a tuple (static_key, state, wout_file) used by
+        # nearest(). Only present for entries stored with a state.
+        self.states = dict()
+        # The number of bytes charged for each entry when it was stored,
+        # so the same number is subtracted when it is removed:
+        self.entry_nbytes = dict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def filename(self, key):
+        """
+        Return the name of the wout file in the cache directory for a
+        given key.
+        """
+        return os.path.join(self.directory, 'wout_' + key + '.nc')
+
+    def get(self, key, loader=None):
+        """
+        Return the wout structure stored for key, or None if there is
+        no entry. If the entry is not in memory but a wout file for key
+        exists in the cache directory, loader(filename) is called to
+        read it, and the result is added to the memory cache.
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            logger.info('VmecCache hit for key {}'.format(key))
+            return self.entries[key]
+
+        if self.directory is not None and loader is not None:
+            filename = self.filename(key)
+            if os.path.exists(filename):
+                wout = loader(filename)
+                self.hits += 1
+                logger.info('VmecCache hit on disk for key {}'.format(key))
+                self.store(key, wout)
+                return wout
+
+        self.misses += 1
+        logger.info('VmecCache miss for key {}'.format(key))
+        return None
+
+    def store(self, key, wout, output_file=None, copy=True,
+              static_key=None, state=None):
+        """
+        Add a wout structure to the memory cache.
+
+        Args:
+            key: The key for this entry.
+            wout: The wout structure to store.
+            output_file: The wout file from which wout was read, if any.
+            copy: If True, and the cache has a directory, output_file is
+              copied into the directory. With MPI, only one proc should
+              copy the file.
+            static_key: Entries are only compared by nearest() if
+              their static_key values are equal, e.g. because the
+              resolution and profiles are the same.
+            state: A 1D array describing the continuous inputs,
+              e.g. the boundary shape, for use by nearest().
+        """
+        if key in self.entries:
+            del self.entries[key]
+            self.nbytes -= self.entry_nbytes.pop(key)
+        self.entries[key] = wout
+        self.entry_nbytes[key] = wout_nbytes(wout)
+        self.nbytes += self.entry_nbytes[key]
+
+        if output_file is not None and self.directory is not None:
+            if copy:
+                # Copy to a temporary file and rename it, so a wout file
+                # with the same key that is memory-mapped elsewhere is
+                # replaced rather than overwritten in place:
+                tmp_file = self.filename(key) + '.{}.tmp'.format(os.getpid())
+                shutil.copyfile(output_file, tmp_file)
+                os.replace(tmp_file, self.filename(key))
+                self.trim_directory()
+            output_file = self.filename(key)
+        if state is not None and output_file is not None:
+            self.states[key] = (static_key, np.array(state, dtype=np.dtype(float)),
+                                output_file)
+
+        while len(self.entries) > self.max_entries \
+              or (self.max_bytes is not None and self.nbytes > self.max_bytes
+                  and len(self.entries) > 0):
+            old_key, old_wout = self.entries.popitem(last=False)
+            self.states.pop(old_key, None)
+            self.nbytes -= self.entry_nbytes.pop(old_key)
+            self.evictions += 1
+            logger.debug('VmecCache evicted key {}'.format(old_key))
+
+    def nearest(self, static_key, state):
+        """
+        Among the entries in memory with the given static_key, find
+        the one whose state is closest to the given state in the
+        Euclidean norm, considering only entries whose wout file still
+        exists.
+
+        Returns:
+            A tuple (wout, wout_file, distance), or None if there is no
+            suitable entry.
+        """
+        state = np.asarray(state, dtype=np.dtype(float))
+        best = None
+        for key, (entry_static_key, entry_state, wout_file) in self.states.items():
+            if entry_static_key != static_key or entry_state.shape != state.shape:
+                continue
+            distance = np.linalg.norm(entry_state - state)
+            if (best is None or distance < best[2]) and os.path.exists(wout_file):
+                best = (self.entries[key], wout_file, distance)
+        return best
+
+    def trim_directory(self):
+        """
+        Delete the oldest wout files in the cache directory until their
+        total size is within max_disk_bytes.
+        """
+        if self.directory is None or self.max_disk_bytes is None:
+            return
+        files = sorted(glob.glob(os.path.join(self.directory, 'wout_*.nc')),
+                       key=os.path.getmtime)
+        sizes = [os.path.getsize(f) for f in files]
+        total = sum(sizes)
+        for f, size in zip(files, sizes):
+            if total <= self.max_disk_bytes:
+                break
+            os.remove(f)
+            total -= size
+
+    def clear(self):
+        """
+        Remove all entries from memory. Files in the cache directory are
+        not deleted.
+        """
+        self.entries.clear()
+        self.states.clear()
+        self.entry_nbytes.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        """
+        Return a dict with the present size and hit/miss counts of the
+        cache.
+        """
+        return {'entries': len(self.entries),
+                'bytes': self.nbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
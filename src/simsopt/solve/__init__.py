@@ -1,2 +1,3 @@
 from .serial_solve import least_squares_serial_solve, serial_solve
 from .mpi_solve import least_squares_mpi_solve, fd_jac_mpi
+from .history import History, load_history, history_to_csv
@@ -0,0 +1,220 @@
+# coding: utf-8
+# Copyright (c) HiddenSymmetries Development Team.
+# Distributed under the terms of the LGPL License
+
+"""
+This module provides the History class, which records the function
+evaluations made during an optimization, along with functions to read
+a recorded history and to convert it to the csv files written by
+earlier versions of simsopt.
+"""
+
+import json
+import logging
+import os
+from datetime import datetime
+from time import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class History:
+    """
+    This class records the state vector, objective function and
+    (for least-squares problems) the residuals at each function
+    evaluation of an optimization.
+
+    Rather than formatting each number as text and flushing a file at
+    every evaluation, rows are accumulated in a numpy buffer and
+    written as binary .npy chunks in a directory. The directory also
+    contains a file index.json, which describes the columns and lists
+    the chunks, so the history can be read while an optimization is
+    running. Each row has the columns
+
+    function_evaluation, seconds, x(0), ..., x(nparams-1),
+    objective_function, F(0), ..., F(nvals-1)
+
+    where the F columns are only present for least-squares problems.
+    """
+
+    def __init__(self, nparams, problem_type='least_squares', directory=None,
+                 flush_rows=100, flush_seconds=10.0):
+        """
+        Args:
+            nparams: Number of entries in the state vector.
+            problem_type: 'least_squares' or 'general'.
+            directory: Directory in which to write the history. If None,
+              a new directory named by the date and time is created in
+              the working directory, with a suffix added if needed to
+              make the name unique.
+            flush_rows: Write a chunk to disk after this many rows.
+            flush_seconds: Also write a chunk to disk if this many
+              seconds have passed since the last write, or None to
+              flush only based on flush_rows.
+        """
+        if flush_rows < 1:
+            raise ValueError('flush_rows must be at least 1')
+        if problem_type not in ['least_squares', 'general']:
+            raise ValueError('Unknown problem_type: {}'.format(problem_type))
+        self.nparams = nparams
+        self.problem_type = problem_type
+        self.directory = directory
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+
+        self.nvals = None
+        self.nevals = 0
+        self.nchunks = 0
+        self.chunk_rows = []
+        self.buffer = None
+        self.nbuffered = 0
+        self.start_time = time()
+        self.last_flush_time = self.start_time
+
+    def record(self, x, objective, f=None):
+        """
+        Add a row to the history for a function evaluation.
+
+        Args:
+            x: The state vector.
+            objective: The value of the objective function.
+            f: For least-squares problems, the vector of residuals.
+        """
+        if self.buffer is None:
+            # The number of residuals is only known at the first
+            # evaluation, so the buffer is created here.
+            self.nvals = 0 if self.problem_type == 'general' else len(f)
+            self.make_directory()
+            self.buffer = np.zeros((self.flush_rows, 3 + self.nparams + self.nvals))
+
+        row = self.buffer[self.nbuffered]
+        row[0] = self.nevals
+        row[1] = time() - self.start_time
+        row[2:2 + self.nparams] = x
+        row[2 + self.nparams] = objective
+        if self.nvals > 0:
+            row[3 + self.nparams:] = f
+        self.nbuffered += 1
+        self.nevals += 1
+
+        if self.nbuffered == self.flush_rows or (self.flush_seconds is not None and \
+           time() - self.last_flush_time > self.flush_seconds):
+            self.flush()
+
+    def make_directory(self):
+        """
+        Create the directory for the history.
+        """
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            return
+        # Several solves, e.g. on different MPI processes, may start
+        # within the same second, so make sure each gets its own
+        # directory:
+        name = "simsopt_" + datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+        suffix = 0
+        while True:
+            directory = name if suffix == 0 else name + "_" + str(suffix)
+            try:
+                os.mkdir(directory)
+                break
+            except FileExistsError:
+                suffix += 1
+        self.directory = directory
+
+    def flush(self):
+        """
+        Write any buffered rows to a new chunk, and update the index.
+        """
+        self.last_flush_time = time()
+        if self.nbuffered == 0:
+            return
+        filename = 'chunk_{:06d}.npy'.format(self.nchunks)
+        np.save(os.path.join(self.directory, filename), self.buffer[:self.nbuffered])
+        self.chunk_rows.append(self.nbuffered)
+        self.nchunks += 1
+        self.nbuffered = 0
+        self.write_index()
+
+    def write_index(self):
+        """
+        Write index.json, describing the columns and the chunks.
+        """
+        index = {'problem_type': self.problem_type,
+                 'nparams': self.nparams,
+                 'nvals': self.nvals,
+                 'chunks': ['chunk_{:06d}.npy'.format(j) for j in range(self.nchunks)],
+                 'rows': self.chunk_rows}
+        # Write to a temporary file first, so readers never see a
+        # partly written index:
+        filename = os.path.join(self.directory, 'index.json')
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(filename + '.tmp', filename)
+
+    def close(self):
+        """
+        Write any remaining rows to disk.
+        """
+        self.flush()
+
+
+def load_history(directory):
+    """
+    Read a history written by History.
+
+    Returns:
+        A tuple (index, data), where index is the dict stored in
+        index.json and data is a 2D array with one row per function
+        evaluation.
+    """
+    with open(os.path.join(directory, 'index.json')) as f:
+        index = json.load(f)
+    ncols = 3 + index['nparams'] + index['nvals']
+    chunks = [np.load(os.path.join(directory, chunk)) for chunk in index['chunks']]
+    if len(chunks) == 0:
+        return index, np.zeros((0, ncols))
+    return index, np.concatenate(chunks)
+
+
+def history_to_csv(directory, output_directory='.'):
+    """
+    Convert a history written by History to the text files written by
+    earlier versions of simsopt, for use by tools that read those
+    files. A file simsopt_*.dat is written with the state vector and
+    objective function, and for least-squares problems, a file
+    residuals_*.dat is also written with the residuals. The * is taken
+    from the name of the history directory.
+
+    Returns:
+        A list of the files written.
+    """
+    index, data = load_history(directory)
+    nparams = index['nparams']
+    nvals = index['nvals']
+    name = os.path.basename(os.path.normpath(directory))
+    if name.startswith('simsopt_'):
+        name = name[len('simsopt_'):]
+
+    header = "Problem type:\n{}\nnparams:\n{}\n".format(index['problem_type'], nparams)
+    header += "function_evaluation,seconds"
+    header += "".join(",x({})".format(j) for j in range(nparams))
+    header += ",objective_function"
+
+    def write(filename, ncols, extra_header):
+        with open(filename, 'w') as f:
+            f.write(header + extra_header + "\n")
+            for row in data:
+                f.write("{:6d},{:12.4e}".format(int(row[0]), row[1]))
+                f.write("".join(",{:24.16e}".format(val) for val in row[2:ncols]))
+                f.write("\n")
+
+    filenames = [os.path.join(output_directory, "simsopt_" + name + ".dat")]
+    write(filenames[0], 3 + nparams, "")
+    if index['problem_type'] == 'least_squares':
+        filenames.append(os.path.join(output_directory, "residuals_" + name + ".dat"))
+        write(filenames[1], 3 + nparams + nvals,
+              "".join(",F({})".format(j) for j in range(nvals)))
+    return filenames
@@ -9,8 +9,9 @@ the operation of these main functions.
 """
 
 import logging
-from datetime import datetime
-from time import time
+import weakref
+from collections import deque
+from time import time, sleep
 
 import numpy as np
 from scipy.optimize import least_squares
@@ -20,33 +21,244 @@ try:
 except ImportError as err:
     MPI = None
 
+from simsopt.core.dofs import fd_points, fd_jac_from_evals
+from .history import History
+
 logger = logging.getLogger(__name__)
 
 # Constants for signaling to workers what task to do:
 CALCULATE_F = 1
 CALCULATE_JAC = 2
 CALCULATE_FD_JAC = 3
+CALCULATE_SPECULATIVE = 4
+
+# Tags for messages between group leaders in fd_jac_mpi and
+# f_speculative_mpi:
+TASK_TAG = 11
+RESULT_TAG = 12
+SETUP_TAG = 13
+OUTCOME_TAG = 14
+
+# Column index sent instead of a task to a group that exceeded the
+# timeout, telling it not to start the task it has in reserve:
+ABANDON = -2
+
+# Seconds between checks for results while proc0_world waits in fd_jac_mpi:
+POLL_INTERVAL = 0.001
+
+# Number of calls to fd_jac_mpi and f_speculative_mpi so far, used to
+# recognize late results:
+fd_jac_calls = 0
+
+# Messages sent with Isend or isend by this proc to other group
+# leaders, together with their buffers, which must be kept until the
+# sends complete:
+pending_sends = []
+
+# On proc0_world, for each MpiPartition, the number of results that
+# each group has been asked for and that have not been received yet:
+pending_results = weakref.WeakKeyDictionary()
+
+# On proc0_world, for each MpiPartition, receives posted by
+# abandon_results() for results that will arrive after the call that
+# asked for them has returned, as (rank, request, buffer):
+abandoned_results = weakref.WeakKeyDictionary()
+
+
+def prune_sends():
+    """
+    Forget the sends that have completed.
+    """
+    pending_sends[:] = [(request, buffer) for request, buffer in pending_sends
+                        if not request.Test()]
+
+
+def send_task(mpi, rank, epoch, j):
+    """
+    Send a task from proc0_world to group leader rank without waiting
+    for it to be received, since the group may be busy.
+    """
+    prune_sends()
+    buffer = np.array([epoch, j], dtype='i')
+    request = mpi.comm_leaders.Isend(buffer, dest=rank, tag=TASK_TAG)
+    pending_sends.append((request, buffer))
+
+
+def send_to_leaders(mpi, ranks, data, tag=SETUP_TAG):
+    """
+    Send a picklable object from proc0_world to each of the group
+    leaders with the given ranks, without waiting for them to receive
+    it. This replaces a broadcast over comm_leaders, which would make
+    proc0_world wait for groups that are still busy.
+    """
+    prune_sends()
+    for rank in ranks:
+        pending_sends.append((mpi.comm_leaders.isend(data, dest=rank, tag=tag), None))
+
+
+def receive_from_proc0(mpi, tag=SETUP_TAG):
+    """
+    On a group leader, receive an object sent by send_to_leaders().
+    """
+    return mpi.comm_leaders.recv(source=0, tag=tag)
+
+
+def send_result(mpi, result):
+    """
+    Send a result from a group leader to proc0_world without waiting
+    for proc0_world to receive it, so the group leader can return to
+    the leaders loop even if proc0_world only receives the result
+    later, or discards it.
+    """
+    prune_sends()
+    request = mpi.comm_leaders.Isend(result, dest=0, tag=RESULT_TAG)
+    pending_sends.append((request, result))
+
+
+def wait_for_sends():
+    """
+    Wait until all messages sent by this group leader have been
+    received. proc0_world does not call this, since groups that are
+    still busy may receive its messages much later.
+    """
+    MPI.Request.Waitall([request for request, buffer in pending_sends])
+    pending_sends.clear()
+
+
+def expect_result(mpi, rank):
+    """
+    On proc0_world, record that group rank has been asked for a result.
+    """
+    counts = pending_results.setdefault(mpi, np.zeros(mpi.ngroups, dtype=int))
+    counts[rank] += 1
+
+
+def receive_result(mpi, status):
+    """
+    On proc0_world, receive the result whose arrival has been detected
+    by a probe with the given status. Returns the rank of the group
+    that sent it, and the result.
+    """
+    rank = status.Get_source()
+    result = np.empty(status.Get_count(MPI.DOUBLE), dtype='d')
+    mpi.comm_leaders.Recv(result, source=rank, tag=RESULT_TAG)
+    pending_results[mpi][rank] -= 1
+    return rank, result
+
+
+def available_leaders(mpi, speculative=None):
+    """
+    On proc0_world, return the ranks of the other group leaders that
+    can take part in the next call to fd_jac_mpi() or
+    f_speculative_mpi(), i.e. those that do not still owe results from
+    earlier calls. Late results that have already arrived are
+    received and discarded first. speculative is as for fd_jac_mpi();
+    the groups whose speculative evaluations will be re-used owe
+    results for the coming call, so they are included.
+    """
+    speculative_ranks = set()
+    if speculative is not None and speculative['epoch'] == fd_jac_calls:
+        speculative_ranks = set(speculative['columns'].keys())
+    counts = pending_results.setdefault(mpi, np.zeros(mpi.ngroups, dtype=int))
+    abandoned = abandoned_results.get(mpi, [])
+    abandoned[:] = [(rank, request, buffer) for rank, request, buffer in abandoned
+                    if not request.Test()]
+    busy = {rank for rank, request, buffer in abandoned}
+    status = MPI.Status()
+    ranks = []
+    for rank in range(1, mpi.ngroups):
+        if rank in speculative_ranks:
+            ranks.append(rank)
+            continue
+        while counts[rank] > 0 and mpi.comm_leaders.Iprobe(source=rank, tag=RESULT_TAG,
+                                                           status=status):
+            receive_result(mpi, status)
+            logger.info('Discarding a late result from group {}'.format(rank))
+        if counts[rank] == 0 and rank not in busy:
+            ranks.append(rank)
+        else:
+            logger.info('Group {} is still busy, so it is left out'.format(rank))
+    return ranks
+
+
+def mobilize_available_leaders(mpi, action, speculative=None):
+    """
+    On proc0_world, send the group leaders returned by
+    available_leaders() into mpi_leaders_task() with the given action,
+    and return their ranks, to be passed to fd_jac_mpi() or
+    f_speculative_mpi().
+    """
+    ranks = available_leaders(mpi, speculative)
+    mpi.mobilize_leaders(action, ranks)
+    return ranks
+
+
+def drain_results(mpi, timeout=None):
+    """
+    On proc0_world, wait for and discard all results that other groups
+    still owe, e.g. from speculative evaluations that were not used,
+    or from groups that exceeded the timeout in fd_jac_mpi(). If they
+    have not all arrived after timeout seconds, the groups that owe
+    them are assumed to be hung, and since they cannot be stopped
+    otherwise, the whole run is aborted with comm_world.Abort().
+    """
+    counts = pending_results.get(mpi)
+    if counts is None:
+        return
+    start_time = time()
+    status = MPI.Status()
+    while np.any(counts > 0):
+        if not mpi.comm_leaders.Iprobe(source=MPI.ANY_SOURCE, tag=RESULT_TAG, status=status):
+            if timeout is not None and time() - start_time > timeout:
+                message = 'Groups {} did not return their results within {} s after ' \
+                    'the timeout. Aborting.'.format(list(np.nonzero(counts)[0]), timeout)
+                logger.error(message)
+                mpi.comm_world.Abort(1)
+            sleep(POLL_INTERVAL)
+            continue
+        rank, result = receive_result(mpi, status)
+        logger.info('Discarding a late result from group {}'.format(rank))
+
+
+def abandon_results(mpi, nvals):
+    """
+    On proc0_world, post receives for the results that other groups
+    still owe, so those groups can complete their sends and finish
+    when their evaluations are done, while proc0_world goes on
+    without waiting. nvals is the number of function values in each
+    result.
+    """
+    counts = pending_results.get(mpi)
+    if counts is None:
+        return
+    abandoned = abandoned_results.setdefault(mpi, [])
+    for rank in range(1, mpi.ngroups):
+        for k in range(counts[rank]):
+            logger.info('Not waiting for a late result from group {}'.format(rank))
+            buffer = np.empty(3 + (0 if nvals is None else nvals))
+            request = mpi.comm_leaders.Irecv(buffer, source=rank, tag=RESULT_TAG)
+            abandoned.append((rank, request, buffer))
+        counts[rank] = 0
+
 
 def mpi_leaders_task(mpi, dofs, data):
     """
     This function is called by group leaders when
     MpiPartition.leaders_loop() receives a signal to do something.
 
-    We have to take a "data" argument, but there is only 1 task we
-    would do, so we don't use it.
+    data indicates whether to join a finite-difference Jacobian
+    calculation (CALCULATE_FD_JAC) or a speculative evaluation
+    (CALCULATE_SPECULATIVE). The state vector and settings are then
+    received from proc0_world within those functions.
     """
     logger.debug('mpi_leaders_task')
 
-    # x is a buffer for receiving the state vector:
-    x = np.empty(dofs.nparams, dtype='d')
-    # If we make it here, we must be doing a fd_jac_par
-    # calculation, so receive the state vector: mpi4py has
-    # separate bcast and Bcast functions!!  comm.Bcast(x,
-    # root=0)
-    x = mpi.comm_leaders.bcast(x, root=0)
-    logger.debug('mpi_leaders_loop x={}'.format(x))
-    dofs.set(x)
-    fd_jac_mpi(dofs, mpi)
+    if data == CALCULATE_FD_JAC:
+        fd_jac_mpi(dofs, mpi)
+    elif data == CALCULATE_SPECULATIVE:
+        f_speculative_mpi(dofs, mpi)
+    else:
+        raise ValueError('Unexpected data in leaders_loop')
 
 
 def mpi_workers_task(mpi, dofs, data):
@@ -58,25 +270,42 @@ def mpi_workers_task(mpi, dofs, data):
 
     # x is a buffer for receiving the state vector:
     x = np.empty(dofs.nparams, dtype='d')
-    # If we make it here, we must be doing a fd_jac_par
-    # calculation, so receive the state vector: mpi4py has
-    # separate bcast and Bcast functions!!  comm.Bcast(x,
-    # root=0)
-    x = mpi.comm_groups.bcast(x, root=0)
+    # If we make it here, we must be doing a function or Jacobian
+    # evaluation, so receive the state vector:
+    mpi.comm_groups.Bcast(x, root=0)
     logger.debug('worker_loop worker x={}'.format(x))
     dofs.set(x)
 
     # We don't store or do anything with f() or jac(), because
-    # the group leader will handle that.
+    # the group leader will handle that. The group leader also
+    # handles any failure, so workers just return to the worker loop.
     if data == CALCULATE_F:
-        dofs.f()
+        try:
+            dofs.f()
+        except:
+            logger.info("Exception caught during function evaluation")
     elif data == CALCULATE_JAC:
-        dofs.jac()
+        try:
+            dofs.jac()
+        except:
+            logger.info("Exception caught during Jacobian evaluation")
     else:
         raise ValueError('Unexpected data in worker_loop')
 
 
-def fd_jac_mpi(dofs, mpi, x=None, eps=1e-7, centered=False):
+def check_all_failed(mpi, all_failed):
+    """
+    Tell all procs whether all evaluations failed on proc0_world in
+    fd_jac_mpi(), and if so raise an exception on all of them, so
+    none of them waits for the others in a later collective.
+    """
+    if mpi.comm_world.bcast(all_failed, root=0):
+        raise RuntimeError('All function evaluations failed in fd_jac_mpi')
+
+
+def fd_jac_mpi(dofs, mpi, x=None, eps=1e-7, centered=False, richardson=False,
+               known_evals=None, speculative=None, task_times=None, timeout=None,
+               max_retries=1, penalty=1.0e12, leaders=None, drain_timeout=None):
     """
     Compute the finite-difference Jacobian of the functions in dofs
     with respect to all non-fixed degrees of freedom. Parallel
@@ -87,6 +316,9 @@ def fd_jac_mpi(dofs, mpi, x=None, eps=1e-7, centered=False):
     first get_dofs() will be called for each object to set the
     global state vector to x.
 
+    eps, centered and richardson select the step sizes and stencil as
+    for Dofs.fd_jac(). They only need to be set on proc0_world.
+
     The mpi argument should be an MpiPartition.
 
     There are 2 ways to call this function. In method 1, all procs
@@ -95,7 +327,61 @@ def fd_jac_mpi(dofs, mpi, x=None, eps=1e-7, centered=False):
     automatically. In method 2, the worker loop has already been
     started before this function is called, as would be the case
     in least_squares_mpi_solve(). Then only the group leaders
-    call this function.
+    call this function: proc0_world calls it directly, after sending
+    the other group leaders that take part into mpi_leaders_task()
+    with mobilize_available_leaders(), which returns their ranks in
+    comm_leaders, to be passed as leaders. x and the settings are sent
+    to these group leaders by proc0_world with point-to-point
+    messages.
+
+    known_evals may be given on proc0_world as a dict, mapping indices
+    of columns in the matrix of evaluation points (the second entry
+    returned below) to function values that are already known. These
+    columns are not evaluated again. For 1-sided differences, passing
+    {0: f0} when the function values f0 at x are known means only the
+    perturbed points are evaluated.
+
+    speculative may be given on proc0_world as the second entry
+    returned by f_speculative_mpi() for the same x and the default eps,
+    with no call to fd_jac_mpi() or f_speculative_mpi() in between.
+    The columns that other groups began evaluating there are then not
+    evaluated again, and their results are received here.
+
+    The columns are not divided among the groups in advance. Rather,
+    proc0_world keeps a queue of columns, and each group is given a
+    new column as soon as it finishes its previous one, so a few
+    expensive evaluations do not hold up groups that could be doing
+    other work. If task_times is a dict, then on proc0_world it is
+    filled with arrays 'time' and 'group', giving the time taken for
+    each column and the group that evaluated it.
+
+    If an evaluation raises an exception, the functions are given the
+    value penalty for that column. If timeout is not None, any group
+    other than group 0 that spends more than timeout seconds on a
+    column is given no more work, and its columns are given to other
+    groups, up to max_retries times per column before the penalty
+    value is used instead. Since a running evaluation cannot be
+    interrupted, the timeout and retries only take effect when there
+    is more than one group, and never apply to the columns evaluated
+    by group 0, which includes proc0_world. timeout, max_retries and
+    penalty only need to be set on proc0_world.
+
+    In method 2, proc0_world does not wait for a group that exceeded
+    the timeout, even if that group never finishes. The group is
+    left out of later calls (see available_leaders()) until its
+    results have arrived. In method 1, all procs return from this
+    function together, so proc0_world waits up to drain_timeout
+    seconds (by default 10 * timeout) for such groups after all the
+    columns are done. Groups that still have not finished by then
+    are considered hung, and the run is aborted with
+    comm_world.Abort().
+
+    If every evaluation fails, the penalty value is used for all
+    columns if the number of function values is known from an earlier
+    evaluation. Otherwise a RuntimeError is raised. If all procs called
+    this function (method 1 above), it is raised on all of them, and
+    otherwise only on proc0_world, whose caller must then stop the
+    other procs, as least_squares_mpi_solve() does.
 
     This function returns a 3-tuple. The first entry is the
     Jacobian. The second entry is a matrix, the columns of which give
@@ -110,94 +396,287 @@ def fd_jac_mpi(dofs, mpi, x=None, eps=1e-7, centered=False):
     if not apart_at_start:
         mpi.worker_loop(lambda mpi2, data: mpi_workers_task(mpi2, dofs, data))
     if not mpi.proc0_groups:
+        if not apart_at_start:
+            check_all_failed(mpi, False)
         return (None, None, None)
 
     # Only group leaders execute this next section.
+    start_time = time()
+    all_failed = False
 
-    if x is not None:
-        dofs.set(x)
+    if mpi.proc0_world:
+        if x is not None:
+            dofs.set(x)
+        x0 = dofs.x
+        # Each call is numbered, so late results from groups that
+        # exceeded the timeout in an earlier call can be recognized
+        # and discarded.
+        global fd_jac_calls
+        if speculative is not None and speculative['epoch'] != fd_jac_calls:
+            logger.info('Ignoring out-of-date speculative evaluations')
+            speculative = None
+        if speculative is None:
+            fd_jac_calls += 1
+        else:
+            logger.info('Re-using speculative evaluations of columns {}'.format(
+                list(speculative['columns'].values())))
+        epoch = fd_jac_calls
+        if leaders is None:
+            leaders = list(range(1, mpi.ngroups))
+        # Leaders in the leaders loop call this function with the
+        # default arguments, so they must be told x0 and the settings
+        # by proc0_world. This is done point-to-point, so groups that
+        # are still busy with an earlier call are not waited for:
+        send_to_leaders(mpi, leaders, (epoch, x0, eps, centered, richardson))
+    else:
+        epoch, x0, eps, centered, richardson = receive_from_proc0(mpi)
+        dofs.set(x0)
 
     logger.info('Beginning parallel finite difference gradient calculation for functions ' + str(dofs.funcs))
-
-    x0 = dofs.x
-    # Make sure all leaders have the same x0.
-    mpi.comm_leaders.Bcast(x0)
     logger.info('  nparams: {}, nfuncs: {}'.format(dofs.nparams, dofs.nfuncs))
     logger.info('  x0: ' + str(x0))
 
     # Set up the list of parameter values to try
-    if centered:
-        nevals_jac = 2 * dofs.nparams
-        xs = np.zeros((dofs.nparams, nevals_jac))
-        for j in range(dofs.nparams):
-            xs[:, 2 * j] = x0[:] # I don't think I need np.copy(), but not 100% sure.
-            xs[j, 2 * j] = x0[j] + eps
-            xs[:, 2 * j + 1] = x0[:]
-            xs[j, 2 * j + 1] = x0[j] - eps
-    else:
-        # 1-sided differences
-        nevals_jac = dofs.nparams + 1
-        xs = np.zeros((dofs.nparams, nevals_jac))
-        xs[:, 0] = x0[:]
-        for j in range(dofs.nparams):
-            xs[:, j + 1] = x0[:]
-            xs[j, j + 1] = x0[j] + eps
-
-    # proc0_world will be responsible for detecting nvals, since
-    #proc0_world always does at least 1 function evaluation. Other
-    #procs cannot be trusted to evaluate nvals because they may
-    #not have any function evals, in which case they never create
-    #"evals", so the MPI reduce would fail.
-
-    #evals = np.zeros((dofs.nfuncs, nevals_jac))
-    evals = None
+    xs = fd_points(x0, eps, centered=centered, richardson=richardson)
+    nevals_jac = xs.shape[1]
+
+    def evaluate(j):
+        """
+        Evaluate the functions at column j of xs using this group,
+        returning the function values and the elapsed time. If the
+        evaluation raises an exception, None is returned for the
+        function values.
+        """
+        eval_start_time = time()
+        mpi.mobilize_workers(CALCULATE_F)
+        x = np.ascontiguousarray(xs[:, j])
+        mpi.comm_groups.Bcast(x, root=0)
+        dofs.set(x)
+
+        try:
+            f = dofs.f()
+        except:
+            logger.info("Exception caught during function evaluation")
+            f = None
+
+        return f, time() - eval_start_time
+
     if not mpi.proc0_world:
-        # All procs other than proc0_world should initialize evals
-        # before the nevals_jac loop, since they may not have any
-        # evals.
-        dofs.nvals = mpi.comm_leaders.bcast(dofs.nvals)
-        evals = np.zeros((dofs.nvals, nevals_jac))
-    # Do the hard work of evaluating the functions.
-    for j in range(nevals_jac):
-        # Handle only this group's share of the work:
-        if np.mod(j, mpi.ngroups) == mpi.rank_leaders:
-            mpi.mobilize_workers(CALCULATE_F)
-            x = xs[:, j]
-            mpi.comm_groups.bcast(x, root=0)
-            dofs.set(x)
-            
-            try:
-                f = dofs.f()
-            except:
-                logger.info("Exception caught during function evaluation")
-                f = np.full(prob.dofs.nvals, 1.0e12)
-                
-            if evals is None and mpi.proc0_world:
-                dofs.nvals = mpi.comm_leaders.bcast(dofs.nvals)
+        # Other group leaders repeatedly ask proc0_world for a column
+        # to evaluate until they are told to stop. To avoid waiting
+        # while proc0_world is busy with its own evaluations, the next
+        # task is always received ahead of time. Tasks are sent as
+        # [call number, column index], and results are sent as a float
+        # array containing the call number, the column index, the
+        # elapsed time, and the function values if the evaluation
+        # succeeded.
+        task = np.zeros(2, dtype='i')
+        mpi.comm_leaders.Recv(task, source=0, tag=TASK_TAG)
+        while task[1] >= 0:
+            epoch, j = task
+            task = np.zeros(2, dtype='i')
+            request = mpi.comm_leaders.Irecv(task, source=0, tag=TASK_TAG)
+            if request.Test() and task[1] == ABANDON:
+                # This group exceeded the timeout, and the column has
+                # been given to another group. A negative elapsed time
+                # tells proc0_world that it was skipped:
+                send_result(mpi, np.array([epoch, j, -1.0]))
+                break
+            f, elapsed = evaluate(j)
+            if f is None:
+                f = []
+            result = np.concatenate(([epoch, j, elapsed], f))
+            # proc0_world may receive a result that comes after the
+            # timeout only much later, so do not wait for it:
+            send_result(mpi, result)
+            request.Wait()
+
+    else:
+        # proc0_world hands out the columns from a queue, and
+        # evaluates columns itself in between.
+        queue = deque(j for j in range(nevals_jac)
+                      if (known_evals is None or j not in known_evals)
+                      and (speculative is None or j not in speculative['columns'].values()))
+        evals = None
+        if known_evals is not None and len(known_evals) > 0:
+            dofs.nvals = len(next(iter(known_evals.values())))
+            evals = np.zeros((dofs.nvals, nevals_jac))
+        done = np.full(nevals_jac, False)
+        if known_evals is not None:
+            done[list(known_evals.keys())] = True
+        failed = []
+        retries = np.zeros(nevals_jac, dtype=int)
+        times = np.zeros(nevals_jac)
+        groups = np.full(nevals_jac, -1)
+        # Columns sent to each group that have not yet been returned,
+        # and the time at which each group began its present column.
+        # Groups that do not take part in this call count as stopped:
+        assigned = [deque() for rank in range(mpi.ngroups)]
+        task_start = np.zeros(mpi.ngroups)
+        stopped = np.full(mpi.ngroups, True)
+        stopped[leaders] = False
+        if speculative is not None:
+            for rank, j in speculative['columns'].items():
+                assigned[rank].append(j)
+                task_start[rank] = speculative['start']
+
+        def pop_queue():
+            # Return the next column that still needs evaluating, or -1.
+            while len(queue) > 0:
+                j = queue.popleft()
+                if not done[j]:
+                    return j
+            return -1
+
+        def next_task(rank):
+            # Send the next column to a group leader, or tell it to stop.
+            j = pop_queue()
+            if j < 0:
+                stopped[rank] = True
+            else:
+                if len(assigned[rank]) == 0:
+                    task_start[rank] = time()
+                assigned[rank].append(j)
+                expect_result(mpi, rank)
+            send_task(mpi, rank, epoch, j)
+
+        def store(j, f, elapsed, rank):
+            nonlocal evals
+            if done[j]:
+                # This column was also given to another group, which
+                # finished first.
+                return
+            done[j] = True
+            times[j] = elapsed
+            groups[j] = rank
+            if f is None:
+                failed.append(j)
+                return
+            if evals is None:
+                dofs.nvals = len(f)
                 evals = np.zeros((dofs.nvals, nevals_jac))
-                
             evals[:, j] = f
-            #evals[:, j] = np.array([f() for f in dofs.funcs])
 
-    # Combine the results from all groups:
-    evals = mpi.comm_leaders.reduce(evals, op=MPI.SUM, root=0)
+        def check_timeouts():
+            # Give the columns of any group that has exceeded the
+            # timeout to other groups, and send that group no more work.
+            if timeout is None:
+                return
+            now = time()
+            for rank in range(1, mpi.ngroups):
+                if len(assigned[rank]) == 0 or now - task_start[rank] < timeout:
+                    continue
+                logger.warning('Group {} exceeded the timeout of {} s for column {}'.format(
+                    rank, timeout, assigned[rank][0]))
+                for j in assigned[rank]:
+                    if done[j]:
+                        continue
+                    if retries[j] < max_retries:
+                        retries[j] += 1
+                        queue.appendleft(j)
+                    else:
+                        store(j, None, now - task_start[rank], rank)
+                assigned[rank].clear()
+                if not stopped[rank]:
+                    send_task(mpi, rank, epoch, ABANDON)
+                    stopped[rank] = True
+
+        def receive(blocking):
+            # Handle results that have arrived from other groups. If
+            # blocking, wait until a result arrives, a column is put
+            # back in the queue, or all columns are done.
+            status = MPI.Status()
+            while True:
+                if not mpi.comm_leaders.Iprobe(source=MPI.ANY_SOURCE,
+                                               tag=RESULT_TAG, status=status):
+                    if not blocking:
+                        return
+                    check_timeouts()
+                    if len(queue) > 0 or np.all(done):
+                        return
+                    sleep(POLL_INTERVAL)
+                    continue
+
+                rank, result = receive_result(mpi, status)
+                if int(result[0]) != epoch or result[2] < 0:
+                    logger.info('Discarding a late or skipped result from group {}'.format(rank))
+                    continue
+                j = int(result[1])
+                if j in assigned[rank]:
+                    assigned[rank].remove(j)
+                    task_start[rank] = time()
+                f = result[3:] if len(result) > 3 else None
+                store(j, f, result[2], rank)
+                if not stopped[rank]:
+                    next_task(rank)
+                blocking = False
+
+        # Give each other group its first task, and one in reserve,
+        # counting a speculative evaluation in progress as one task:
+        for rank in leaders:
+            next_task(rank)
+            if not stopped[rank] and len(assigned[rank]) < 2:
+                next_task(rank)
+
+        while not np.all(done):
+            receive(False)
+            check_timeouts()
+            j = pop_queue()
+            if j >= 0:
+                f, elapsed = evaluate(j)
+                store(j, f, elapsed, 0)
+            else:
+                receive(True)
+
+        # Groups may still be working on columns that were also given
+        # to other groups. Tell them to stop when they are done:
+        for rank in leaders:
+            if not stopped[rank]:
+                send_task(mpi, rank, epoch, -1)
+
+        if len(failed) > 0:
+            if evals is None and dofs.nvals is not None:
+                evals = np.zeros((dofs.nvals, nevals_jac))
+            if evals is None:
+                all_failed = True
+            else:
+                logger.info('Using the penalty value for columns {}'.format(failed))
+                evals[:, failed] = penalty
+
+        if not apart_at_start:
+            # All procs return from this call together, so the results
+            # still on their way from groups that exceeded the timeout
+            # must be received here, unless those groups are hung:
+            if drain_timeout is None and timeout is not None:
+                drain_timeout = 10 * timeout
+            drain_results(mpi, drain_timeout)
+
+        total = np.sum(times)
+        logger.info('Finite difference tasks: total time {:.3g} s, max {:.3g} s, '
+                    'wall time {:.3g} s'.format(total, np.max(times),
+                                                time() - start_time))
+        if task_times is not None:
+            task_times['time'] = times
+            task_times['group'] = groups
 
     if not apart_at_start:
         mpi.stop_workers()
+        if not mpi.proc0_world:
+            wait_for_sends()
+        check_all_failed(mpi, all_failed)
+    elif all_failed:
+        raise RuntimeError('All function evaluations failed in fd_jac_mpi')
 
     # Only proc0_world will actually have the Jacobian.
     if not mpi.proc0_world:
         return (None, None, None)
 
+    if known_evals is not None:
+        for j, f in known_evals.items():
+            evals[:, j] = f
+
     # Use the evals to form the Jacobian
-    jac = np.zeros((dofs.nvals, dofs.nparams))
-    if centered:
-        for j in range(dofs.nparams):
-            jac[:, j] = (evals[:, 2 * j] - evals[:, 2 * j + 1]) / (2 * eps)
-    else:
-        # 1-sided differences:
-        for j in range(dofs.nparams):
-            jac[:, j] = (evals[:, j + 1] - evals[:, 0]) / eps
+    jac = fd_jac_from_evals(evals, eps, centered=centered, richardson=richardson)
 
     # Weird things may happen if we do not reset the state vector
     # to x0:
@@ -205,7 +684,135 @@ def fd_jac_mpi(dofs, mpi, x=None, eps=1e-7, centered=False):
     return jac, xs, evals
 
 
-def least_squares_mpi_solve(prob, mpi, grad=None, **kwargs):
+def f_speculative_mpi(dofs, mpi, x=None, eps=1e-7, leaders=None):
+    """
+    Evaluate the functions in dofs at the state vector x using group 0,
+    while each of the other groups begins evaluating one of the points
+    that a 1-sided finite-difference Jacobian at x would need. If the
+    optimizer later asks for the Jacobian at x, these evaluations can
+    be passed to fd_jac_mpi() as speculative, so groups that would
+    otherwise sit idle while group 0 works do useful work ahead of
+    time.
+
+    proc0_world does not wait for the other groups: they send their
+    results without blocking, and the results are received by the
+    next fd_jac_mpi(), or discarded by it or by available_leaders()
+    if they are not needed.
+
+    Only group leaders call this function, with their workers in the
+    worker loop. As for fd_jac_mpi(), proc0_world calls it directly,
+    and leaders gives the ranks of the other group leaders, sent into
+    mpi_leaders_task() by mobilize_available_leaders(). If leaders is
+    None, all other group leaders take part. If the argument x is not
+    supplied, the present state vector is used. x and eps only need
+    to be given on proc0_world.
+
+    This function returns a 2-tuple on proc0_world. The first entry
+    is the vector of function values at x, or None if the evaluation
+    raised an exception. The second entry describes the evaluations
+    begun by the other groups, to be passed to fd_jac_mpi(). Other
+    procs return (None, None).
+    """
+    if not mpi.proc0_groups:
+        return (None, None)
+
+    # Column 0 is x0 itself, and column j > 0 has dof j - 1
+    # perturbed, as in fd_jac_mpi:
+    if mpi.proc0_world:
+        if x is not None:
+            dofs.set(x)
+        x0 = dofs.x
+        # Number this call like a call to fd_jac_mpi, so the results
+        # can be told apart from those of other calls:
+        global fd_jac_calls
+        fd_jac_calls += 1
+        epoch = fd_jac_calls
+        if leaders is None:
+            leaders = list(range(1, mpi.ngroups))
+        columns = {rank: j + 1 for j, rank in enumerate(leaders[:dofs.nparams])}
+        for rank in leaders:
+            send_to_leaders(mpi, [rank], (epoch, x0, eps, columns.get(rank, -1)))
+        j = 0
+    else:
+        epoch, x0, eps, j = receive_from_proc0(mpi)
+        if j < 0:
+            return (None, None)
+
+    start_time = time()
+    x = np.copy(x0)
+    if j > 0:
+        x[j - 1] = x0[j - 1] + eps
+    mpi.mobilize_workers(CALCULATE_F)
+    mpi.comm_groups.Bcast(x, root=0)
+    dofs.set(x)
+    try:
+        f = dofs.f()
+    except:
+        logger.info("Exception caught during function evaluation")
+        f = None
+
+    if not mpi.proc0_world:
+        # Send the result in the same form as in fd_jac_mpi:
+        if f is None:
+            f = []
+        send_result(mpi, np.concatenate(([epoch, j, time() - start_time], f)))
+        return (None, None)
+
+    for rank in columns:
+        expect_result(mpi, rank)
+    speculative = {'epoch': epoch,
+                   'columns': columns,
+                   'start': start_time}
+    return (f, speculative)
+
+
+def broyden_update(jac, x0, f0, x1, f1, min_ratio=0.25):
+    """
+    Update an approximate Jacobian with Broyden's rank-one formula,
+
+    J1 = J0 + (f1 - f0 - J0 s) s^T / (s^T s),  with s = x1 - x0,
+
+    so that J1 satisfies the secant condition J1 s = f1 - f0.
+
+    Before updating, the linear model f0 + J0 s is checked against the
+    actual residuals f1: the ratio of the actual reduction in the sum
+    of squares, |f0|^2 - |f1|^2, to the reduction predicted by the
+    model, |f0|^2 - |f0 + J0 s|^2, should be at least min_ratio. If it
+    is not, or if the step is zero, the model is considered to have
+    degraded and None is returned, indicating that a new
+    finite-difference Jacobian should be computed.
+
+    Args:
+        jac: The Jacobian at x0, a 2D array of shape (nvals, nparams).
+        x0: The previous state vector.
+        f0: The residuals at x0.
+        x1: The new state vector.
+        f1: The residuals at x1.
+        min_ratio: The smallest acceptable ratio of actual to predicted
+          reduction.
+
+    Returns:
+        The updated Jacobian at x1, or None.
+    """
+    s = x1 - x0
+    ss = np.dot(s, s)
+    if ss == 0:
+        return None
+    f_predicted = f0 + jac @ s
+    cost0 = np.dot(f0, f0)
+    predicted_reduction = cost0 - np.dot(f_predicted, f_predicted)
+    actual_reduction = cost0 - np.dot(f1, f1)
+    if predicted_reduction <= 0 or actual_reduction < min_ratio * predicted_reduction:
+        logger.info("Broyden model degraded: actual reduction {}, predicted reduction "
+                    "{}".format(actual_reduction, predicted_reduction))
+        return None
+    return jac + np.outer(f1 - f_predicted, s) / ss
+
+
+def least_squares_mpi_solve(prob, mpi, grad=None, speculative=False,
+                            timeout=None, history=None, broyden=False,
+                            broyden_ratio=0.25, max_broyden_updates=None,
+                            **kwargs):
     """
     Solve a nonlinear-least-squares minimization problem using
     MPI. All MPI processes (including group leaders and workers)
@@ -215,6 +822,41 @@ def least_squares_mpi_solve(prob, mpi, grad=None, **kwargs):
 
     mpi should be an instance of MpiPartition.
 
+    If speculative is True and a finite-difference Jacobian is used,
+    then whenever the residuals are evaluated, the groups other than
+    group 0 simultaneously begin evaluating the first points needed
+    for the finite-difference Jacobian at the same state vector, using
+    f_speculative_mpi(). The residuals are returned to the optimizer
+    as soon as group 0 is done, without waiting for the other groups.
+    If the optimizer goes on to request that Jacobian, their results
+    are re-used.
+
+    timeout is the maximum number of seconds a group other than group 0
+    may spend on one function evaluation for a finite-difference
+    Jacobian before its work is given to other groups. See fd_jac_mpi().
+    It does not limit the evaluations done by group 0, including all
+    evaluations of the residuals requested by the optimizer. A group
+    that exceeds the timeout is left out until it finishes, and
+    proc0_world returns without waiting for it, even if it is hung;
+    the procs in that group return from this function once their
+    evaluation is done.
+
+    history can be a History object, to control where and how often
+    the record of function evaluations is written. It is only used on
+    proc0_world. If None, a History with the default settings is used.
+
+    If broyden is True and a finite-difference Jacobian is used, then
+    after the first finite-difference Jacobian, the Jacobian at each
+    new point is obtained from the previous one by a rank-one Broyden
+    update, using the residuals already evaluated at the new point,
+    so no further function evaluations are needed. To decide whether
+    the updated Jacobian can still be trusted, the reduction in the
+    sum of squares over the last step is compared with the reduction
+    predicted by the linear model. If the ratio of the two falls below
+    broyden_ratio, or after max_broyden_updates consecutive updates (if
+    not None), a new finite-difference Jacobian is computed with
+    fd_jac_mpi() instead.
+
     kwargs allows you to pass any arguments to scipy.optimize.minimize.
     """
     if MPI is None:
@@ -225,13 +867,29 @@ def least_squares_mpi_solve(prob, mpi, grad=None, **kwargs):
     if grad is None:
         grad = prob.dofs.grad_avail
 
-    x = np.copy(prob.x) # For use in Bcast later.
-
-    logfile = None
-    logfile_started = False
-    residuals_file = None
-    nevals = 0
-    start_time = time()
+    x = np.copy(prob.x) # The optimum, sent to all procs at the end.
+
+    if history is None and mpi.proc0_world:
+        history = History(prob.dofs.nparams)
+    # State vector, function values and evaluations begun by other
+    # groups, from the most recent speculative evaluation:
+    speculative_x = None
+    speculative_f = None
+    speculative_evals = None
+    # Finite-difference Jacobians are only computed here if grad is
+    # True but the functions do not provide derivatives:
+    fd_mode = grad and not prob.dofs.grad_avail
+    speculative = speculative and fd_mode
+    broyden = broyden and fd_mode
+    # The most recent function evaluation:
+    last_x = None
+    last_f_unshifted = None
+    # State of the Broyden approximation: the (scaled) Jacobian, and
+    # the point and shifted residuals at which it applies.
+    broyden_jac = None
+    broyden_x = None
+    broyden_f = None
+    nbroyden_updates = 0
 
     def _f_proc0(x):
         """
@@ -240,67 +898,32 @@ def least_squares_mpi_solve(prob, mpi, grad=None, **kwargs):
         proc 0 while workers are in the worker loop.
         """
         logger.debug("Entering _f_proc0")
-        mpi.mobilize_workers(CALCULATE_F)
-        # Send workers the state vector:
-        mpi.comm_groups.bcast(x, root=0)
-        logger.debug("Past bcast in _f_proc0")
+        nonlocal speculative_x, speculative_f, speculative_evals, last_x, last_f_unshifted
+        if speculative:
+            leaders = mobilize_available_leaders(mpi, CALCULATE_SPECULATIVE)
+            f_unshifted, speculative_evals = f_speculative_mpi(prob.dofs, mpi, x,
+                                                               leaders=leaders)
+            speculative_x = np.copy(x)
+            speculative_f = f_unshifted
+            if f_unshifted is None:
+                f_unshifted = np.full(prob.dofs.nvals, 1.0e12)
+        else:
+            mpi.mobilize_workers(CALCULATE_F)
+            # Send workers the state vector:
+            mpi.comm_groups.Bcast(x, root=0)
+            logger.debug("Past Bcast in _f_proc0")
 
-        try:
-            f_unshifted = prob.dofs.f(x)
-        except:
-            f_unshifted = np.full(prob.dofs.nvals, 1.0e12)
-            logger.info("Exception caught during function evaluation.")
+            try:
+                f_unshifted = prob.dofs.f(x)
+            except:
+                f_unshifted = np.full(prob.dofs.nvals, 1.0e12)
+                logger.info("Exception caught during function evaluation.")
 
+        last_x = np.copy(x)
+        last_f_unshifted = f_unshifted
         f_shifted = prob.f_from_unshifted(f_unshifted)
         objective_val = prob.objective_from_shifted_f(f_shifted)
-
-        nonlocal logfile_started, logfile, residuals_file, nevals
-
-        # Since the number of terms is not known until the first
-        # evaluation of the objective function, we cannot write the
-        # header of the output file until this first evaluation is
-        # done.
-        if not logfile_started:
-            # Initialize log file
-            logfile_started = True
-            datestr = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-            filename = "simsopt_" + datestr + ".dat"
-            logfile = open(filename, 'w')
-            logfile.write("Problem type:\nleast_squares\nnparams:\n{}\n".format(prob.dofs.nparams))
-            logfile.write("function_evaluation,seconds")
-            for j in range(prob.dofs.nparams):
-                logfile.write(",x({})".format(j))
-            logfile.write(",objective_function")
-            logfile.write("\n")
-
-            filename = "residuals_" + datestr + ".dat"
-            residuals_file = open(filename, 'w')
-            residuals_file.write("Problem type:\nleast_squares\nnparams:\n{}\n".format(prob.dofs.nparams))
-            residuals_file.write("function_evaluation,seconds")
-            for j in range(prob.dofs.nparams):
-                residuals_file.write(",x({})".format(j))
-            residuals_file.write(",objective_function")
-            for j in range(prob.dofs.nvals):
-                residuals_file.write(",F({})".format(j))
-            residuals_file.write("\n")
-
-        logfile.write("{:6d},{:12.4e}".format(nevals, time() - start_time))
-        for xj in x:
-            logfile.write(",{:24.16e}".format(xj))
-        logfile.write(",{:24.16e}".format(objective_val))
-        logfile.write("\n")
-        logfile.flush()
-
-        residuals_file.write("{:6d},{:12.4e}".format(nevals, time() - start_time))
-        for xj in x:
-            residuals_file.write(",{:24.16e}".format(xj))
-        residuals_file.write(",{:24.16e}".format(objective_val))
-        for fj in f_unshifted:
-            residuals_file.write(",{:24.16e}".format(fj))
-        residuals_file.write("\n")
-        residuals_file.flush()
-
-        nevals += 1
+        history.record(x, objective_val, f_unshifted)
         return f_shifted
 
     # End of _f_proc0
@@ -315,43 +938,58 @@ def least_squares_mpi_solve(prob, mpi, grad=None, **kwargs):
             # proc0_world calling mobilize_workers will mobilize only group 0.
             mpi.mobilize_workers(CALCULATE_JAC)
             # Send workers the state vector:
-            mpi.comm_groups.bcast(x, root=0)
+            mpi.comm_groups.Bcast(x, root=0)
 
             return prob.jac(x)
 
         else:
-            # Evaluate Jacobian using fd_jac_mpi
-            mpi.mobilize_leaders(CALCULATE_FD_JAC)
-            # Send leaders the state vector:
-            mpi.comm_leaders.bcast(x, root=0)
-
-            jac, xs, evals = fd_jac_mpi(prob.dofs, mpi, x)
+            nonlocal broyden_jac, broyden_x, broyden_f, nbroyden_updates, speculative_x
+            have_f = last_x is not None and np.array_equal(x, last_x)
+            if broyden and broyden_jac is not None and have_f:
+                f = prob.f_from_unshifted(last_f_unshifted)
+                jac = broyden_update(broyden_jac, broyden_x, broyden_f, x, f,
+                                     broyden_ratio)
+                if jac is not None and (max_broyden_updates is None
+                                        or nbroyden_updates < max_broyden_updates):
+                    nbroyden_updates += 1
+                    logger.info("Using Broyden update {} of the Jacobian".format(
+                        nbroyden_updates))
+                    broyden_jac, broyden_x, broyden_f = jac, np.copy(x), f
+                    return np.copy(jac)
 
-            # Write function evaluations to the files
-            nonlocal logfile_started, logfile, residuals_file, nevals
-            nevals_jac = evals.shape[1]
-            for j in range(nevals_jac):
+            # Evaluate Jacobian using fd_jac_mpi
+            known_evals = None
+            speculative_columns = None
+            if speculative_x is not None and np.array_equal(x, speculative_x):
+                speculative_columns = speculative_evals
+                if speculative_f is not None:
+                    known_evals = {0: speculative_f}
+            elif have_f:
+                known_evals = {0: last_f_unshifted}
+            # The speculative evaluations are used up or out of date
+            # after this call:
+            speculative_x = None
+            leaders = mobilize_available_leaders(mpi, CALCULATE_FD_JAC, speculative_columns)
+            jac, xs, evals = fd_jac_mpi(prob.dofs, mpi, x, known_evals=known_evals,
+                                        speculative=speculative_columns, timeout=timeout,
+                                        leaders=leaders)
+
+            # Record the function evaluations that were not already
+            # recorded, including the evaluation at x if it failed
+            # before and was repeated:
+            for j in range(evals.shape[1]):
+                if known_evals is not None and j in known_evals:
+                    continue
                 objective_val = prob.objective_from_unshifted_f(evals[:, j])
+                history.record(xs[:, j], objective_val, evals[:, j])
 
-                logfile.write("{:6d},{:12.4e}".format(nevals, time() - start_time))
-                for xj in xs[:, j]:
-                    logfile.write(",{:24.16e}".format(xj))
-                logfile.write(",{:24.16e}".format(objective_val))
-                logfile.write("\n")
-                logfile.flush()
-
-                residuals_file.write("{:6d},{:12.4e}".format(nevals, time() - start_time))
-                for xj in xs[:, j]:
-                    residuals_file.write(",{:24.16e}".format(xj))
-                residuals_file.write(",{:24.16e}".format(objective_val))
-                for fj in evals[:, j]:
-                    residuals_file.write(",{:24.16e}".format(fj))
-                residuals_file.write("\n")
-                residuals_file.flush()
-
-                nevals += 1
-
-            return prob.scale_dofs_jac(jac)
+            jac = prob.scale_dofs_jac(jac)
+            if broyden:
+                broyden_jac = np.copy(jac)
+                broyden_x = np.copy(x)
+                broyden_f = prob.f_from_unshifted(evals[:, 0])
+                nbroyden_updates = 0
+            return jac
 
     # End of _jac_proc0
     
@@ -360,35 +998,56 @@ def least_squares_mpi_solve(prob, mpi, grad=None, **kwargs):
     workers_action = lambda mpi2, data: mpi_workers_task(mpi, prob.dofs, data)
     mpi.apart(leaders_action, workers_action)
 
+    error = None
     if mpi.proc0_world:
         # proc0_world does this block, running the optimization.
         x0 = np.copy(prob.dofs.x)
         #print("x0:",x0)
-        # Call scipy.optimize:
-        if grad:
-            logger.info("Using derivatives")
-            print("Using derivatives")
-            result = least_squares(_f_proc0, x0, verbose=2, jac=_jac_proc0, **kwargs)
-        else:
-            logger.info("Using derivative-free method")
-            print("Using derivative-free method")
-            result = least_squares(_f_proc0, x0, verbose=2, **kwargs)
-
-        logger.info("Completed solve.")
-        x = result.x
-
-        logfile.close()
-        residuals_file.close()
+        # Call scipy.optimize. If it fails, the other procs must
+        # still be stopped and told about the failure:
+        try:
+            if grad:
+                logger.info("Using derivatives")
+                print("Using derivatives")
+                result = least_squares(_f_proc0, x0, verbose=2, jac=_jac_proc0, **kwargs)
+            else:
+                logger.info("Using derivative-free method")
+                print("Using derivative-free method")
+                result = least_squares(_f_proc0, x0, verbose=2, **kwargs)
+            logger.info("Completed solve.")
+            x = result.x
+        except Exception as err:
+            error = err
+
+        history.close()
+        # Results may still be on their way, e.g. from speculative
+        # evaluations that were not used, or from groups that exceeded
+        # the timeout and may never finish. Do not wait for them:
+        abandon_results(mpi, prob.dofs.nvals)
         
     # Stop loops for workers and group leaders:
     mpi.together()
 
-    logfile_started = False
+    # Finally, make sure all procs get the outcome and the optimal
+    # state vector. This is sent point-to-point to the other group
+    # leaders instead of broadcast over comm_world, so proc0_world
+    # does not wait for groups that are still busy:
+    if mpi.proc0_world:
+        outcome = (error is not None, x)
+        send_to_leaders(mpi, range(1, mpi.ngroups), outcome, tag=OUTCOME_TAG)
+    elif mpi.proc0_groups:
+        outcome = receive_from_proc0(mpi, tag=OUTCOME_TAG)
+        wait_for_sends()
+    else:
+        outcome = None
+    failed, x = mpi.comm_groups.bcast(outcome, root=0)
+    if failed:
+        if error is not None:
+            raise error
+        raise RuntimeError('The optimization failed on proc0_world')
+
     logger.info("Completed solve.")
-    
-    # Finally, make sure all procs get the optimal state vector.
-    mpi.comm_world.Bcast(x)
-    logger.debug('After Bcast, x={}'.format(x))
+    logger.debug('After bcast, x={}'.format(x))
     #print("optimum x:",result.x)
     #print("optimum residuals:",result.fun)
     #print("optimum cost function:",result.cost)
@@ -8,117 +8,111 @@ function. Eventually I can also put a serial_solve function here for
 general optimization problems.
 """
 
-from datetime import datetime
-from time import time
 import numpy as np
 from scipy.optimize import least_squares, minimize
 import logging
 
+from .history import History
+from ..core.dofs import scipy_fd_steps
+
 logger = logging.getLogger(__name__)
 
-def least_squares_serial_solve(prob, grad=None, **kwargs):
+def least_squares_serial_solve(prob, grad=None, history=None, validate=False,
+                               executor=None, **kwargs):
     """
     Solve a nonlinear-least-squares minimization problem using
     scipy.optimize, and without using any parallelization.
 
     prob should be a LeastSquaresProblem object.
 
+    history can be a History object, to control where and how often
+    the record of function evaluations is written. If None, a History
+    with the default settings is used.
+
+    If validate is True, then at each evaluation the objective function
+    is also computed by prob.objective(), and checked against the
+    value computed from the residuals. This doubles the number of
+    function evaluations, so it is only useful for debugging.
+
+    If executor is a concurrent.futures.Executor, such as a
+    ProcessPoolExecutor, and derivatives are not available, the
+    finite-difference Jacobian is computed by evaluating the functions
+    at the perturbed points in parallel using executor, instead of by
+    scipy. The function values already computed at the base point are
+    re-used, and the steps are the same scipy would use, including
+    diff_step if it is given. See Dofs.fd_jac().
+
     kwargs allows you to pass any arguments to scipy.optimize.least_squares.
     """
 
-    logfile = None
-    logfile_started = False
-    residuals_file = None
-    nevals = 0
-    start_time = time()
-    
+    # The most recent state vector and function values, so the
+    # finite-difference Jacobian need not evaluate the base point
+    # again:
+    last_x = None
+    last_f = None
+
     def objective(x):
-        nonlocal logfile_started, logfile, residuals_file, nevals
+        nonlocal last_x, last_f
         try:
             f_unshifted = prob.dofs.f(x)
         except:
             logger.info("Exception caught during function evaluation")
             f_unshifted = np.full(prob.dofs.nvals, 1.0e12)
+        last_x = np.copy(x)
+        last_f = f_unshifted
 
+        # The objective is computed from the residuals already
+        # evaluated, so each target function is called once per
+        # evaluation.
         f_shifted = prob.f_from_unshifted(f_unshifted)
         objective_val = prob.objective_from_shifted_f(f_shifted)
         
-        # Check that 2 ways of computing the objective give same
-        # answer within roundoff:
-        objective2 = prob.objective()
-        logger.info("objective_from_f={} objective={} diff={}".format(
-            objective_val, objective2, objective_val - objective2))
-        abs_diff = np.abs(objective_val - objective2)
-        rel_diff = abs_diff / (1e-12 + np.abs(objective_val + objective2))
-        assert (abs_diff < 1e-12) or (rel_diff < 1e-12)
+        if validate:
+            # Check that 2 ways of computing the objective give same
+            # answer within roundoff. This evaluates all the
+            # functions a second time.
+            objective2 = prob.objective()
+            logger.info("objective_from_f={} objective={} diff={}".format(
+                objective_val, objective2, objective_val - objective2))
+            abs_diff = np.abs(objective_val - objective2)
+            rel_diff = abs_diff / (1e-12 + np.abs(objective_val + objective2))
+            assert (abs_diff < 1e-12) or (rel_diff < 1e-12)
         
-        # Since the number of terms is not known until the first
-        # evaluation of the objective function, we cannot write the
-        # header of the output file until this first evaluation is
-        # done.
-        if not logfile_started:
-            # Initialize log file
-            logfile_started = True
-            datestr = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-            filename = "simsopt_" + datestr + ".dat"
-            logfile = open(filename, 'w')
-            logfile.write("Problem type:\nleast_squares\nnparams:\n{}\n".format(prob.dofs.nparams))
-            logfile.write("function_evaluation,seconds")
-            for j in range(prob.dofs.nparams):
-                logfile.write(",x({})".format(j))
-            logfile.write(",objective_function")
-            logfile.write("\n")
-            
-            filename = "residuals_" + datestr + ".dat"
-            residuals_file = open(filename, 'w')
-            residuals_file.write("Problem type:\nleast_squares\nnparams:\n{}\n".format(prob.dofs.nparams))
-            residuals_file.write("function_evaluation,seconds")
-            for j in range(prob.dofs.nparams):
-                residuals_file.write(",x({})".format(j))
-            residuals_file.write(",objective_function")
-            for j in range(prob.dofs.nvals):
-                residuals_file.write(",F({})".format(j))
-            residuals_file.write("\n")
-            
-        logfile.write("{:6d},{:12.4e}".format(nevals, time() - start_time))
-        for xj in x:
-            logfile.write(",{:24.16e}".format(xj))
-        logfile.write(",{:24.16e}".format(objective_val))
-        logfile.write("\n")
-        logfile.flush()
-
-        residuals_file.write("{:6d},{:12.4e}".format(nevals, time() - start_time))
-        for xj in x:
-            residuals_file.write(",{:24.16e}".format(xj))
-        residuals_file.write(",{:24.16e}".format(objective_val))
-        for fj in f_unshifted:
-            residuals_file.write(",{:24.16e}".format(fj))
-        residuals_file.write("\n")
-        residuals_file.flush()
-
-        nevals += 1
+        history.record(x, objective_val, f_unshifted)
         return f_shifted
 
+    def fd_jac(x):
+        f0 = None
+        if last_x is not None and np.array_equal(x, last_x):
+            f0 = last_f
+        eps = scipy_fd_steps(x, kwargs.get('diff_step'))
+        return prob.jac(x, executor=executor, f0=f0, eps=eps)
+
     logger.info("Beginning solve.")
     prob._init() # In case 'fixed', 'mins', etc have changed since the problem was created.
+    if history is None:
+        history = History(prob.dofs.nparams)
     if grad is None:
         grad = prob.dofs.grad_avail
         
     #if not 'verbose' in kwargs:
         
     x0 = np.copy(prob.x)
-    if grad:
-        logger.info("Using derivatives")
-        print("Using derivatives")
-        result = least_squares(objective, x0, verbose=2, jac=prob.jac, **kwargs)
-    else:
-        logger.info("Using derivative-free method")
-        print("Using derivative-free method")
-        result = least_squares(objective, x0, verbose=2, **kwargs)
-
-    logfile_started = False
-    logfile.close()
-    residuals_file.close()
+    try:
+        if grad:
+            logger.info("Using derivatives")
+            print("Using derivatives")
+            result = least_squares(objective, x0, verbose=2, jac=prob.jac, **kwargs)
+        elif executor is not None:
+            logger.info("Using derivative-free method with parallel finite differences")
+            print("Using derivative-free method with parallel finite differences")
+            result = least_squares(objective, x0, verbose=2, jac=fd_jac, **kwargs)
+        else:
+            logger.info("Using derivative-free method")
+            print("Using derivative-free method")
+            result = least_squares(objective, x0, verbose=2, **kwargs)
+    finally:
+        history.close()
     logger.info("Completed solve.")
     
     #print("optimum x:",result.x)
@@ -128,7 +122,7 @@ def least_squares_serial_solve(prob, grad=None, **kwargs):
     prob.x = result.x
 
 
-def serial_solve(prob, grad=None, **kwargs):
+def serial_solve(prob, grad=None, history=None, **kwargs):
     """
     Solve a general minimization problem (i.e. one that need not be of
     least-squares form) using scipy.optimize.minimize, and without using any
@@ -136,45 +130,23 @@ def serial_solve(prob, grad=None, **kwargs):
 
     prob should be a simsopt problem.
 
+    history can be a History object, to control where and how often
+    the record of function evaluations is written. If None, a History
+    with the default settings is used.
+
     kwargs allows you to pass any arguments to scipy.optimize.minimize.
     """
 
-    logfile = None
-    logfile_started = False
-    nevals = 0
-    start_time = time()
+    if history is None:
+        history = History(prob.dofs.nparams, problem_type='general')
     
     def objective(x):
-        nonlocal logfile_started, logfile, nevals
         try:
             result = prob.objective(x)
         except:
             result = 1e+12
         
-        # Since the number of terms is not known until the first
-        # evaluation of the objective function, we cannot write the
-        # header of the output file until this first evaluation is
-        # done.
-        if not logfile_started:
-            # Initialize log file
-            logfile_started = True
-            filename = "simsopt_" + datetime.now().strftime("%Y-%m-%d-%H-%M-%S") + ".dat"
-            logfile = open(filename, 'w')
-            logfile.write("Problem type:\ngeneral\nnparams:\n{}\n".format(prob.dofs.nparams))
-            logfile.write("function_evaluation,seconds")
-            for j in range(prob.dofs.nparams):
-                logfile.write(",x({})".format(j))
-            logfile.write(",objective_function")
-            logfile.write("\n")
-            
-        logfile.write("{:6d},{:12.4e}".format(nevals, time() - start_time))
-        for xj in x:
-            logfile.write(",{:24.16e}".format(xj))
-        logfile.write(",{:24.16e}".format(result))
-        logfile.write("\n")
-        logfile.flush()
-
-        nevals += 1
+        history.record(x, result)
         return result
 
     logger.info("Beginning solve.")
@@ -196,10 +168,11 @@ def serial_solve(prob, grad=None, **kwargs):
     else:
         logger.info("Using derivative-free method")
         print("Using derivative-free method")
-        result = minimize(objective, x0, options={'disp':True}, **kwargs)
+        try:
+            result = minimize(objective, x0, options={'disp':True}, **kwargs)
+        finally:
+            history.close()
 
-    logfile_started = False
-    logfile.close()
     logger.info("Completed solve.")
     
     #print("optimum x:",result.x)
@@ -19,6 +19,10 @@ except ImportError as err:
 
 STOP = 0
 
+# Tag of the messages from proc0_world to the other group leaders in
+# leaders_loop():
+SIGNAL_TAG = 1
+
 def log(level=logging.INFO):
     """
     Turn on logging. If MPI is available, the processor number will be
@@ -44,6 +48,9 @@ class MpiPartition:
             raise RuntimeError("MpiPartition class requires the mpi4py package.")
                 
         self.is_apart = False
+        # Signals sent to the group leaders that may not have been
+        # received yet, with their buffers:
+        self.pending_signals = []
         self.comm_world = comm_world
         self.rank_world = comm_world.Get_rank()
         self.nprocs_world = comm_world.Get_size()
@@ -109,13 +116,32 @@ class MpiPartition:
             tag = self.rank_world
             self.comm_world.send(data, 0, tag)
 
-    def mobilize_leaders(self, action_const):
+    def signal_leaders(self, data, ranks=None):
+        """
+        Send data to the group leaders with the given ranks in
+        comm_leaders, or to all of them if ranks is None. The messages
+        are point-to-point and proc0_world does not wait for them to be
+        received, so a group leader that is still busy, e.g. with an
+        evaluation that exceeded a timeout, does not hold up
+        proc0_world, and receives the message when it returns to
+        leaders_loop().
+        """
+        self.pending_signals = [(request, buffer) for request, buffer in self.pending_signals
+                                if not request.Test()]
+        if ranks is None:
+            ranks = range(1, self.nprocs_leaders)
+        for rank in ranks:
+            buffer = np.array([data], dtype='i')
+            request = self.comm_leaders.Isend(buffer, dest=rank, tag=SIGNAL_TAG)
+            self.pending_signals.append((request, buffer))
+
+    def mobilize_leaders(self, action_const, ranks=None):
         logger.debug('mobilize_leaders, action_const={}'.format(action_const))
         if not self.proc0_world:
             raise RuntimeError(
                 'Only proc0_world should call mobilize_leaders()')
 
-        self.comm_leaders.bcast(action_const, root=0)
+        self.signal_leaders(action_const, ranks)
 
     def mobilize_workers(self, action_const):
         logger.debug('mobilize_workers, action_const={}'.format(action_const))
@@ -123,23 +149,21 @@ class MpiPartition:
             raise RuntimeError(
                 'Only group leaders should call mobilize_workers()')
 
-        self.comm_groups.bcast(action_const, root=0)
+        self.comm_groups.Bcast(np.array([action_const], dtype='i'), root=0)
 
     def stop_leaders(self):
         logger.debug('stop_leaders')
         if not self.proc0_world:
             raise RuntimeError('Only proc0_world should call stop_leaders()')
 
-        data = STOP
-        self.comm_leaders.bcast(data, root=0)
+        self.signal_leaders(STOP)
 
     def stop_workers(self):
         logger.debug('stop_workers')
         if not self.proc0_groups:
             raise RuntimeError('Only proc0_groups should call stop_workers()')
 
-        data = STOP
-        self.comm_groups.bcast(data, root=0)
+        self.comm_groups.Bcast(np.array([STOP], dtype='i'), root=0)
 
     def leaders_loop(self, action):
         """
@@ -154,10 +178,11 @@ class MpiPartition:
 
         logger.debug('entering leaders_loop')
 
+        buffer = np.zeros(1, dtype='i')
         while True:
             # Wait for proc 0 to send us something:
-            data = None
-            data = self.comm_leaders.bcast(data, root=0)
+            self.comm_leaders.Recv(buffer, source=0, tag=SIGNAL_TAG)
+            data = int(buffer[0])
             logger.debug('leaders_loop received {}'.format(data))
             if data == STOP:
                 # Tell workers to stop
@@ -181,10 +206,11 @@ class MpiPartition:
 
         logger.debug('entering worker_loop')
 
+        buffer = np.zeros(1, dtype='i')
         while True:
             # Wait for the group leader to send us something:
-            data = None
-            data = self.comm_groups.bcast(data, root=0)
+            self.comm_groups.Bcast(buffer, root=0)
+            data = int(buffer[0])
             logger.debug('worker_loop worker received {}'.format(data))
             if data == STOP:
                 break
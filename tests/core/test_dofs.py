@@ -1,8 +1,45 @@
 import unittest
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
-from simsopt.core.dofs import get_owners, Dofs
+import scipy.sparse
+from simsopt.core.dofs import get_owners, Dofs, scipy_fd_steps
 from simsopt.core.functions import Identity, Adder, TestObject2, Rosenbrock, Affine
-from simsopt.core.optimizable import Target
+from simsopt.core.optimizable import Target, Optimizable
+
+class Trig(Optimizable):
+    """
+    A vector-valued function that is not a low-degree polynomial, with
+    optional noise of relative size noise, for testing finite
+    differences.
+    """
+    def __init__(self, noise=0.0):
+        self.x = np.array([0.3, -0.8, 1.7])
+        self.fixed = np.full(3, False)
+        self.noise = noise
+        self.ncalls = 0
+
+    def get_dofs(self):
+        return self.x
+
+    def set_dofs(self, x):
+        self.x = np.array(x)
+
+    def f(self):
+        self.ncalls += 1
+        f = np.array([np.sin(self.x[0]) * np.exp(self.x[1]) + 2,
+                      np.cos(self.x[2] * self.x[0]) + 3])
+        if self.noise > 0:
+            # Noise that is a deterministic function of x:
+            rng = np.random.default_rng(abs(hash(self.x.tobytes())))
+            f *= 1 + self.noise * rng.standard_normal(2)
+        return f
+
+    def df(self):
+        return np.array([[np.cos(self.x[0]) * np.exp(self.x[1]),
+                          np.sin(self.x[0]) * np.exp(self.x[1]), 0],
+                         [-self.x[2] * np.sin(self.x[2] * self.x[0]), 0,
+                          -self.x[0] * np.sin(self.x[2] * self.x[0])]])
+
 
 class GetOwnersTests(unittest.TestCase):
     def test_no_dependents(self):
@@ -93,6 +130,42 @@ class GetOwnersTests(unittest.TestCase):
         with self.assertRaises(RuntimeError):
             get_owners(o1)
 
+    def test_shared_dependency(self):
+        """
+        An object reached along two paths is not a circular dependency,
+        and is listed once for each path.
+        """
+        o1 = Identity()
+        o2 = Identity()
+        o3 = Identity()
+        o4 = Identity()
+        o1.depends_on = ["o2", "o3"]
+        o2.depends_on = ["o4"]
+        o3.depends_on = ["o4"]
+        o1.o2 = o2
+        o1.o3 = o3
+        o2.o4 = o4
+        o3.o4 = o4
+        memo = {}
+        self.assertEqual(get_owners(o1, memo), [o1, o2, o4, o3, o4])
+        self.assertEqual(get_owners(o3, memo), [o3, o4])
+        self.assertEqual(len(memo), 4)
+
+    def test_deep_chain(self):
+        """
+        A chain of dependencies longer than the recursion limit should
+        be handled, and a cycle at its end detected.
+        """
+        objs = [Identity() for j in range(5000)]
+        for j in range(len(objs) - 1):
+            objs[j].depends_on = ["next"]
+            objs[j].next = objs[j + 1]
+        self.assertEqual(get_owners(objs[0]), objs)
+        objs[-1].depends_on = ["next"]
+        objs[-1].next = objs[0]
+        with self.assertRaises(RuntimeError):
+            get_owners(objs[0])
+
 class DofsTests(unittest.TestCase):
     def test_no_dependents(self):
         """
@@ -168,6 +241,83 @@ class DofsTests(unittest.TestCase):
         self.assertEqual(dofs.dof_owners, [o2, o2, o1])
         np.testing.assert_allclose(dofs.indices, [0, 1, 1])
 
+    def test_index_maps(self):
+        """
+        Check the precomputed maps between the global state vector and
+        the dofs of each owner, and between the global Jacobian and
+        the gradient of each function.
+        """
+        o1 = Adder(3)
+        o2 = Adder(4)
+        o1.set_dofs([10, 11, 12])
+        o2.set_dofs([101, 102, 103, 104])
+        o1.fixed = [False, True, False]
+        o2.fixed = [True, False, False, True]
+        o1.depends_on = ["o2"]
+        o1.o2 = o2
+        dofs = Dofs([o1.J, o2.J])
+        self.assertEqual(dofs.all_owners, [o1, o2])
+        np.testing.assert_equal(dofs.owner_global_indices[0], [0, 1])
+        np.testing.assert_equal(dofs.owner_local_indices[0], [0, 2])
+        np.testing.assert_equal(dofs.owner_global_indices[1], [2, 3])
+        np.testing.assert_equal(dofs.owner_local_indices[1], [1, 2])
+        np.testing.assert_equal(dofs.func_global_cols[0], [0, 1, 2, 3])
+        np.testing.assert_equal(dofs.func_local_cols[0], [0, 2, 4, 5])
+        np.testing.assert_equal(dofs.func_global_cols[1], [2, 3])
+        np.testing.assert_equal(dofs.func_local_cols[1], [1, 2])
+
+        np.testing.assert_allclose(dofs.x, [10, 12, 102, 103])
+        dofs.set([-1, -2, -3, -4])
+        np.testing.assert_allclose(o1.x, [-1, 11, -2])
+        np.testing.assert_allclose(o2.x, [101, -3, -4, 104])
+        np.testing.assert_allclose(dofs.x, [-1, -2, -3, -4])
+
+    def test_set_skips_unchanged(self):
+        """
+        Dofs.set() should only call set_dofs() on owners whose dofs
+        changed, or which depend on an owner whose dofs changed.
+        """
+        o1 = Adder(2)
+        o2 = Adder(3)
+        o3 = Identity()
+        o3.fixed = [True]
+        o3.depends_on = ["o2"]
+        o3.o2 = o2
+        calls = {}
+        for name, obj in [('o1', o1), ('o2', o2), ('o3', o3)]:
+            def set_dofs(x, obj=obj, name=name, orig=obj.set_dofs):
+                calls[name] = calls.get(name, 0) + 1
+                orig(x)
+            obj.set_dofs = set_dofs
+        dofs = Dofs([o1.J, o3.J])
+        self.assertEqual(dofs.all_owners, [o1, o3, o2])
+        np.testing.assert_equal(dofs.owner_dependencies[1], [2])
+        x = dofs.x
+
+        # Nothing changes, so nothing should be updated:
+        dofs.set(x)
+        self.assertEqual(calls, {})
+        self.assertEqual(dofs.nskipped_set_dofs, 3)
+
+        # Change only a dof of o1:
+        x[1] = 7.0
+        dofs.set(x)
+        self.assertEqual(calls, {'o1': 1})
+        self.assertEqual(dofs.nskipped_set_dofs, 5)
+
+        # Change a dof of o2, which o3 depends on:
+        x[3] = -2.0
+        dofs.set(x)
+        self.assertEqual(calls, {'o1': 1, 'o2': 1, 'o3': 1})
+        self.assertEqual(dofs.nskipped_set_dofs, 6)
+        np.testing.assert_allclose(o1.x, [0, 7])
+        np.testing.assert_allclose(o2.x, [0, -2, 0])
+
+        # If an owner is modified directly, set() should restore it:
+        o2.x = np.array([1.0, 1.0, 1.0])
+        dofs.set(x)
+        np.testing.assert_allclose(o2.x, [0, -2, 0])
+
     def test_vector_valued(self):
         """
         For a function that returns a vector rather than a scalar, make
@@ -310,5 +460,159 @@ class DofsTests(unittest.TestCase):
                 self.assertEqual(list(dofs.nvals_per_func), nvals_per_func)
                 
 
+    def test_fd_jac_executor(self):
+        """
+        Dofs.fd_jac() with an executor should give the same result as
+        the serial calculation, without changing the state vector.
+        """
+        o = TestObject2(0.7, -1.3)
+        o.adder.set_dofs([0.4, -0.2])
+        o.t.adder1.set_dofs([1.1, 0.3, -0.6])
+        r = Rosenbrock(b=3.0)
+        r.set_dofs([0.5, 0.8])
+        r.fixed = [False, True]
+        dofs = Dofs([o.J, r.terms, o.t.J])
+        x0 = dofs.x
+        for centered in [False, True]:
+            fd_jac = dofs.fd_jac(centered=centered)
+            for executor in [ProcessPoolExecutor(max_workers=2),
+                             ThreadPoolExecutor(max_workers=2)]:
+                with executor:
+                    for chunksize in [1, 3, 100]:
+                        dofs.nvals = None
+                        jac = dofs.fd_jac(centered=centered, executor=executor,
+                                          chunksize=chunksize)
+                        np.testing.assert_allclose(jac, fd_jac, rtol=1e-13, atol=1e-13)
+                        np.testing.assert_equal(dofs.x, x0)
+                        self.assertEqual(dofs.nvals, 4)
+
+
+    def test_scipy_fd_steps(self):
+        """
+        Dofs.fd_jac() with the steps from scipy_fd_steps() should agree
+        with the finite differences of scipy.optimize.least_squares.
+        """
+        from scipy.optimize._numdiff import approx_derivative
+        o = Trig()
+        o.x = np.array([0.3, -2.5, 0.0])
+        dofs = Dofs([o.f])
+        x0 = dofs.x
+        for diff_step in [None, 1e-6]:
+            eps = scipy_fd_steps(x0, diff_step)
+            jac_scipy = approx_derivative(dofs.f, x0, method='2-point', rel_step=diff_step)
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                jac = dofs.fd_jac(eps=eps, executor=executor)
+            np.testing.assert_allclose(jac, jac_scipy, rtol=1e-6, atol=1e-6)
+
+    def test_fd_jac_richardson(self):
+        """
+        Richardson extrapolation should reduce the truncation error of
+        finite differences by the expected order in the step size.
+        """
+        o = Trig()
+        dofs = Dofs([o.f])
+        jac = dofs.jac()
+        for centered, order in [(False, 2), (True, 4)]:
+            errors = []
+            for eps in [1e-2, 5e-3]:
+                fd_jac = dofs.fd_jac(eps=eps, centered=centered, richardson=True)
+                errors.append(np.max(np.abs(fd_jac - jac)))
+            plain_error = np.max(np.abs(dofs.fd_jac(eps=5e-3, centered=centered) - jac))
+            self.assertLess(errors[1], plain_error)
+            self.assertAlmostEqual(np.log2(errors[0] / errors[1]), order, delta=0.3)
+
+    def test_fd_jac_f0(self):
+        """
+        Passing f0 to a 1-sided fd_jac should save exactly one function
+        evaluation, and an array of steps should be handled.
+        """
+        o = Trig()
+        dofs = Dofs([o.f])
+        eps = np.array([1e-7, 2e-7, 3e-7])
+        fd_jac = dofs.fd_jac(eps=eps)
+        o.ncalls = 0
+        fd_jac2 = dofs.fd_jac(eps=eps, f0=dofs.f())
+        self.assertEqual(o.ncalls, 1 + 3)
+        np.testing.assert_allclose(fd_jac2, fd_jac, rtol=1e-13, atol=1e-13)
+        np.testing.assert_allclose(fd_jac, dofs.jac(), rtol=1e-6, atol=1e-6)
+
+    def test_sparse_jac(self):
+        """
+        The sparse Jacobians and the sparsity pattern should agree with
+        the dense Jacobian, for objects that share dependencies.
+        """
+        o = TestObject2(0.7, -1.3)
+        o.adder.set_dofs([0.4, -0.2])
+        o.t.adder1.set_dofs([1.1, 0.3, -0.6])
+        r = Rosenbrock(b=3.0)
+        r.set_dofs([0.5, 0.8])
+        r.fixed = [False, True]
+        dofs = Dofs([o.J, r.terms, o.t.J])
+        jac = dofs.jac()
+        sparse_jac = dofs.jac(sparse=True)
+        self.assertTrue(scipy.sparse.issparse(sparse_jac))
+        np.testing.assert_allclose(sparse_jac.toarray(), jac, rtol=1e-15, atol=0)
+        # Every nonzero entry of the Jacobian is in the sparsity pattern:
+        sparsity = dofs.jac_sparsity().toarray()
+        self.assertTrue(np.all(sparsity[jac != 0] == 1))
+        # The Rosenbrock terms do not depend on the dofs of o:
+        np.testing.assert_equal(sparsity[1:3, :dofs.nparams - 1], 0)
+
+        for centered in [False, True]:
+            fd_jac = dofs.fd_jac(centered=centered)
+            grouped = dofs.fd_jac(centered=centered, grouped=True, sparse=True)
+            np.testing.assert_allclose(grouped.toarray(), fd_jac, rtol=1e-13, atol=1e-13)
+
+    def test_fd_jac_grouped(self):
+        """
+        For functions that each depend on separate objects, perturbing
+        the dofs in groups should give the same Jacobian with fewer
+        function evaluations.
+        """
+        objs = [Trig() for j in range(3)]
+        for j, o in enumerate(objs):
+            o.set_dofs(o.x + 0.1 * j)
+        dofs = Dofs([o.f for o in objs])
+        groups = dofs.column_groups()
+        self.assertEqual(len(groups), 3)
+        for j, group in enumerate(groups):
+            np.testing.assert_equal(group, [j, j + 3, j + 6])
+
+        for centered in [False, True]:
+            for richardson in [False, True]:
+                fd_jac = dofs.fd_jac(centered=centered, richardson=richardson)
+                for o in objs:
+                    o.ncalls = 0
+                grouped = dofs.fd_jac(centered=centered, richardson=richardson,
+                                      grouped=True)
+                # The dense Richardson stencil leaves rounding errors
+                # where the Jacobian vanishes:
+                np.testing.assert_allclose(grouped, fd_jac, rtol=1e-13, atol=1e-8)
+                npoints = (2 if centered else 1) * (2 if richardson else 1) * 3 \
+                    + (0 if centered else 1)
+                self.assertEqual(objs[0].ncalls, npoints)
+        np.testing.assert_allclose(dofs.fd_jac(grouped=True), dofs.jac(), rtol=1e-6, atol=1e-6)
+
+    def test_fd_noise_and_steps(self):
+        """
+        The estimated noise should be close to the noise added to the
+        functions, and the steps should scale with the dofs.
+        """
+        for noise in [1e-6, 1e-9]:
+            o = Trig(noise=noise)
+            dofs = Dofs([o.f])
+            estimate = dofs.fd_noise(npoints=20)
+            self.assertGreater(estimate, noise / 4)
+            self.assertLess(estimate, noise * 4)
+
+            steps = dofs.fd_steps(noise=noise)
+            np.testing.assert_allclose(steps, 2 * np.sqrt(noise) * np.array([1, 1, 1.7]))
+            fd_jac = dofs.fd_jac(eps=steps)
+            np.testing.assert_allclose(fd_jac, dofs.jac(), atol=100 * np.sqrt(noise))
+        # Without noise, the estimate should be near machine precision:
+        o = Trig()
+        self.assertLess(Dofs([o.f]).fd_noise(), 1e-12)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -2,6 +2,31 @@ import unittest
 import numpy as np
 from simsopt.core.optimizable import Optimizable
 from simsopt.core.functions import Adder
+from simsopt.core.dofs import Dofs
+
+
+class Cached(Optimizable):
+    """
+    An object that depends on another object through depends_on, and
+    caches a result computed from it.
+    """
+    def __init__(self, parent):
+        self.parent = parent
+        self.depends_on = ['parent']
+        self.ncomputes = 0
+
+    def get_dofs(self):
+        return np.array([])
+
+    def set_dofs(self, x):
+        pass
+
+    def J(self):
+        if self.is_stale():
+            self.result = 2 * self.parent.J()
+            self.ncomputes += 1
+            self.mark_current()
+        return self.result
 
 class OptimizableTests(unittest.TestCase):
     def test_index(self):
@@ -40,5 +65,47 @@ class OptimizableTests(unittest.TestCase):
         o.set_fixed('gee', False)
         self.assertFalse(o.get_fixed('gee'))
         
+    def test_versions(self):
+        """
+        A change to a dof should make only the objects downstream of it
+        stale.
+        """
+        a1 = Adder(2)
+        a1.names = ['x0', 'x1']
+        a2 = Adder(2)
+        c1 = Cached(a1)
+        c2 = Cached(Cached(a2))
+        self.assertTrue(c1.is_stale())
+        self.assertTrue(c1.need_to_run_code)
+        self.assertEqual(c2.J(), 0)
+        self.assertFalse(c2.is_stale())
+        self.assertFalse(c2.parent.is_stale())
+
+        dofs = Dofs([c1.J, c2.J])
+        dofs.set([1.0, 2.0, 0.0, 0.0])
+        self.assertTrue(c1.is_stale())
+        self.assertFalse(c2.is_stale())
+        np.testing.assert_allclose(dofs.f(), [6.0, 0.0])
+        self.assertEqual(c1.ncomputes, 1)
+        self.assertEqual(c2.ncomputes, 1)
+
+        # A change at the bottom of the chain should propagate up:
+        dofs.set([1.0, 2.0, 0.0, 0.5])
+        self.assertTrue(c2.is_stale())
+        self.assertTrue(c2.parent.is_stale())
+        np.testing.assert_allclose(dofs.f(), [6.0, 2.0])
+        self.assertEqual(c1.ncomputes, 1)
+        self.assertEqual(c2.ncomputes, 2)
+
+        # Changes made outside of Dofs should also be noticed:
+        a1.set('x0', 3.0)
+        self.assertEqual(c1.J(), 10.0)
+        c1.need_to_run_code = True
+        c1.J()
+        self.assertEqual(c1.ncomputes, 3)
+        c1.need_to_run_code = False
+        c1.J()
+        self.assertEqual(c1.ncomputes, 3)
+
 if __name__ == "__main__":
     unittest.main()
@@ -4,6 +4,7 @@ import numpy as np
 
 from simsopt.geo.curvexyzfourier import CurveXYZFourier
 from simsopt.geo.biotsavart import BiotSavart
+from simsopt.geo.curve import RotatedCurve
 
 
 def get_coil(num_quadrature_points=200):
@@ -15,6 +16,33 @@ def get_coil(num_quadrature_points=200):
     coil.set_dofs(np.concatenate(coeffs))
     return coil
 
+
+def compute_A_python(coils, currents, points):
+    """
+    Reference implementation of the vector potential and its first two
+    derivatives, as in the original pure Python BiotSavart.compute_A.
+    """
+    A = np.zeros((len(points), 3))
+    dA_by_dX = np.zeros((len(points), 3, 3))
+    d2A_by_dXdX = np.zeros((len(points), 3, 3, 3))
+    for coil, current in zip(coils, currents):
+        gamma = coil.gamma()
+        dgamma_by_dphi = coil.gammadash()
+        fak = current * 1e-7 / gamma.shape[0]
+        for i, point in enumerate(points):
+            diff = point - gamma
+            dist = np.linalg.norm(diff, axis=1)
+            A[i, :] += fak * np.sum((1./dist)[:, None] * dgamma_by_dphi, axis=0)
+            for j in range(3):
+                dA_by_dX[i, j, :] += fak * np.sum(-(diff[:, j]/dist**3)[:, None] * dgamma_by_dphi, axis=0)
+            for j1 in range(3):
+                for j2 in range(3):
+                    term1 = 3 * (diff[:, j1] * diff[:, j2]/dist**5)[:, None] * dgamma_by_dphi
+                    term2 = - (1./dist**3)[:, None] * dgamma_by_dphi if j1 == j2 else 0
+                    d2A_by_dXdX[i, j1, j2, :] += fak * np.sum(term1 + term2, axis=0)
+    return A, dA_by_dX, d2A_by_dXdX
+
+
 class Testing(unittest.TestCase):
 
     def test_biotsavart_both_interfaces_give_same_result(self):
@@ -27,6 +55,102 @@ class Testing(unittest.TestCase):
         assert np.linalg.norm(B1) > 1e-5
         assert np.allclose(B1, B2)
 
+    def test_biotsavart_fused_matches_per_coil(self):
+        """
+        Accumulating the current-weighted field in the kernel should give
+        the same result as summing the fields of the individual coils,
+        also for a number of points that is not a multiple of the block
+        size or the SIMD width.
+        """
+        np.random.seed(1)
+        coils = [get_coil(), get_coil(150)]
+        coils[1].set_dofs(np.asarray(coils[1].get_dofs()) + 0.05 * np.random.rand(coils[1].num_dofs()))
+        currents = [1e4, -3e3]
+        points = np.asarray(301 * [[-1.41513202e-03,  8.99999382e-01, -3.14473221e-04]])
+        points += 0.1 * (np.random.rand(*points.shape) - 0.5)
+        bs = BiotSavart(coils, currents).set_points(points)
+        B_fused = bs.B(compute_derivatives=2)
+        dB_fused = bs.dB_by_dX()
+        d2B_fused = bs.d2B_by_dXdX()
+        self.assertIsNone(bs._dB_by_dcoilcurrents)
+
+        bs.compute(points, compute_derivatives=2)
+        self.assertEqual(len(bs.dB_by_dcoilcurrents()), 2)
+        np.testing.assert_allclose(B_fused, bs._B, rtol=1e-13, atol=1e-13)
+        np.testing.assert_allclose(dB_fused, bs._dB_by_dX, rtol=1e-13, atol=1e-12)
+        np.testing.assert_allclose(d2B_fused, bs._d2B_by_dXdX, rtol=1e-13, atol=1e-11)
+
+    def test_biotsavart_treecode(self):
+        """
+        The treecode should agree with the direct sum to rounding error
+        for tol=0, and to within tol otherwise.
+        """
+        np.random.seed(1)
+        coils = []
+        for phi in np.linspace(0, 2 * np.pi, 16, endpoint=False):
+            coil = CurveXYZFourier(100, 1)
+            coil.set_dofs([np.cos(phi), 0, 0.3 * np.cos(phi),
+                           np.sin(phi), 0, 0.3 * np.sin(phi),
+                           0, 0.3, 0])
+            coils.append(coil)
+        currents = 1e5 * (1 + 0.1 * np.random.rand(len(coils)))
+        phi = 2 * np.pi * np.random.rand(500)
+        r = 1 + 0.15 * (np.random.rand(500) - 0.5)
+        points = np.stack((r * np.cos(phi), r * np.sin(phi), 0.15 * (np.random.rand(500) - 0.5)), axis=1)
+        bs = BiotSavart(coils, currents).set_points(points)
+        B = bs.B(compute_derivatives=1)
+        dB = bs.dB_by_dX()
+        for tol in [0, 1e-3]:
+            with self.subTest(tol=tol):
+                bs.set_points(points, tol=tol)
+                B_tree = bs.B(compute_derivatives=1)
+                dB_tree = bs.dB_by_dX()
+                rtol = max(tol, 1e-12)
+                self.assertLess(np.max(np.linalg.norm(B_tree - B, axis=1) / np.linalg.norm(B, axis=1)), rtol)
+                self.assertLess(np.max(np.linalg.norm(dB_tree - dB, axis=(1, 2)) / np.linalg.norm(dB, axis=(1, 2))), rtol)
+        # The second derivatives are computed directly:
+        np.testing.assert_allclose(bs.d2B_by_dXdX(), BiotSavart(coils, currents).set_points(points).d2B_by_dXdX())
+        with self.assertRaises(ValueError):
+            bs.set_points(points, tol=-1)
+
+    def test_biotsavart_symmetry(self):
+        """
+        Passing the base coils with nfp and stellsym should give the same
+        result as passing all rotated copies of the coils.
+        """
+        nfp = 3
+        np.random.seed(1)
+        base_coils = [get_coil(), get_coil()]
+        base_coils[1].set_dofs(base_coils[1].get_dofs() + 0.01 * np.random.rand(base_coils[1].num_dofs()))
+        base_currents = [1e4, -2e4]
+        points = np.random.rand(20, 3)
+        v = np.random.rand(20, 3)
+        vgrad = np.random.rand(20, 3, 3)
+        for stellsym in [False, True]:
+            with self.subTest(stellsym=stellsym):
+                coils = []
+                currents = []
+                for k in range(nfp):
+                    for flip in ([False, True] if stellsym else [False]):
+                        coils += [RotatedCurve(coil, 2 * np.pi * k / nfp, flip) for coil in base_coils]
+                        currents += base_currents
+                bs = BiotSavart(coils, currents).set_points(points)
+                bs_sym = BiotSavart(base_coils, base_currents, nfp=nfp, stellsym=stellsym).set_points(points)
+                np.testing.assert_allclose(bs_sym.B(compute_derivatives=2), bs.B(compute_derivatives=2), rtol=1e-10)
+                np.testing.assert_allclose(bs_sym.dB_by_dX(), bs.dB_by_dX(), rtol=1e-10)
+                np.testing.assert_allclose(bs_sym.d2B_by_dXdX(), bs.d2B_by_dXdX(), rtol=1e-10)
+                np.testing.assert_allclose(bs_sym.A(compute_derivatives=1), bs.A(compute_derivatives=1), rtol=1e-10)
+                np.testing.assert_allclose(bs_sym.dA_by_dX(), bs.dA_by_dX(), rtol=1e-10)
+                # The derivatives with respect to the currents and the dofs
+                # of the base coils are the sums over their copies:
+                dB_by_dcoilcurrents = bs.dB_by_dcoilcurrents()
+                res_B, res_dB = bs.B_and_dB_vjp(v, vgrad)
+                res_B_sym, res_dB_sym = bs_sym.B_and_dB_vjp(v, vgrad)
+                for i in range(len(base_coils)):
+                    np.testing.assert_allclose(bs_sym.dB_by_dcoilcurrents()[i], sum(dB_by_dcoilcurrents[i::len(base_coils)]), rtol=1e-10)
+                    np.testing.assert_allclose(res_B_sym[i], sum(res_B[i::len(base_coils)]), rtol=1e-10)
+                    np.testing.assert_allclose(res_dB_sym[i], sum(res_dB[i::len(base_coils)]), rtol=1e-10)
+
     def test_biotsavart_exponential_convergence(self):
         coil = get_coil()
         from time import time
@@ -234,6 +358,54 @@ class Testing(unittest.TestCase):
                 assert new_err < 0.55 * err
                 err = new_err
 
+    def test_biotsavart_A_matches_python(self):
+        """
+        The vector potential computed by the SIMD kernel should agree
+        with the reference Python implementation, for several coils and
+        a number of points that is not a multiple of the SIMD width.
+        """
+        np.random.seed(1)
+        coils = [get_coil(), get_coil(150)]
+        coils[1].set_dofs(np.asarray(coils[1].get_dofs()) + 0.05 * np.random.rand(coils[1].num_dofs()))
+        currents = [1e4, -3e3]
+        points = np.asarray(19 * [[-1.41513202e-03,  8.99999382e-01, -3.14473221e-04]])
+        points += 0.1 * (np.random.rand(*points.shape) - 0.5)
+        bs = BiotSavart(coils, currents).set_points(points)
+        A, dA_by_dX, d2A_by_dXdX = compute_A_python(coils, currents, points)
+        np.testing.assert_allclose(bs.A(compute_derivatives=2), A, rtol=1e-12, atol=1e-15)
+        np.testing.assert_allclose(bs.dA_by_dX(), dA_by_dX, rtol=1e-12, atol=1e-14)
+        np.testing.assert_allclose(bs.d2A_by_dXdX(), d2A_by_dXdX, rtol=1e-12, atol=1e-13)
+
+    def test_dA_by_dcoilcoeff_reverse_taylortest(self):
+        np.random.seed(1)
+        coil = get_coil()
+        bs = BiotSavart([coil], [1e4])
+        points = np.asarray(17 * [[-1.41513202e-03,  8.99999382e-01, -3.14473221e-04 ]])
+        points += 0.001 * (np.random.rand(*points.shape)-0.5)
+
+        bs.set_points(points)
+        coil_dofs = np.asarray(coil.get_dofs())
+        A = bs.A()
+        dAdX = bs.dA_by_dX()
+        J0 = [np.sum(A**2), np.sum(dAdX**2)]
+        dJ = bs.A_and_dA_vjp(A, dAdX)
+        np.testing.assert_allclose(bs.A_vjp(A)[0], dJ[0][0])
+
+        h = 1e-2 * np.random.rand(len(coil_dofs)).reshape(coil_dofs.shape)
+        for idx in range(2):
+            dJ_dh = 2*np.sum(dJ[idx][0] * h)
+            err = 1e6
+            for i in range(5, 10):
+                eps = 0.5**i
+                coil.set_dofs(coil_dofs + eps * h)
+                bs.clear_cached_properties()
+                Jh = np.sum(bs.A()**2) if idx == 0 else np.sum(bs.dA_by_dX()**2)
+                deriv_est = (Jh-J0[idx])/eps
+                err_new = np.linalg.norm(deriv_est-dJ_dh)
+                assert err_new < 0.55 * err
+                err = err_new
+            coil.set_dofs(coil_dofs)
+
     def test_biotsavart_dAdX_taylortest(self):
         for idx in [0, 16]:
             with self.subTest(idx=idx):
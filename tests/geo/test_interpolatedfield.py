@@ -0,0 +1,96 @@
+import unittest
+
+import numpy as np
+
+from simsopt.geo.curvexyzfourier import CurveXYZFourier
+from simsopt.geo.biotsavart import BiotSavart
+from simsopt.geo.interpolatedfield import InterpolatedField
+
+
+def get_ring_of_coils(ncoils):
+    """
+    Circular coils with minor radius 0.3, centered on the unit circle in
+    the plane z=0. The field is invariant under rotation by 2 pi/ncoils,
+    and stellarator symmetric.
+    """
+    coils = []
+    for phi in np.linspace(0, 2 * np.pi, ncoils, endpoint=False):
+        coil = CurveXYZFourier(100, 1)
+        coil.set_dofs([np.cos(phi), 0, 0.3 * np.cos(phi),
+                       np.sin(phi), 0, 0.3 * np.sin(phi),
+                       0, 0.3, 0])
+        coils.append(coil)
+    return coils
+
+
+class Testing(unittest.TestCase):
+
+    def test_interpolated_field_convergence(self):
+        """
+        The interpolated field should agree with the Biot-Savart law, and
+        the error should decrease at the expected rate as the grid is
+        refined, with and without stellarator symmetry.
+        """
+        ncoils = 8
+        coils = get_ring_of_coils(ncoils)
+        currents = ncoils * [1e5]
+        np.random.seed(1)
+        phi = 2 * np.pi * np.random.rand(200)
+        r = 1 + 0.3 * (np.random.rand(200) - 0.5)
+        points = np.stack((r * np.cos(phi), r * np.sin(phi), 0.3 * (np.random.rand(200) - 0.5)), axis=1)
+        bs = BiotSavart(coils, currents).set_points(points)
+        B = bs.B(compute_derivatives=1)
+        dB = bs.dB_by_dX()
+        for stellsym in [False, True]:
+            with self.subTest(stellsym=stellsym):
+                errs = []
+                estimates = []
+                for n in [4, 8]:
+                    nphi = n if stellsym else 2 * n
+                    field = InterpolatedField(BiotSavart(coils, currents), (0.8, 1.2), (-0.15, 0.15), n, nphi, n,
+                                              degree=3, nfp=ncoils, stellsym=stellsym)
+                    field.set_points(points)
+                    B_interp = field.B(compute_derivatives=1)
+                    dB_interp = field.dB_by_dX()
+                    err_B = np.max(np.linalg.norm(B_interp - B, axis=1) / np.linalg.norm(B, axis=1))
+                    err_dB = np.max(np.linalg.norm(dB_interp - dB, axis=(1, 2)) / np.linalg.norm(dB, axis=(1, 2)))
+                    errs.append((err_B, err_dB))
+                    estimates.append(field.estimate_error(200))
+                    self.assertLess(estimates[-1][1], estimates[-1][0])
+                self.assertLess(errs[1][0], 1e-3)
+                # Tricubic interpolation converges with order 4 in B and
+                # order 3 in its derivative:
+                self.assertLess(errs[1][0], errs[0][0] / 8)
+                self.assertLess(errs[1][1], errs[0][1] / 4)
+                self.assertLess(estimates[1][0], estimates[0][0])
+
+    def test_interpolated_field_outside(self):
+        coils = get_ring_of_coils(4)
+        field = InterpolatedField(BiotSavart(coils, 4 * [1e5]), (0.8, 1.2), (-0.15, 0.15), 2, 2, 2, nfp=4, stellsym=True)
+        field.set_points(np.asarray([[1., 0., 0.2], [0.5, 0., 0.], [1., 0., 0.]]))
+        B = field.B()
+        self.assertTrue(np.all(np.isnan(B[:2])))
+        self.assertFalse(np.any(np.isnan(B[2])))
+        with self.assertRaises(ValueError):
+            InterpolatedField(BiotSavart(coils, 4 * [1e5]), (0.8, 1.2), (-0.1, 0.15), 2, 2, 2, nfp=4, stellsym=True)
+
+    def test_interpolated_field_points(self):
+        """
+        Evaluating the interpolated field before set_points() should give
+        a clear error, and building and checking the interpolant should
+        not change the points of the field that is interpolated.
+        """
+        coils = get_ring_of_coils(4)
+        bs = BiotSavart(coils, 4 * [1e5])
+        points = np.asarray([[1., 0., 0.1], [0., 1.1, -0.1]])
+        B = bs.set_points(points).B()
+        field = InterpolatedField(bs, (0.8, 1.2), (-0.15, 0.15), 2, 2, 2, nfp=4, stellsym=True)
+        with self.assertRaises(RuntimeError):
+            field.B()
+        field.estimate_error(10)
+        self.assertIs(bs.points, points)
+        np.testing.assert_allclose(bs.B(), B)
+
+
+if __name__ == "__main__":
+    unittest.main()
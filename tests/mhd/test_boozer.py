@@ -2,9 +2,11 @@ import unittest
 import numpy as np
 import os
 import logging
+from mpi4py import MPI
 from scipy.io import netcdf
 from simsopt.mhd.boozer import Boozer, Quasisymmetry, booz_xform_found
 from simsopt.mhd.vmec import Vmec, vmec_found
+from simsopt.util.mpi import MpiPartition
 from . import TEST_DIR
 
 logger = logging.getLogger(__name__)
@@ -46,6 +48,7 @@ class MockBoozer():
     def __init__(self, mpol, ntor, nfp):
         self.bx = MockBoozXform(mpol, ntor, nfp)
         self.s_to_index = {0: 0, 1: 1}
+        self.s_used = {0: 0.25, 1: 0.75}
         self.mpi = None
         
     def register(self, s):
@@ -88,6 +91,37 @@ class QuasisymmetryTests(unittest.TestCase):
         np.testing.assert_allclose(q.J(), [2, 3, 4, 5, 6, 8, 9, 10, 11, 12, 14, 15, 16, 17, 18])
 
         
+    def test_multiple_surfaces(self):
+        """
+        The residuals for several surfaces should be the residuals for
+        each surface in turn, for all the options.
+        """
+        b = MockBoozer(3, 2, 4)
+        for m, n in [(1, 0), (0, 1), (1, 1), (1, -1)]:
+            for normalization in ["B00", "symmetric"]:
+                for weight in ["even", "stellopt", "stellopt_ornl"]:
+                    q = Quasisymmetry(b, (0, 1), m, n, normalization, weight)
+                    q0 = Quasisymmetry(b, 0, m, n, normalization, weight)
+                    q1 = Quasisymmetry(b, 1, m, n, normalization, weight)
+                    residuals = q.J()
+                    np.testing.assert_allclose(residuals, np.concatenate((q0.J(), q1.J())))
+                    if weight == "stellopt_ornl":
+                        self.assertEqual(len(residuals), 2)
+                    # The mode masks are re-used for the same resolution:
+                    masks = q.symmetric
+                    np.testing.assert_allclose(q.J(), residuals)
+                    self.assertIs(q.symmetric, masks)
+
+        q = Quasisymmetry(b, 0, 1, 0, "B00", "even")
+        self.assertEqual(len(q.J()), 14)
+        # A change in the resolution should give new masks:
+        b.bx = MockBoozXform(2, 2, 4)
+        self.assertEqual(len(q.J()), 10)
+        self.assertEqual(len(q.symmetric), 13)
+        # So should a change in the helicity:
+        q.m, q.n = 1, 1
+        np.testing.assert_allclose(q.J(), Quasisymmetry(b, 0, 1, 1, "B00", "even").J())
+
     @unittest.skipIf(not booz_xform_found, "booz_xform python package not found")
     def test_boozer_register(self):
         b1 = Boozer(None)
@@ -180,6 +214,56 @@ class QuasisymmetryTests(unittest.TestCase):
                                    atol=atol, rtol=rtol)
 
         
+    @unittest.skipIf((not booz_xform_found) or (not vmec_found),
+                     "vmec or booz_xform python package not found")
+    def test_boozer_mpi_groups(self):
+        """
+        When the surfaces are divided among the procs of each group,
+        the group leaders should end up with the results for all the
+        surfaces, in the right order.
+        """
+        f = netcdf.netcdf_file(os.path.join(TEST_DIR, "boozmn_circular_tokamak.nc"),
+                               mmap=False)
+        bmnc_ref = f.variables["bmnc_b"][()].transpose()
+        f.close()
+        for ngroups in range(1, 1 + MPI.COMM_WORLD.Get_size()):
+            mpi = MpiPartition(ngroups=ngroups)
+            v = Vmec(os.path.join(TEST_DIR, "input.circular_tokamak"), mpi=mpi)
+            b = Boozer(v, mpol=48, ntor=0)
+            qs = Quasisymmetry(b, [0.5, 1.0, 0.1], 0, 1)
+            residuals = qs.J()
+            if mpi.proc0_groups:
+                np.testing.assert_allclose(b.bx.compute_surfs, [1, 7, 15])
+                np.testing.assert_allclose(b.bx.bmnc_b, bmnc_ref[:, [1, 7, 15]],
+                                           atol=1e-12, rtol=1e-12)
+                self.assertEqual(len(residuals), 3 * (len(b.bx.xm_b) - 1))
+            else:
+                self.assertEqual(len(residuals), 0)
+
+    @unittest.skipIf((not booz_xform_found) or (not vmec_found),
+                     "vmec or booz_xform python package not found")
+    def test_boozer_leaders_only(self):
+        """
+        With parallel=False, Boozer.run() should work when it is called
+        only by the group leaders.
+        """
+        f = netcdf.netcdf_file(os.path.join(TEST_DIR, "boozmn_circular_tokamak.nc"),
+                               mmap=False)
+        bmnc_ref = f.variables["bmnc_b"][()].transpose()
+        f.close()
+        for ngroups in range(1, 1 + MPI.COMM_WORLD.Get_size()):
+            mpi = MpiPartition(ngroups=ngroups)
+            v = Vmec(os.path.join(TEST_DIR, "input.circular_tokamak"), mpi=mpi)
+            # VMEC itself runs on all procs in the group:
+            v.run()
+            b = Boozer(v, mpol=48, ntor=0, parallel=False)
+            qs = Quasisymmetry(b, [0.5, 1.0, 0.1], 0, 1)
+            if mpi.proc0_groups:
+                residuals = qs.J()
+                np.testing.assert_allclose(b.bx.bmnc_b, bmnc_ref[:, [1, 7, 15]],
+                                           atol=1e-12, rtol=1e-12)
+                self.assertEqual(len(residuals), 3 * (len(b.bx.xm_b) - 1))
+
     #@unittest.skipIf((not booz_xform_found) or (not vmec_found),
     #                 "booz_xform python package not found")
     @unittest.skip("This test won't work when run with other tests involving"
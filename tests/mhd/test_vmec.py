@@ -1,12 +1,121 @@
 import unittest
 import numpy as np
 import os
+import tempfile
+from scipy.io import netcdf
 
-from simsopt.mhd.vmec import vmec_found
+from simsopt.mhd.vmec import vmec_found, LazyWout
 if vmec_found:
     from simsopt.mhd.vmec import Vmec
+from simsopt.mhd.vmec_cache import VmecCache
 from . import TEST_DIR
 
+class LazyWoutTests(unittest.TestCase):
+    def test_lazy_loading(self):
+        """
+        Variables should be read from the file only when first accessed,
+        with (radius, mode) arrays transposed.
+        """
+        ns = 5
+        mnmax = 3
+        rmnc = np.arange(ns * mnmax, dtype=float).reshape((ns, mnmax))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'wout_test.nc')
+            f = netcdf.netcdf_file(filename, 'w')
+            f.createDimension('radius', ns)
+            f.createDimension('mn_mode', mnmax)
+            f.createVariable('ier_flag', 'i', ())[()] = 0
+            f.createVariable('volume_p', 'd', ())[()] = 2.5
+            f.createVariable('rmnc', 'd', ('radius', 'mn_mode'))[:] = rmnc
+            f.close()
+
+            wout = LazyWout(filename)
+            self.assertNotIn('rmnc', vars(wout))
+            self.assertEqual(wout.volume, 2.5)
+            np.testing.assert_allclose(wout.rmnc, rmnc.transpose())
+            self.assertIn('rmnc', vars(wout))
+            self.assertIs(wout.rmnc, wout.rmnc)
+            with self.assertRaises(AttributeError):
+                wout.bmnc
+            del wout
+
+            f = netcdf.netcdf_file(filename, 'a')
+            f.variables['ier_flag'][()] = 1
+            f.close()
+            with self.assertRaises(RuntimeError):
+                LazyWout(filename)
+
+
+    def test_load(self):
+        """
+        After load(), all variables should be available without the
+        file, so the file can be deleted.
+        """
+        rmnc = np.arange(6, dtype=float).reshape((2, 3))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'wout_test.nc')
+            f = netcdf.netcdf_file(filename, 'w')
+            f.createDimension('radius', 2)
+            f.createDimension('mn_mode', 3)
+            f.createVariable('ier_flag', 'i', ())[()] = 0
+            f.createVariable('volume_p', 'd', ())[()] = 2.5
+            f.createVariable('rmnc', 'd', ('radius', 'mn_mode'))[:] = rmnc
+            f.close()
+
+            wout = LazyWout(filename)
+            wout.load()
+            os.remove(filename)
+            self.assertEqual(wout.volume, 2.5)
+            np.testing.assert_allclose(wout.rmnc, rmnc.transpose())
+            with self.assertRaises(AttributeError):
+                wout.bmnc
+            # Calling load() again does nothing:
+            wout.load()
+
+
+    def test_cache_nbytes(self):
+        """
+        A LazyWout should be charged the size of its file in a
+        VmecCache, regardless of which variables have been read, so
+        max_bytes works and nbytes returns to 0 when all entries are
+        evicted.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filenames = []
+            for j in range(4):
+                filename = os.path.join(tmpdir, 'wout_test{}.nc'.format(j))
+                f = netcdf.netcdf_file(filename, 'w')
+                f.createDimension('radius', 50)
+                f.createDimension('mn_mode', 40)
+                f.createVariable('ier_flag', 'i', ())[()] = 0
+                f.createVariable('rmnc', 'd', ('radius', 'mn_mode'))[:] = j
+                f.close()
+                filenames.append(filename)
+            filesize = os.path.getsize(filenames[0])
+
+            cache = VmecCache(max_bytes=int(2.5 * filesize))
+            wouts = [LazyWout(filename) for filename in filenames]
+            for j in range(3):
+                cache.store(str(j), wouts[j])
+                # Reading variables after storing does not change the
+                # size of the entry:
+                wouts[j].rmnc
+            self.assertEqual(list(cache.entries.keys()), ['1', '2'])
+            self.assertEqual(cache.nbytes, 2 * filesize)
+            cache.store('2', wouts[2])
+            self.assertEqual(cache.nbytes, 2 * filesize)
+
+            cache.max_entries = 1
+            cache.store('3', wouts[3])
+            self.assertEqual(cache.nbytes, filesize)
+            cache.max_bytes = 0
+            cache.store('3', wouts[3])
+            self.assertEqual(len(cache.entries), 0)
+            self.assertEqual(cache.nbytes, 0)
+            for wout in wouts:
+                wout.load()
+
+
 @unittest.skipIf(not vmec_found, "Valid Python interface to VMEC not found")
 class VmecTests(unittest.TestCase):
     def test_init_defaults(self):
@@ -55,6 +164,115 @@ class VmecTests(unittest.TestCase):
         self.assertFalse(v.free_boundary)
         self.assertTrue(v.need_to_run_code)
 
+    def test_cache(self):
+        """
+        Running VMEC again for the same inputs should use the cache
+        instead of running VMEC.
+        """
+        cache = VmecCache()
+        v = Vmec(cache=cache)
+        volume = v.volume()
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(v.iter, 1)
+
+        v.need_to_run_code = True
+        self.assertAlmostEqual(v.volume(), volume)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(v.iter, 1)
+
+        # Changing the boundary should trigger a new run:
+        v.boundary.set_rc(0, 0, 1.1 * v.boundary.get_rc(0, 0))
+        self.assertTrue(v.need_to_run_code)
+        v.volume()
+        self.assertEqual(cache.misses, 2)
+        self.assertEqual(v.iter, 2)
+
+    def test_warm_start(self):
+        """
+        A warm-started run should give the same result as a cold-started
+        run, to within the solver tolerance.
+        """
+        filename = os.path.join(TEST_DIR, 'input.li383_low_res')
+        volumes = []
+        for warm_start in [False, True]:
+            v = Vmec(filename, warm_start=warm_start)
+            v.volume()
+            v.boundary.set_rc(0, 0, v.boundary.get_rc(0, 0) + 1.0e-4)
+            volumes.append(v.volume())
+        self.assertAlmostEqual(volumes[0], volumes[1], places=7)
+
+    def test_cache_key_includes_ftol(self):
+        """
+        Equilibria converged to different tolerances should have
+        different cache keys.
+        """
+        v = Vmec(warm_start=True)
+        key = v.cache_key()
+        v.warm_start_ftol_factor = 0.1
+        self.assertNotEqual(v.cache_key(), key)
+        v.warm_start_ftol_factor = 1.0
+        key = v.cache_key()
+        v.warm_start = False
+        self.assertEqual(v.cache_key(), key)
+
+    def test_wout_in_memory(self):
+        """
+        Loading the output from VMEC's fortran memory should give the
+        same results as reading the wout file, and the wout file should
+        be deleted unless keep_wout_files is set.
+        """
+        filename = os.path.join(TEST_DIR, 'input.li383_low_res')
+        v1 = Vmec(filename)
+        v1.run()
+        self.assertTrue(os.path.exists(v1.output_file))
+        v2 = Vmec(filename, wout_in_memory=True)
+        v2.run()
+        # Each run writes its own file, so v1's file is not touched:
+        self.assertNotEqual(v1.output_file, v2.output_file)
+        self.assertTrue(os.path.exists(v1.output_file))
+        self.assertFalse(os.path.exists(v2.output_file))
+        self.assertAlmostEqual(v1.wout.aspect, v2.wout.aspect)
+        self.assertAlmostEqual(v1.wout.volume, v2.wout.volume)
+        self.assertEqual(v1.wout.mnmax, v2.wout.mnmax)
+        for name in ['xm', 'xn', 'rmnc', 'zmns', 'bmnc', 'iotaf']:
+            np.testing.assert_allclose(getattr(v1.wout, name),
+                                       getattr(v2.wout, name))
+
+        v3 = Vmec(filename, wout_in_memory=True)
+        v3.keep_wout_files = True
+        v3.run()
+        self.assertTrue(os.path.exists(v3.output_file))
+
+    def test_wout_in_memory_lasym(self):
+        """
+        For a non-stellarator-symmetric run, loading the output from
+        VMEC's fortran memory should also give the asymmetric arrays
+        and the magnetic axis, as when reading the wout file.
+        """
+        filename = os.path.join(TEST_DIR, 'input.li383_low_res')
+        v1 = Vmec(filename)
+        v1.stellsym = False
+        v1.run()
+        v2 = Vmec(filename, wout_in_memory=True)
+        v2.stellsym = False
+        v2.run()
+        self.assertTrue(v2.wout.lasym)
+        for name in ['rmnc', 'rmns', 'zmns', 'zmnc', 'lmns', 'lmnc', 'bmnc', 'bmns',
+                     'bsubumnc', 'bsubumns', 'bsubvmnc', 'bsubvmns',
+                     'raxis_cc', 'raxis_cs', 'zaxis_cs', 'zaxis_cc']:
+            np.testing.assert_allclose(getattr(v1.wout, name),
+                                       getattr(v2.wout, name), atol=1e-12)
+
+    def test_wout_in_memory_missing_file(self):
+        """
+        Failing to read the wout file should raise an error rather than
+        returning the data of a previous run.
+        """
+        v = Vmec(wout_in_memory=True)
+        v.output_file = os.path.join(TEST_DIR, 'wout_does_not_exist.nc')
+        with self.assertRaises(RuntimeError):
+            v.load_wout()
+
     #def test_stellopt_scenarios_1DOF_circularCrossSection_varyR0_targetVolume(self):
         """
         This script implements the "1DOF_circularCrossSection_varyR0_targetVolume"
@@ -0,0 +1,125 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+
+from simsopt.core.util import Struct
+from simsopt.mhd.vmec_cache import VmecCache, hash_state, wout_nbytes
+
+
+def make_wout(val, n=10):
+    wout = Struct()
+    wout.aspect = val
+    wout.rmnc = np.full((n, 3), val)
+    return wout
+
+
+class HashStateTests(unittest.TestCase):
+    def test_hash_state(self):
+        """
+        Equal inputs should give equal keys, and any change in the
+        inputs should change the key.
+        """
+        x = np.array([1.0, 2.0, 3.0])
+        key = hash_state('abc', x, [1, 2])
+        self.assertEqual(key, hash_state('abc', np.copy(x), [1.0, 2.0]))
+        self.assertNotEqual(key, hash_state('abd', x, [1, 2]))
+        self.assertNotEqual(key, hash_state('abc', x + 1e-15, [1, 2]))
+        self.assertNotEqual(key, hash_state('abc', x.reshape((3, 1)), [1, 2]))
+
+
+class VmecCacheTests(unittest.TestCase):
+    def test_hits_and_misses(self):
+        cache = VmecCache()
+        self.assertIsNone(cache.get('a'))
+        wout = make_wout(1.0)
+        cache.store('a', wout)
+        self.assertIs(cache.get('a'), wout)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats(), {'entries': 1,
+                                         'bytes': wout_nbytes(wout),
+                                         'hits': 1,
+                                         'misses': 2,
+                                         'evictions': 0})
+
+    def test_max_entries(self):
+        """
+        The least recently used entry should be evicted first.
+        """
+        cache = VmecCache(max_entries=2)
+        cache.store('a', make_wout(1.0))
+        cache.store('b', make_wout(2.0))
+        cache.get('a')
+        cache.store('c', make_wout(3.0))
+        self.assertEqual(list(cache.entries.keys()), ['a', 'c'])
+        self.assertEqual(cache.evictions, 1)
+
+    def test_max_bytes(self):
+        nbytes = wout_nbytes(make_wout(1.0))
+        cache = VmecCache(max_bytes=int(2.5 * nbytes))
+        for j, key in enumerate(['a', 'b', 'c', 'd']):
+            cache.store(key, make_wout(float(j)))
+        self.assertEqual(list(cache.entries.keys()), ['c', 'd'])
+        self.assertEqual(cache.nbytes, 2 * nbytes)
+        self.assertEqual(cache.evictions, 2)
+
+    def test_directory(self):
+        """
+        Entries evicted from memory should be recovered from disk.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = VmecCache(max_entries=1, directory=tmpdir)
+            for key in ['a', 'b']:
+                src = os.path.join(tmpdir, 'src_' + key)
+                with open(src, 'w') as f:
+                    f.write(key)
+                cache.store(key, make_wout(1.0), output_file=src)
+            self.assertTrue(os.path.exists(cache.filename('a')))
+            self.assertEqual(list(cache.entries.keys()), ['b'])
+
+            def loader(filename):
+                with open(filename) as f:
+                    return make_wout(float(ord(f.read())))
+
+            wout = cache.get('a', loader=loader)
+            self.assertEqual(wout.aspect, float(ord('a')))
+            self.assertEqual(cache.hits, 1)
+            self.assertEqual(list(cache.entries.keys()), ['a'])
+            # Without a loader, the disk is not consulted:
+            self.assertIsNone(cache.get('b'))
+
+    def test_nearest(self):
+        """
+        nearest() should return the closest entry with the same static
+        key whose wout file exists.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            files = []
+            for j in range(3):
+                files.append(os.path.join(tmpdir, 'wout_{}.nc'.format(j)))
+                with open(files[-1], 'w') as f:
+                    f.write('x')
+            cache = VmecCache()
+            self.assertIsNone(cache.nearest('s', [0.0, 0.0]))
+            cache.store('a', make_wout(1.0), output_file=files[0],
+                        static_key='s', state=[0.0, 0.0])
+            cache.store('b', make_wout(2.0), output_file=files[1],
+                        static_key='s', state=[1.0, 1.0])
+            cache.store('c', make_wout(3.0), output_file=files[2],
+                        static_key='t', state=[0.9, 0.9])
+            # An entry without a state is ignored:
+            cache.store('d', make_wout(4.0))
+
+            wout, wout_file, distance = cache.nearest('s', [0.8, 0.8])
+            self.assertEqual(wout.aspect, 2.0)
+            self.assertEqual(wout_file, files[1])
+            self.assertAlmostEqual(distance, np.sqrt(0.08))
+
+            os.remove(files[1])
+            wout, wout_file, distance = cache.nearest('s', [0.8, 0.8])
+            self.assertEqual(wout_file, files[0])
+            self.assertIsNone(cache.nearest('u', [0.8, 0.8]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -118,8 +118,7 @@ class F90wrapVmecTests(unittest.TestCase):
 
         # Now try reading in the output
         wout_file = os.path.join(os.path.dirname(__file__), 'wout_li383_low_res.nc')
-        ierr = 0
-        vmec.read_wout_mod.read_wout_file(wout_file, ierr)
+        ierr = vmec.read_wout_mod.read_wout_file(wout_file)
         self.assertEqual(ierr, 0)
         self.assertAlmostEqual(vmec.read_wout_mod.betatot, \
                                    0.0426211525919469, places=4)
@@ -0,0 +1,104 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from simsopt.core.functions import Rosenbrock
+from simsopt.core.least_squares_problem import LeastSquaresProblem
+from simsopt.solve.history import History, load_history, history_to_csv
+from simsopt.solve.serial_solve import least_squares_serial_solve
+
+
+class HistoryTests(unittest.TestCase):
+    def test_record_and_load(self):
+        """
+        Rows recorded by History should be read back by load_history,
+        including rows flushed in several chunks.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            directory = os.path.join(tmpdir, 'simsopt_test')
+            history = History(2, directory=directory, flush_rows=3,
+                              flush_seconds=None)
+            for j in range(7):
+                history.record(np.array([j, -j]), 10.0 * j, np.array([j, 2 * j, 3 * j]))
+            # Only the full chunks have been written so far:
+            index, data = load_history(directory)
+            self.assertEqual(index['rows'], [3, 3])
+            self.assertEqual(data.shape, (6, 8))
+
+            history.close()
+            index, data = load_history(directory)
+            self.assertEqual(index['nvals'], 3)
+            self.assertEqual(index['rows'], [3, 3, 1])
+            np.testing.assert_equal(data[:, 0], np.arange(7))
+            np.testing.assert_equal(data[:, 2], np.arange(7))
+            np.testing.assert_equal(data[:, 3], -np.arange(7))
+            np.testing.assert_equal(data[:, 4], 10.0 * np.arange(7))
+            np.testing.assert_equal(data[:, 7], 3 * np.arange(7))
+            self.assertTrue(np.all(np.diff(data[:, 1]) >= 0))
+
+    def test_general(self):
+        """
+        For general problems, there should be no residual columns and
+        no residuals file.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            directory = os.path.join(tmpdir, 'simsopt_test')
+            history = History(3, problem_type='general', directory=directory)
+            history.record(np.array([1.0, 2.0, 3.0]), 4.0)
+            history.close()
+            index, data = load_history(directory)
+            np.testing.assert_equal(data[:, 2:], [[1.0, 2.0, 3.0, 4.0]])
+            filenames = history_to_csv(directory, tmpdir)
+            self.assertEqual(filenames, [os.path.join(tmpdir, 'simsopt_test.dat')])
+
+    def test_csv(self):
+        """
+        history_to_csv should write files in the text format of
+        earlier versions of simsopt.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            directory = os.path.join(tmpdir, 'simsopt_test')
+            history = History(2, directory=directory)
+            history.record(np.array([1.0, 2.0]), 0.5, np.array([0.25, -0.75]))
+            history.record(np.array([3.0, 4.0]), 1.5, np.array([1.25, -1.75]))
+            history.close()
+            filenames = history_to_csv(directory, tmpdir)
+            self.assertEqual(filenames, [os.path.join(tmpdir, 'simsopt_test.dat'),
+                                         os.path.join(tmpdir, 'residuals_test.dat')])
+
+            with open(filenames[0]) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(lines[:5], ['Problem type:', 'least_squares', 'nparams:', '2',
+                                         'function_evaluation,seconds,x(0),x(1),objective_function'])
+            self.assertEqual(len(lines), 7)
+            vals = [float(s) for s in lines[6].split(',')]
+            self.assertEqual(vals[0], 1)
+            np.testing.assert_equal(vals[2:], [3.0, 4.0, 1.5])
+
+            with open(filenames[1]) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(lines[4], 'function_evaluation,seconds,x(0),x(1),'
+                             'objective_function,F(0),F(1)')
+            vals = [float(s) for s in lines[5].split(',')]
+            np.testing.assert_equal(vals[2:], [1.0, 2.0, 0.5, 0.25, -0.75])
+
+    def test_solve(self):
+        """
+        A solver given a History should record every function evaluation.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            directory = os.path.join(tmpdir, 'simsopt_test')
+            r = Rosenbrock()
+            prob = LeastSquaresProblem([(r.term1, 0, 1), (r.term2, 0, 1)])
+            history = History(2, directory=directory)
+            least_squares_serial_solve(prob, history=history)
+            index, data = load_history(directory)
+            self.assertEqual(data.shape[0], history.nevals)
+            self.assertGreater(history.nevals, 0)
+            np.testing.assert_allclose(data[-1, 2:4], [1, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
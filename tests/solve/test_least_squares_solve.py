@@ -1,10 +1,14 @@
 import unittest
 import logging
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
 from simsopt.core.functions import Identity, Rosenbrock
 from simsopt.core.optimizable import Target
 from simsopt.core.least_squares_problem import LeastSquaresProblem, LeastSquaresTerm
 from simsopt.solve.serial_solve import least_squares_serial_solve
+from simsopt.solve.history import History
 from simsopt.util.mpi import MpiPartition
 from simsopt.solve.mpi_solve import least_squares_mpi_solve
 
@@ -15,6 +19,19 @@ solvers = [least_squares_serial_solve, mpi_solve_1group]
 
 #logging.basicConfig(level=logging.DEBUG)
 
+class CountingRosenbrock(Rosenbrock):
+    """
+    Rosenbrock, but counting the calls to term1.
+    """
+    def __init__(self):
+        super().__init__()
+        self.ncalls = 0
+
+    def term1(self):
+        self.ncalls += 1
+        return super().term1()
+
+
 class LeastSquaresProblemTests(unittest.TestCase):
 
     def test_solve_quadratic(self):
@@ -178,5 +195,36 @@ class LeastSquaresProblemTests(unittest.TestCase):
                 self.assertAlmostEqual(v[0], 1)
                 self.assertAlmostEqual(v[1], 1)
 
+    def test_one_call_per_evaluation(self):
+        """
+        least_squares_serial_solve should call each function exactly
+        once per evaluation of the residuals, unless validate is True.
+        """
+        for grad in [True, False]:
+            for validate in [False, True]:
+                r = CountingRosenbrock()
+                prob = LeastSquaresProblem([(r.term1, 0, 1), (r.term2, 0, 1)])
+                with tempfile.TemporaryDirectory() as tmpdir:
+                    history = History(2, directory=os.path.join(tmpdir, 'history'))
+                    least_squares_serial_solve(prob, grad=grad, history=history,
+                                               validate=validate)
+                self.assertGreater(history.nevals, 0)
+                expected = 2 * history.nevals if validate else history.nevals
+                self.assertEqual(r.ncalls, expected)
+
+    def test_solve_rosenbrock_executor(self):
+        """
+        Minimize the Rosenbrock function using a finite-difference
+        Jacobian evaluated by a process pool.
+        """
+        r = Rosenbrock()
+        prob = LeastSquaresProblem([(r.term1, 0, 1), (r.term2, 0, 1)])
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            least_squares_serial_solve(prob, grad=False, executor=executor)
+        self.assertAlmostEqual(prob.objective(), 0)
+        v = r.get_dofs()
+        self.assertAlmostEqual(v[0], 1)
+        self.assertAlmostEqual(v[1], 1)
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,11 +1,16 @@
 import logging
+import tempfile
 import unittest
+from time import sleep, time
 import numpy as np
 from mpi4py import MPI
 from simsopt.core.dofs import Dofs
 from simsopt.core.least_squares_problem import LeastSquaresProblem
 from simsopt.util.mpi import MpiPartition
-from simsopt.solve.mpi_solve import fd_jac_mpi, least_squares_mpi_solve
+from simsopt.solve.mpi_solve import fd_jac_mpi, least_squares_mpi_solve, broyden_update, \
+    f_speculative_mpi, mpi_leaders_task, mpi_workers_task, drain_results, wait_for_sends, \
+    mobilize_available_leaders, CALCULATE_SPECULATIVE, CALCULATE_FD_JAC
+from simsopt.solve.history import History
 
 #logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger('[{}]'.format(MPI.COMM_WORLD.Get_rank()) + __name__)
@@ -75,6 +80,53 @@ class TestFunction3:
         self.comm.barrier()
         return self.x[0] ** 2 - self.x[1]
     
+class TestFunction4(TestFunction2):
+    """
+    Like TestFunction2, but evaluation fails when x[1] is increased,
+    and is slow on processors other than proc0_world.
+    """
+    def __init__(self, mpi, delay=0):
+        super().__init__()
+        self.mpi = mpi
+        self.delay = delay
+
+    def f0(self):
+        if not self.mpi.proc0_world:
+            sleep(self.delay)
+        if self.x[1] > 0.9:
+            raise RuntimeError('Evaluation failed')
+        return super().f0()
+
+class TestFunction5(TestFunction2):
+    """
+    Like TestFunction2, but slow on processors other than proc0_world.
+    """
+    def __init__(self, mpi, delay=0):
+        super().__init__()
+        self.mpi = mpi
+        self.delay = delay
+
+    def f0(self):
+        if not self.mpi.proc0_world:
+            sleep(self.delay)
+        return super().f0()
+
+class TestFunction6(TestFunction3):
+    """
+    Like TestFunction3, but the first evaluation on group 1 hangs for
+    delay seconds.
+    """
+    def __init__(self, mpi, delay):
+        super().__init__(mpi.comm_groups)
+        self.hang = (mpi.group == 1)
+        self.delay = delay
+
+    def f0(self):
+        if self.hang:
+            self.hang = False
+            sleep(self.delay)
+        return super().f0()
+
 class MpiPartitionTests(unittest.TestCase):
     def test_ngroups1(self):
         """
@@ -236,6 +288,89 @@ class MpiPartitionTests(unittest.TestCase):
             jac = d.fd_jac(centered=True, eps=1e-7)
             np.testing.assert_allclose(jac, jac_reference, rtol=1e-13, atol=1e-13)
             
+    def test_fd_jac_task_times(self):
+        """
+        Every column of the finite-difference Jacobian should be
+        evaluated exactly once, and its timing recorded.
+        """
+        for ngroups in range(1, 4):
+            mpi = MpiPartition(ngroups=ngroups)
+            o = TestFunction2()
+            d = Dofs([o.f0, o.f1, o.f2, o.f3])
+            task_times = {}
+            jac, xs, evals = fd_jac_mpi(d, mpi, centered=True, eps=1e-7,
+                                        task_times=task_times)
+            if mpi.proc0_world:
+                self.assertEqual(len(task_times['time']), 4)
+                self.assertTrue(np.all(task_times['time'] >= 0))
+                self.assertTrue(np.all(task_times['group'] >= 0))
+                self.assertTrue(np.all(task_times['group'] < mpi.ngroups))
+                jac_serial = d.fd_jac(centered=True, eps=1e-7)
+                np.testing.assert_allclose(jac, jac_serial, rtol=1e-13, atol=1e-13)
+
+    def test_fd_jac_failures(self):
+        """
+        Failed function evaluations should give the penalty value, and
+        slow groups should have their columns given to other groups.
+        """
+        for ngroups in range(1, 4):
+            for delay in [0, 0.3]:
+                mpi = MpiPartition(ngroups=ngroups)
+                o = TestFunction4(mpi, delay=delay)
+                d = Dofs([o.f0, o.f1])
+                task_times = {}
+                jac, xs, evals = fd_jac_mpi(d, mpi, centered=False, eps=1e-7,
+                                            task_times=task_times, timeout=0.1,
+                                            penalty=1.0e12)
+                if mpi.proc0_world:
+                    np.testing.assert_allclose(evals[:, 2], [1.0e12, 1.0e12])
+                    o2 = TestFunction2()
+                    jac_reference = Dofs([o2.f0, o2.f1]).fd_jac(centered=False, eps=1e-7)
+                    np.testing.assert_allclose(jac[:, 0], jac_reference[:, 0],
+                                               rtol=1e-13, atol=1e-13)
+                    if delay > 0:
+                        # Only proc0_world is fast enough:
+                        np.testing.assert_equal(task_times['group'], [0, 0, 0])
+
+    def test_fd_jac_all_failures(self):
+        """
+        If all function evaluations fail, every proc should raise an
+        exception, unless the number of function values is already
+        known, in which case the penalty value is used.
+        """
+        for ngroups in range(1, 4):
+            mpi = MpiPartition(ngroups=ngroups)
+            o = TestFunction4(mpi)
+            d = Dofs([o.f0, o.f1])
+            x = np.array([0.0, 0.95])
+            with self.assertRaises(RuntimeError):
+                fd_jac_mpi(d, mpi, x=x, centered=False, eps=1e-7)
+
+            d.f(np.zeros(2))
+            jac, xs, evals = fd_jac_mpi(d, mpi, x=x, centered=False, eps=1e-7,
+                                        penalty=1.0e12)
+            if mpi.proc0_world:
+                np.testing.assert_allclose(evals, np.full((2, 3), 1.0e12))
+
+    def test_fd_jac_richardson(self):
+        """
+        The step sizes and stencil set on proc0_world should be used by
+        all groups.
+        """
+        for ngroups in range(1, 4):
+            for centered in [False, True]:
+                mpi = MpiPartition(ngroups=ngroups)
+                o = TestFunction2()
+                d = Dofs([o.f0, o.f1, o.f2, o.f3])
+                if mpi.proc0_world:
+                    eps = np.array([1e-3, 2e-3])
+                    jac, xs, evals = fd_jac_mpi(d, mpi, eps=eps, centered=centered,
+                                                richardson=True)
+                    jac_serial = d.fd_jac(eps=eps, centered=centered, richardson=True)
+                    np.testing.assert_allclose(jac, jac_serial, rtol=1e-13, atol=1e-13)
+                else:
+                    fd_jac_mpi(d, mpi)
+
     def test_parallel_optimization(self):
         """
         Test a full least-squares optimization.
@@ -251,3 +386,122 @@ class MpiPartitionTests(unittest.TestCase):
                 self.assertAlmostEqual(prob.x[0], 1)
                 self.assertAlmostEqual(prob.x[1], 1)
                 
+
+    def test_speculative_optimization(self):
+        """
+        Speculative evaluation of the finite-difference points should
+        not change the result of an optimization.
+        """
+        for ngroups in range(1, 4):
+            mpi = MpiPartition(ngroups=ngroups)
+            o = TestFunction3(mpi.comm_groups)
+            term1 = (o.f0, 0, 1)
+            term2 = (o.f1, 0, 1)
+            prob = LeastSquaresProblem([term1, term2])
+            least_squares_mpi_solve(prob, mpi, grad=True, speculative=True)
+            self.assertAlmostEqual(prob.x[0], 1)
+            self.assertAlmostEqual(prob.x[1], 1)
+
+    def test_hung_group(self):
+        """
+        A group that hangs for much longer than the whole optimization
+        should be left out after it exceeds the timeout, and
+        proc0_world should return without waiting for it.
+        """
+        delay = 3.0
+        mpi = MpiPartition()
+        if mpi.ngroups < 2:
+            return
+        o = TestFunction6(mpi, delay)
+        term1 = (o.f0, 0, 1)
+        term2 = (o.f1, 0, 1)
+        prob = LeastSquaresProblem([term1, term2])
+        start_time = time()
+        least_squares_mpi_solve(prob, mpi, grad=True, timeout=0.1)
+        if mpi.proc0_world:
+            self.assertLess(time() - start_time, delay / 2)
+        self.assertAlmostEqual(prob.x[0], 1)
+        self.assertAlmostEqual(prob.x[1], 1)
+        # Let the hung group catch up before the next test:
+        mpi.comm_world.barrier()
+
+    def test_speculative_fd_jac(self):
+        """
+        f_speculative_mpi should not wait for the other groups, and
+        fd_jac_mpi should receive their results instead of evaluating
+        those columns again.
+        """
+        for ngroups in range(1, 4):
+            mpi = MpiPartition(ngroups=ngroups)
+            o = TestFunction5(mpi, delay=0.5)
+            d = Dofs([o.f0, o.f1, o.f2, o.f3])
+            mpi.apart(lambda mpi2, data: mpi_leaders_task(mpi, d, data),
+                      lambda mpi2, data: mpi_workers_task(mpi, d, data))
+            if mpi.proc0_world:
+                x = np.array([1.2, 0.9])
+                start_time = time()
+                leaders = mobilize_available_leaders(mpi, CALCULATE_SPECULATIVE)
+                f0, speculative = f_speculative_mpi(d, mpi, x, leaders=leaders)
+                self.assertLess(time() - start_time, 0.25)
+
+                leaders = mobilize_available_leaders(mpi, CALCULATE_FD_JAC, speculative)
+                self.assertEqual(leaders, list(range(1, mpi.ngroups)))
+                task_times = {}
+                jac, xs, evals = fd_jac_mpi(d, mpi, x, known_evals={0: f0},
+                                            speculative=speculative,
+                                            task_times=task_times, leaders=leaders)
+                for rank, j in speculative['columns'].items():
+                    self.assertEqual(task_times['group'][j], rank)
+                o2 = TestFunction2()
+                jac_reference = Dofs([o2.f0, o2.f1, o2.f2, o2.f3]).fd_jac(eps=1e-7)
+                np.testing.assert_allclose(jac, jac_reference, rtol=1e-13, atol=1e-13)
+                drain_results(mpi)
+            mpi.together()
+            if mpi.proc0_groups and not mpi.proc0_world:
+                wait_for_sends()
+
+    def test_broyden_update(self):
+        """
+        The Broyden update should satisfy the secant condition, and
+        should be rejected when the linear model predicts the change
+        in the residuals badly.
+        """
+        jac = np.array([[1.0, 0.0], [2.0, -1.0], [0.5, 3.0]])
+        x0 = np.array([0.3, -0.2])
+        f0 = np.array([1.0, 2.0, -1.5])
+        x1 = x0 + np.array([-0.1, 0.05])
+        f1 = f0 + jac @ (x1 - x0) + np.array([0.01, -0.02, 0.005])
+        jac1 = broyden_update(jac, x0, f0, x1, f1)
+        np.testing.assert_allclose(jac1 @ (x1 - x0), f1 - f0, rtol=1e-13, atol=1e-13)
+        # The update changes the Jacobian only along the step:
+        perp = np.array([0.05, 0.1])
+        np.testing.assert_allclose(jac1 @ perp, jac @ perp, rtol=1e-13, atol=1e-13)
+
+        # Residuals that grow instead of shrinking:
+        self.assertIsNone(broyden_update(jac, x0, f0, x1, 2 * f0))
+        # Zero step:
+        self.assertIsNone(broyden_update(jac, x0, f0, x0, f0))
+
+    def test_broyden_optimization(self):
+        """
+        Broyden updates of the Jacobian should reach the same optimum
+        with fewer function evaluations.
+        """
+        for ngroups in range(1, 4):
+            nevals = {}
+            for broyden in [False, True]:
+                mpi = MpiPartition(ngroups=ngroups)
+                o = TestFunction3(mpi.comm_groups)
+                term1 = (o.f0, 0, 1)
+                term2 = (o.f1, 0, 1)
+                prob = LeastSquaresProblem([term1, term2])
+                with tempfile.TemporaryDirectory() as tmpdir:
+                    history = History(2, directory=tmpdir) if mpi.proc0_world else None
+                    least_squares_mpi_solve(prob, mpi, grad=True, broyden=broyden,
+                                            history=history)
+                    if mpi.proc0_world:
+                        nevals[broyden] = history.nevals
+                self.assertAlmostEqual(prob.x[0], 1)
+                self.assertAlmostEqual(prob.x[1], 1)
+            if mpi.proc0_world:
+                self.assertLess(nevals[True], nevals[False])